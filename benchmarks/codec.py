@@ -0,0 +1,49 @@
+""" Compares the size and speed of Map logs written with each codec.
+
+Usage: codec.py [number of records]
+
+"""
+
+import os
+import sys
+
+import persisted
+from persisted import Map, ThresholdPolicy
+from persisted.log import Log
+from persisted.map import _op_names
+from timing import ScratchDirectory, Timer, report
+
+_codecs = [
+    ("json (default)", persisted.CODEC_JSON),
+    ("binary", persisted.CODEC_BINARY),
+]
+
+# Keys are reused so that the log holds overwritten entries, as a long-lived
+# Stack's log would. Compaction is disabled so that the whole history is kept.
+_distinct_keys = 1000
+
+def main(records):
+    with ScratchDirectory() as scratch:
+        for label, codec in _codecs:
+            path = scratch.file(codec)
+            test_map = Map(path, codec=codec, group_commit_size=1000,
+                compaction_policy=ThresholdPolicy(float("inf")))
+            with Timer() as write:
+                for i in range(records):
+                    key = "http://example.com/%d" % (i % _distinct_keys)
+                    test_map[key] = {"title" : "Page %d" % i,
+                        "timestamp" : float(i), "url" : key}
+                test_map.close()
+            report("%s: write" % label, records, write.seconds)
+            print "%s: %d bytes" % (label, os.stat(path).st_size)
+            # Replay into a fresh map so that opening does not compact the log.
+            log = Log(path, lambda: [], validate=False, codec=codec,
+                op_names=_op_names)
+            replayed = Map(scratch.file(codec + ".replayed"))
+            with Timer() as replay:
+                log.replay(replayed._get_op_map())
+            report("%s: replay" % label, records, replay.seconds)
+            assert replayed._inner_map == test_map._inner_map
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
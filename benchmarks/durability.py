@@ -0,0 +1,46 @@
+""" Compares Stack.add throughput under each durability mode.
+
+Usage: durability.py [number of pages]
+
+"""
+
+import sys
+import time
+
+import persisted
+from stack import Stack
+from timing import ScratchDirectory, Timer, report
+
+_configurations = [
+    ("none", dict(durability=persisted.DURABILITY_NONE)),
+    ("flush (default)", dict(durability=persisted.DURABILITY_FLUSH)),
+    ("fsync", dict(durability=persisted.DURABILITY_FSYNC)),
+    ("fsync_interval 100ms", dict(
+        durability=persisted.DURABILITY_FSYNC_INTERVAL, fsync_interval=0.1)),
+    ("fsync_interval 1000 ops", dict(
+        durability=persisted.DURABILITY_FSYNC_INTERVAL, fsync_interval=60,
+        fsync_ops=1000)),
+    ("flush + group commit 100", dict(
+        durability=persisted.DURABILITY_FLUSH, group_commit_size=100)),
+    ("fsync + group commit 100", dict(
+        durability=persisted.DURABILITY_FSYNC, group_commit_size=100)),
+]
+
+def main(pages):
+    with ScratchDirectory() as scratch:
+        for label, options in _configurations:
+            stack = Stack(scratch.file(label), **options)
+            # fsync per operation is slow enough that we use fewer pages.
+            count = pages
+            if options.get("durability") == persisted.DURABILITY_FSYNC and \
+                    "group_commit_size" not in options:
+                count = max(pages / 100, 1)
+            with Timer() as timer:
+                for i in range(count):
+                    stack.add("http://example.com/%d" % (i % 1000),
+                        "Page %d" % i, time.time())
+                stack.close()
+            report(label, count, timer.seconds)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
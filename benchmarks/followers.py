@@ -0,0 +1,70 @@
+""" Measures how quickly follower processes catch up with a writer.
+
+Each follower process opens the map read-only and follows it while the writer
+process saves a burst of pages. The lag is the time from the writer's last
+write to the moment a follower holds every page. It is compared with the time
+a reader would take to reopen the map instead.
+
+Usage: followers.py [pages in the map] [pages written] [followers]
+
+"""
+
+import multiprocessing
+import sys
+import time
+
+from persisted import Follower, Map
+from timing import ScratchDirectory, Timer, report
+
+_interval = 0.01
+
+def fill(test_map, start, pages):
+    for i in range(start, start + pages):
+        key = "http://example.com/%d" % i
+        test_map[key] = {"title" : "Page %d" % i, "timestamp" : float(i),
+            "url" : key}
+
+def follow(path, expected, ready, results):
+    # Runs in a follower process. Reports when it saw the last page.
+    reader = Map(path, read_only=True)
+    follower = Follower(reader, interval=_interval)
+    ready.put(None)
+    while len(reader) < expected:
+        time.sleep(_interval / 10)
+    results.put(time.time())
+    follower.stop()
+    reader.close()
+
+def main(pages, written, followers):
+    with ScratchDirectory() as scratch:
+        path = scratch.file("map")
+        writer = Map(path, group_commit_size=1000)
+        fill(writer, 0, pages)
+        writer.flush()
+        ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=follow,
+            args=(path, pages + written, ready, results))
+            for _ in range(followers)]
+        for process in processes:
+            process.start()
+        for _ in processes:
+            ready.get()
+        with Timer() as timer:
+            fill(writer, pages, written)
+            writer.flush()
+        report("write", written, timer.seconds)
+        finished = time.time()
+        lags = [results.get() - finished for _ in processes]
+        for process in processes:
+            process.join()
+        print "%d followers caught up within %.3f s (mean %.3f s)" % (
+            followers, max(lags), sum(lags) / len(lags))
+        with Timer() as timer:
+            Map(path, read_only=True).close()
+        report("reopen read-only instead", pages + written, timer.seconds)
+        writer.close()
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 10000,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 4)
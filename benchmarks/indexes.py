@@ -0,0 +1,68 @@
+""" Measures the cost of secondary indexes on a Map of Stack-like pages.
+
+Reports write throughput with and without an index on the pages' titles, the
+memory the index takes, and lookups through the index against a linear scan
+over the values.
+
+Usage: indexes.py [number of pages]
+
+"""
+
+import sys
+
+import persisted
+from persisted import Map
+from timing import ScratchDirectory, Timer, report
+
+# Titles are shared by several pages, as they would be for a site's pages.
+_distinct_titles = 1000
+_lookups = 100
+
+def title(page):
+    return page["title"]
+
+def index_size(index):
+    # The bytes taken by the index's own dict and sets. The keys and titles
+    # are shared with the map, so they are not counted.
+    return sys.getsizeof(index.buckets) + \
+        sum(sys.getsizeof(bucket) for bucket in index.buckets.itervalues())
+
+def fill(test_map, pages):
+    for i in range(pages):
+        key = "http://example.com/%d" % i
+        test_map[key] = {"title" : "Title %d" % (i % _distinct_titles),
+            "timestamp" : float(i), "url" : key}
+
+def main(pages):
+    with ScratchDirectory() as scratch:
+        for label, indexes in [("no index", None),
+                ("title index", {"title" : title})]:
+            test_map = Map(scratch.file(label), indexes=indexes,
+                durability=persisted.DURABILITY_NONE)
+            with Timer() as write:
+                fill(test_map, pages)
+            report("%s: write" % label, pages, write.seconds)
+            with Timer() as rewrite:
+                fill(test_map, pages)
+            report("%s: overwrite" % label, pages, rewrite.seconds)
+            test_map.close()
+            with Timer() as reopen:
+                test_map = Map(scratch.file(label), indexes=indexes)
+            report("%s: open" % label, pages, reopen.seconds)
+        size = index_size(test_map._indexes["title"])
+        print "title index: %d bytes, %.1f bytes per page" % (
+            size, float(size) / pages)
+        wanted = ["Title %d" % i for i in range(_lookups)]
+        with Timer() as indexed:
+            for value in wanted:
+                test_map.lookup("title", value)
+        report("lookup through index", _lookups, indexed.seconds)
+        with Timer() as scanned:
+            for value in wanted:
+                [key for key, page in test_map.iteritems()
+                    if page["title"] == value]
+        report("lookup by scanning", _lookups, scanned.seconds)
+        test_map.close()
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,49 @@
+""" Measures the cost of locking a Map's log against other processes.
+
+Exclusive locking only locks the log when it is opened, so writes cost the
+same as without locking. Coordinated locking takes the lock, and checks for
+changes made by other writers, around every write. With several coordinated
+writer processes, each also reads back the others' writes.
+
+Usage: locking.py [writes per process] [processes]
+
+"""
+
+import multiprocessing
+import sys
+
+from persisted import Map, LOCKING_COORDINATED, LOCKING_EXCLUSIVE, \
+    LOCKING_NONE
+from timing import ScratchDirectory, Timer, report
+
+def write(path, locking, process, writes):
+    test_map = Map(path, locking=locking)
+    for i in range(writes):
+        key = "http://example.com/%d/%d" % (process, i)
+        test_map[key] = {"title" : "Page %d" % i, "timestamp" : float(i),
+            "url" : key}
+    test_map.close()
+
+def main(writes, processes):
+    with ScratchDirectory() as scratch:
+        for locking in [LOCKING_NONE, LOCKING_EXCLUSIVE, LOCKING_COORDINATED]:
+            with Timer() as timer:
+                write(scratch.file(locking), locking, 0, writes)
+            report("%s: 1 process" % locking, writes, timer.seconds)
+        path = scratch.file("processes")
+        Map(path, locking=LOCKING_COORDINATED).close()
+        writers = [multiprocessing.Process(target=write,
+            args=(path, LOCKING_COORDINATED, process, writes))
+            for process in range(processes)]
+        with Timer() as timer:
+            for writer in writers:
+                writer.start()
+            for writer in writers:
+                writer.join()
+        report("%s: %d processes" % (LOCKING_COORDINATED, processes),
+            writes * processes, timer.seconds)
+        assert len(Map(path)) == writes * processes
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 4)
@@ -0,0 +1,71 @@
+""" Measures the memory a Map of Stack-like pages takes per entry.
+
+Each configuration is filled in a fresh process, and the growth of the
+process's resident set is divided by the number of pages. This counts
+everything a page costs: its key, its value and the map's own slots. Reads
+through the map are timed as well, since compact values are decoded on access.
+Linux only, as the resident set is read from /proc.
+
+Usage: memory.py [number of pages]
+
+"""
+
+import subprocess
+import sys
+
+import persisted
+from persisted import Map, ThresholdPolicy
+from timing import ScratchDirectory, Timer, report
+
+_configurations = [
+    ("objects", {}),
+    ("compact values", {"compact_values" : True}),
+    ("compact values, cache", {"compact_values" : True,
+        "value_cache_size" : 1000}),
+]
+_reads = 100000
+
+def resident_bytes():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+
+def measure(label, pages):
+    options = dict(_configurations)[label]
+    with ScratchDirectory() as scratch:
+        # Nothing is compacted or kept in the log's write buffer, so the
+        # growth is the map's alone.
+        test_map = Map(scratch.file("map"), group_commit_size=1000,
+            durability=persisted.DURABILITY_NONE,
+            compaction_policy=ThresholdPolicy(float("inf")), **options)
+        before = resident_bytes()
+        for i in range(pages):
+            key = "http://example.com/%d" % i
+            test_map[key] = {"title" : "Page %d" % i, "timestamp" : float(i),
+                "url" : key}
+        test_map.flush()
+        grown = resident_bytes() - before
+        print "%-40s %10d pages %10.1f bytes per page" % (label, pages,
+            float(grown) / pages)
+        # Reads cycle over fewer pages than the cache holds, as reads of
+        # popular pages would.
+        keys = ["http://example.com/%d" % (i % 500) for i in range(_reads)]
+        with Timer() as read:
+            for key in keys:
+                test_map[key]
+        report("%s: read" % label, _reads, read.seconds)
+        test_map.close()
+
+def main(pages):
+    # Memory freed by one configuration stays with the process, so each runs
+    # in a process of its own.
+    for label, _ in _configurations:
+        subprocess.check_call([sys.executable, __file__, str(pages), label])
+
+if __name__ == "__main__":
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    if len(sys.argv) > 2:
+        measure(sys.argv[2], pages)
+    else:
+        main(pages)
@@ -0,0 +1,38 @@
+""" Measures opening a large log after a clean shutdown and after a crash.
+
+After a clean shutdown the tail is sealed and opening it reads nothing but the
+headers. After a crash, the records written since the log was opened have to be
+checked.
+
+Usage: open.py [number of records]
+
+"""
+
+import os
+import sys
+
+import persisted
+from persisted.log import Log
+from timing import ScratchDirectory, Timer, report
+
+def main(records):
+    with ScratchDirectory() as scratch:
+        for codec in [persisted.CODEC_JSON, persisted.CODEC_BINARY]:
+            path = scratch.file(codec)
+            log = Log(path, lambda: [], codec=codec, group_commit_size=1000,
+                compaction_policy=persisted.ThresholdPolicy(float("inf")))
+            for i in range(records):
+                log.save_operation("set", "http://example.com/%d" % i, {
+                    "title" : "Page %d" % i, "timestamp" : float(i)})
+            log.close()
+            with Timer() as sealed:
+                Log(path, lambda: [], codec=codec).close()
+            report("%s: open after clean shutdown" % codec, records,
+                sealed.seconds)
+            os.remove(path + ".sealed")
+            with Timer() as unsealed:
+                Log(path, lambda: [], codec=codec)
+            report("%s: open after crash" % codec, records, unsealed.seconds)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,60 @@
+""" Measures how replaying a large Map log scales with replay_processes.
+
+Decoding is spread over the processes while the decoded operations are still
+loaded and applied on a single core, so scaling levels off once that dominates.
+The CPU time spent by the replaying process itself is reported alongside, as a
+bound on how far replay can scale given enough cores.
+
+Usage: parallel_replay.py [number of records] [most processes]
+
+"""
+
+import multiprocessing
+import sys
+import time
+
+from persisted import Map, CODEC_BINARY, CODEC_JSON
+from persisted.log import Log
+from persisted.map import _op_names
+from timing import ScratchDirectory, Timer, report
+
+# Keys are reused so that the log holds overwritten entries, as a long-lived
+# Stack's log would.
+_distinct_keys = 100000
+
+def write_log(path, codec, records):
+    # Records are written straight to the file so that the log is never
+    # compacted while we build it.
+    encoder = Log(path, lambda: [], codec=codec, op_names=_op_names)
+    log_file = open(path, 'ab')
+    for i in range(records):
+        key = "http://example.com/%d" % (i % _distinct_keys)
+        log_file.write(encoder.encode_operation("set", key, {
+            "title" : "Page %d" % i, "timestamp" : float(i), "url" : key }))
+    log_file.close()
+
+def main(records, most_processes):
+    with ScratchDirectory() as scratch:
+        for codec in [CODEC_JSON, CODEC_BINARY]:
+            source = scratch.file(codec)
+            write_log(source, codec, records)
+            expected = None
+            for processes in range(1, most_processes + 1):
+                log = Log(source, lambda: [], validate=False, codec=codec,
+                    op_names=_op_names, replay_processes=processes)
+                replayed = Map(scratch.file("%s.%d" % (codec, processes)))
+                cpu = time.clock()
+                with Timer() as replay:
+                    log.replay(replayed._get_op_map())
+                cpu = time.clock() - cpu
+                label = "%s: %d process(es)" % (codec, processes)
+                report(label, records, replay.seconds)
+                report(label + ", replaying CPU", records, cpu)
+                if expected is None:
+                    expected = replayed._inner_map
+                assert replayed._inner_map == expected
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else
+            max(multiprocessing.cpu_count(), 2))
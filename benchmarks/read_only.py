@@ -0,0 +1,50 @@
+""" Compares opening a Map for writing with opening it read-only.
+
+Opening a map for writing replays its log and then compacts it, rewriting the
+whole snapshot. Opening it read-only only replays. A read-only map then picks
+up a writer's new records with refresh, which is compared with reopening it.
+
+Usage: read_only.py [number of pages] [pages written between refreshes]
+
+"""
+
+import sys
+
+import persisted
+from persisted import Map
+from timing import ScratchDirectory, Timer, report
+
+def fill(test_map, start, pages):
+    for i in range(start, start + pages):
+        key = "http://example.com/%d" % i
+        test_map[key] = {"title" : "Page %d" % i, "timestamp" : float(i),
+            "url" : key}
+
+def main(pages, appended):
+    with ScratchDirectory() as scratch:
+        path = scratch.file("map")
+        writer = Map(path, group_commit_size=1000,
+            durability=persisted.DURABILITY_NONE)
+        fill(writer, 0, pages)
+        writer.close()
+        with Timer() as timer:
+            writer = Map(path)
+        report("open for writing", pages, timer.seconds)
+        with Timer() as timer:
+            reader = Map(path, read_only=True)
+        report("open read-only", pages, timer.seconds)
+        fill(writer, pages, appended)
+        with Timer() as timer:
+            reader.refresh()
+        report("refresh", appended, timer.seconds)
+        with Timer() as timer:
+            reopened = Map(path, read_only=True)
+        report("reopen read-only", pages + appended, timer.seconds)
+        assert len(reader) == len(reopened) == pages + appended
+        reader.close()
+        reopened.close()
+        writer.close()
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
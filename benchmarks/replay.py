@@ -0,0 +1,60 @@
+""" Measures cold-start replay of a large Map log.
+
+Compares replaying through the Map's internal apply path with replaying through
+its public mutators, which is what Map.__init__ used to do.
+
+Usage: replay.py [number of records]
+
+"""
+
+import sys
+
+from persisted import Map
+from persisted.log import Log
+from timing import ScratchDirectory, Timer, report
+
+# Keys are reused so that the log holds overwritten and deleted entries, as a
+# long-lived Stack's log would.
+_distinct_keys = 100000
+
+def write_log(path, records):
+    # Records are written straight to the file so that the log is never
+    # compacted while we build it.
+    encoder = Log(path, lambda: [])
+    log_file = open(path, 'a')
+    for i in range(records):
+        if i % 10 == 9:
+            # Delete the key which was set by the previous record.
+            key = "http://example.com/%d" % ((i - 1) % _distinct_keys)
+            log_file.write(encoder.encode_operation("delete", key))
+        else:
+            key = "http://example.com/%d" % (i % _distinct_keys)
+            log_file.write(encoder.encode_operation("set", key, {
+                "title" : "Page %d" % i, "timestamp" : float(i), "url" : key }))
+    log_file.close()
+
+def main(records):
+    with ScratchDirectory() as scratch:
+        source = scratch.file("source")
+        write_log(source, records)
+        log = Log(source, lambda: [], validate=False)
+
+        fast_map = Map(scratch.file("fast"))
+        with Timer() as fast:
+            log.replay(fast_map._get_op_map())
+        report("internal apply path", records, fast.seconds)
+
+        public_map = Map(scratch.file("public"))
+        # Stop the public mutators from writing back to the map's own log.
+        public_map._log.save_record = lambda *args, **kwargs: None
+        with Timer() as public:
+            log.replay({
+                "set" : public_map.__setitem__,
+                "delete" : public_map.__delitem__
+            })
+        report("public mutators", records, public.seconds)
+        assert fast_map == public_map
+        print "speedup: %.2fx" % (public.seconds / fast.seconds)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,43 @@
+""" Compares compaction pauses of snapshotting and segmented Map logs.
+
+The map keeps growing while a fraction of its keys are overwritten, so every
+snapshot rewrites more than the last. Merging segments only ever rewrites about
+a segment's worth of records at a time.
+
+Usage: segments.py [number of writes]
+
+"""
+
+import sys
+import time
+
+from persisted import GarbageRatioPolicy, Map
+from timing import ScratchDirectory, report
+
+_configurations = [
+    ("snapshot", dict()),
+    ("segmented 256 KB", dict(segment_size=256 * 1024)),
+]
+
+def main(writes):
+    with ScratchDirectory() as scratch:
+        for label, options in _configurations:
+            test_map = Map(scratch.file(label), durability="none",
+                compaction_policy=GarbageRatioPolicy(
+                    max_dead_ratio=0.5, min_size=256 * 1024),
+                **options)
+            longest_pause = 0
+            start = time.time()
+            for i in range(writes):
+                # Every other write overwrites one of the most recent keys.
+                key = i if i % 2 else max(1, i - 99)
+                before = time.time()
+                test_map["http://example.com/%d" % key] = {"visits" : i}
+                longest_pause = max(longest_pause, time.time() - before)
+            seconds = time.time() - start
+            test_map.close()
+            report(label, writes, seconds)
+            print "%s: longest pause %.3f s" % (label, longest_pause)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
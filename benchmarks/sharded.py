@@ -0,0 +1,52 @@
+""" Compares a single Map with a ShardedMap under concurrent writers.
+
+Each writer thread sets its own keys. With fsync after every write, a single
+map serializes the writers on its log, while a sharded map lets the fsyncs of
+different shards overlap. Reopening measures cold start.
+
+Usage: sharded.py [writes per thread] [threads]
+
+"""
+
+import sys
+import threading
+
+import persisted
+from persisted import Map, ShardedMap
+from timing import ScratchDirectory, Timer, report
+
+def write(test_map, thread, writes):
+    for i in range(writes):
+        key = "http://example.com/%d/%d" % (thread, i)
+        test_map[key] = {"title" : "Page %d" % i, "timestamp" : float(i),
+            "url" : key}
+
+def main(writes, threads):
+    configurations = [
+        ("map", lambda path: Map(path,
+            durability=persisted.DURABILITY_FSYNC)),
+        ("sharded map, %d shards" % threads, lambda path: ShardedMap(path,
+            shards=threads, durability=persisted.DURABILITY_FSYNC)),
+    ]
+    with ScratchDirectory() as scratch:
+        for label, open_map in configurations:
+            path = scratch.file(label)
+            test_map = open_map(path)
+            writers = [threading.Thread(target=write,
+                args=(test_map, thread, writes)) for thread in range(threads)]
+            with Timer() as timer:
+                for writer in writers:
+                    writer.start()
+                for writer in writers:
+                    writer.join()
+            test_map.close()
+            report("%s: write" % label, writes * threads, timer.seconds)
+            with Timer() as timer:
+                reopened = open_map(path)
+            report("%s: open" % label, writes * threads, timer.seconds)
+            assert len(reopened) == writes * threads
+            reopened.close()
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 4)
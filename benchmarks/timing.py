@@ -0,0 +1,42 @@
+""" Helpers shared by the benchmark scripts in this directory.
+
+The benchmarks are plain scripts. Run them from the root of the repository
+with the repository on the path, e.g.:
+
+    PYTHONPATH=. python benchmarks/durability.py
+
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+class Timer(object):
+    """ A context manager recording the wall-clock time spent inside it. """
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.time() - self.start
+
+class ScratchDirectory(object):
+    """ A context manager providing a temporary directory for backing files. """
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp()
+        return self
+
+    def __exit__(self, *exc_info):
+        shutil.rmtree(self.path)
+
+    def file(self, name):
+        """ Returns the path to a file called 'name' in this directory. """
+        return os.path.join(self.path, name)
+
+def report(label, operations, seconds):
+    """ Prints the throughput of a benchmark run. """
+    print "%-40s %10d ops %8.3f s %12.0f ops/s" % (
+        label, operations, seconds, operations / max(seconds, 1e-9))
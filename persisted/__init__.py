@@ -1,2 +1,11 @@
+from codec import CODEC_JSON, CODEC_BINARY, Codec, JSONCodec, BinaryCodec
+from compaction import CompactionPolicy, GarbageRatioPolicy, ThresholdPolicy
+from disk_map import DiskMap
+from follower import Follower
 from list import List
+from log import DURABILITY_NONE, DURABILITY_FLUSH, DURABILITY_FSYNC, \
+    DURABILITY_FSYNC_INTERVAL, LOCKING_NONE, LOCKING_EXCLUSIVE, \
+    LOCKING_COORDINATED
 from map import Map
+from sharded_map import ShardedMap
+from sorted_map import SortedMap
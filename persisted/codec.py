@@ -0,0 +1,514 @@
+""" Codecs which encode the records in a persisted.Log. """
+
+import json
+import marshal
+import struct
+import zlib
+
+# Names of the operations the log saves for its own use.
+GENERATION = "__generation__"
+""" The header record at the start of snapshots and tails. """
+BATCH = "__batch__"
+""" A record holding a batch of operations. """
+
+CODEC_JSON = "json"
+""" Newline-delimited JSON records. Human-readable and the default. """
+CODEC_BINARY = "binary"
+""" Length-prefixed binary records. Smaller and faster than JSON. """
+
+_key = "key"
+_parameters = "parameters"
+
+class TruncatedRecordError(ValueError):
+    """ Raised when a file ends part way through a record.
+
+    This is what a crash in the middle of a write leaves behind. The offset
+    attribute holds the position in the file at which the record starts.
+
+    """
+
+    def __init__(self, offset):
+        ValueError.__init__(self, "Malformed input file", "Truncated record")
+        self.offset = offset
+
+    def __reduce__(self):
+        # Lets the error be pickled, e.g. to pass it back from a worker process.
+        return TruncatedRecordError, (self.offset,)
+
+def make_codec(codec, op_names=()):
+    """ Returns the codec to use for a log.
+
+    Args:
+        codec (string or Codec)
+            One of the CODEC_* constants in this module, or a Codec instance,
+            which is returned as is.
+        op_names (string list)
+            The names of the operations the log will save.
+    Returns:
+        codec (Codec)
+            The codec.
+    Raises:
+        ValueError
+            If the codec name is not recognized.
+
+    """
+    if isinstance(codec, Codec):
+        return codec
+    if codec == CODEC_JSON:
+        return JSONCodec()
+    if codec == CODEC_BINARY:
+        return BinaryCodec(op_names)
+    raise ValueError("Unknown codec", codec)
+
+def recognize_codec(data):
+    """ Works out which of the built-in codecs wrote a buffer.
+
+    Logs name their codec in the header at the start of each file, so this is
+    only needed for files whose header could not be read.
+
+    Args:
+        data (mmap or string)
+            The buffer, starting with a record.
+    Returns:
+        name (string)
+            The CODEC_* constant of the first built-in codec which recognizes
+            the buffer's first record, or None if none does.
+
+    """
+    for name in (CODEC_JSON, CODEC_BINARY):
+        if make_codec(name).recognizes(data):
+            return name
+    return None
+
+class Codec(object):
+    """ Encodes operations as records, and reads them back from a file.
+
+    Codecs must be able to encode any operation name, including the GENERATION
+    and BATCH names used by the log itself.
+
+    """
+
+    name = None
+    """ The name the log records in its headers, so that it can tell when a
+    file was written with another codec. """
+
+    def encode(self, op_name, parameters):
+        """ Encodes an operation as a record.
+
+        Args:
+            op_name (string)
+                The name of the operation.
+            parameters (object list)
+                The parameters to the operation.
+        Returns:
+            record (string)
+                The encoded record, including any framing.
+        Raises:
+            Exception
+                If the parameters cannot be encoded. The exception type is up to
+                the codec.
+
+        """
+        raise NotImplementedError
+
+    def encode_batch(self, records):
+        """ Combines encoded records into a single BATCH record.
+
+        Args:
+            records (string list)
+                Records returned by the encode method.
+        Returns:
+            record (string)
+                The encoded batch record.
+
+        """
+        raise NotImplementedError
+
+    def read(self, log_file):
+        """ Reads records from a file.
+
+        Args:
+            log_file (file)
+                The file to read from, positioned at the start of a record.
+        Returns:
+            operations (iterator of (string, object list))
+                The decoded operations, as (name, parameters) tuples. For BATCH
+                records, the parameters are the list of operations in the batch
+                as (name, parameters) tuples.
+        Raises:
+            TruncatedRecordError
+                If the file ends part way through the last record.
+            ValueError
+                If a record cannot be decoded.
+
+        """
+        raise NotImplementedError
+
+    def read_buffer(self, data, offset=0):
+        """ Reads records from a buffer, such as a memory-mapped file.
+
+        Records are found and decoded one at a time, straight from the buffer,
+        so the buffer's contents are never copied as a whole.
+
+        Args:
+            data (mmap or string)
+                The buffer to read from.
+            offset (int)
+                The position in the buffer at which to start reading. Must be
+                the start of a record.
+        Returns:
+            operations (iterator of (string, object list))
+                The decoded operations, as for the read method.
+        Raises:
+            TruncatedRecordError
+                If the buffer ends part way through the last record. Its offset
+                is the record's position in the buffer.
+            ValueError
+                If a record cannot be decoded.
+
+        """
+        raise NotImplementedError
+
+    def scan_buffer(self, data, offset=0):
+        """ Reads records from a buffer along with their positions.
+
+        Args:
+            data (mmap or string)
+                The buffer to read from.
+            offset (int)
+                The position in the buffer at which to start reading. Must be
+                the start of a record.
+        Returns:
+            records (iterator of (int, string, object list))
+                The offset of each record in the buffer, followed by the
+                operation decoded from it as for the read method.
+        Raises:
+            TruncatedRecordError
+                If the buffer ends part way through the last record.
+            ValueError
+                If a record cannot be decoded.
+
+        """
+        raise NotImplementedError
+
+    def recognizes(self, data):
+        """ Checks whether a buffer starts with a record written by this codec.
+
+        The default implementation tries to decode the first record.
+
+        Args:
+            data (mmap or string)
+                The buffer to check.
+        Returns:
+            recognized (bool)
+                True iff the buffer starts with a complete, valid record.
+
+        """
+        try:
+            for _ in self.read_buffer(data):
+                return True
+        except ValueError:
+            pass
+        return False
+
+    def is_torn(self, data, offset):
+        """ Checks whether the end of a buffer could be a record torn by a
+        crash, i.e. the start of a record this codec would write.
+
+        The default implementation cannot tell, so it assumes the record is
+        torn.
+
+        Args:
+            data (mmap or string)
+                The buffer, which ends part way through a record.
+            offset (int)
+                The position in the buffer at which the record starts, as given
+                by a TruncatedRecordError.
+        Returns:
+            torn (bool)
+                False if the bytes from offset to the end cannot be the start of
+                a record.
+
+        """
+        return True
+
+    def split(self, data, chunk_size):
+        """ Splits a buffer into chunks which can be decoded independently.
+
+        The default implementation does not split the buffer at all. Codecs
+        which can find record boundaries without decoding records override it.
+
+        Args:
+            data (mmap or string)
+                The buffer to split.
+            chunk_size (int)
+                The size, in bytes, each chunk should roughly have.
+        Returns:
+            chunks ((int, int) list)
+                The (start, end) offsets of the chunks, in order. Chunks start
+                at a record boundary and together cover the whole buffer.
+
+        """
+        return [(0, len(data))]
+
+class JSONCodec(Codec):
+    """ Encodes each operation as a JSON object on its own line.
+
+    Records carry no checksum, so a corrupted record is only detected if it no
+    longer decodes as an operation.
+
+    """
+
+    name = CODEC_JSON
+
+    def encode(self, op_name, parameters):
+        """ Encodes an operation as a line of JSON. Raises TypeError if the
+        parameters are not encodable by the json.dumps method. """
+        return json.dumps({_key : op_name, _parameters : parameters}) + '\n'
+
+    def encode_batch(self, records):
+        """ Wraps encoded records in a batch record without encoding them
+        again. """
+        return '{"%s": "%s", "%s": [%s]}\n' % (_key, BATCH, _parameters,
+            ','.join(record[:-1] for record in records))
+
+    def read(self, log_file):
+        """ Reads records from a file line by line. Records are written along
+        with their newline, so a final line without one is truncated. """
+        offset = log_file.tell()
+        for line in log_file:
+            if not line.endswith('\n'):
+                raise TruncatedRecordError(offset)
+            offset += len(line)
+            yield self._decode(line)
+
+    def read_buffer(self, data, offset=0):
+        """ Reads records from a buffer line by line. Each line is copied out
+        of the buffer as it is decoded, as the json module needs a string. """
+        end = len(data)
+        while offset < end:
+            newline = data.find('\n', offset)
+            if newline == -1:
+                raise TruncatedRecordError(offset)
+            yield self._decode(data[offset:newline])
+            offset = newline + 1
+
+    def scan_buffer(self, data, offset=0):
+        """ Reads records from a buffer line by line, along with the offset of
+        each line. """
+        end = len(data)
+        while offset < end:
+            newline = data.find('\n', offset)
+            if newline == -1:
+                raise TruncatedRecordError(offset)
+            op_name, parameters = self._decode(data[offset:newline])
+            yield offset, op_name, parameters
+            offset = newline + 1
+
+    def is_torn(self, data, offset):
+        """ Checks that the unterminated last line starts a JSON object. """
+        return data[offset:offset + 1] == '{'
+
+    def split(self, data, chunk_size):
+        """ Splits a buffer after the first newline following every chunk_size
+        bytes. """
+        chunks = []
+        start, end = 0, len(data)
+        while start < end:
+            newline = data.find('\n', start + max(chunk_size, 1) - 1)
+            stop = end if newline == -1 else newline + 1
+            chunks.append((start, stop))
+            start = stop
+        return chunks
+
+    def _decode(self, line):
+        try:
+            op_dict = json.loads(line)
+            op_name, parameters = op_dict[_key], op_dict[_parameters]
+            if op_name == BATCH:
+                parameters = [(op[_key], op[_parameters]) for op in parameters]
+        except Exception as e:
+            raise ValueError("Malformed input file", e)
+        return op_name, parameters
+
+# Binary records are a big-endian length and CRC32 followed by a body of that
+# length. The body is a one-byte opcode followed by the marshalled parameters.
+# Operations whose names have no opcode of their own are saved with the _named
+# opcode and their name marshalled alongside their parameters. The body of a
+# batch record is the concatenation of the records in the batch.
+_frame = struct.Struct('>II')
+_batch_opcode = 0
+_generation_opcode = 1
+_named_opcode = 2
+_first_free_opcode = 3
+_marshal_version = 2
+
+class BinaryCodec(Codec):
+    """ Encodes operations as compact, length-prefixed binary records.
+
+    Parameters are packed with the marshal module, so they must be built from
+    None, booleans, numbers, strings, tuples, lists, dicts and sets. Unlike
+    JSON, tuples and non-string dictionary keys survive the round trip. Each
+    record carries a checksum of its body, so corrupted records are detected.
+
+    """
+
+    name = CODEC_BINARY
+
+    def __init__(self, op_names=()):
+        """ Initializes the codec.
+
+        Args:
+            op_names (string list)
+                The names of the operations which are given one-byte opcodes.
+                The opcode is determined by the position in this list, so new
+                names must only ever be appended to it. Other operation names
+                can still be encoded, but take up more space.
+        Raises:
+            ValueError
+                If there are more names than fit in a byte.
+
+        """
+        if len(op_names) + _first_free_opcode > 256:
+            raise ValueError("Too many operation names", len(op_names))
+        self._op_names = [BATCH, GENERATION, None] + list(op_names)
+        self._opcodes = dict((op_name, opcode)
+            for opcode, op_name in enumerate(self._op_names)
+            if op_name is not None)
+
+    def encode(self, op_name, parameters):
+        """ Encodes an operation as a binary record. Raises ValueError if the
+        parameters cannot be marshalled. """
+        opcode = self._opcodes.get(op_name)
+        if opcode is None:
+            body = chr(_named_opcode) + \
+                marshal.dumps((op_name, parameters), _marshal_version)
+        else:
+            body = chr(opcode) + marshal.dumps(parameters, _marshal_version)
+        return _frame_record(body)
+
+    def encode_batch(self, records):
+        """ Wraps encoded records in a batch record without encoding them
+        again. """
+        return _frame_record(chr(_batch_opcode) + ''.join(records))
+
+    def read(self, log_file):
+        """ Reads length-prefixed records from a file, verifying their
+        checksums. A record whose checksum does not match is only considered
+        truncated if it is the last in the file. """
+        offset = log_file.tell()
+        while True:
+            frame = log_file.read(_frame.size)
+            if not frame:
+                return
+            if len(frame) < _frame.size:
+                raise TruncatedRecordError(offset)
+            length, checksum = _frame.unpack(frame)
+            body = log_file.read(length)
+            if len(body) < length:
+                raise TruncatedRecordError(offset)
+            if _checksum(body) != checksum:
+                if not log_file.read(1):
+                    raise TruncatedRecordError(offset)
+                raise ValueError("Malformed input file", "Checksum mismatch")
+            offset += _frame.size + length
+            yield self._decode(body)
+
+    def read_buffer(self, data, offset=0):
+        """ Reads length-prefixed records from a buffer, verifying their
+        checksums. Bodies are checksummed and unmarshalled from buffer slices
+        which share the underlying memory. """
+        for _, body in self._bodies(data, offset):
+            yield self._decode(body)
+
+    def scan_buffer(self, data, offset=0):
+        """ Reads length-prefixed records from a buffer as read_buffer does,
+        along with the offset of each record. """
+        for record_offset, body in self._bodies(data, offset):
+            op_name, parameters = self._decode(body)
+            yield record_offset, op_name, parameters
+
+    def recognizes(self, data):
+        """ Checks that the first record's length and checksum are valid,
+        without decoding its body, which may use opcodes the codec was not
+        given names for. """
+        try:
+            for _ in self._bodies(data, 0):
+                return True
+        except ValueError:
+            pass
+        return False
+
+    def is_torn(self, data, offset):
+        """ Checks that the record's length is more than what is left of the
+        buffer, and that its opcode, if any of the body is left, is known. """
+        remaining = len(data) - offset
+        if remaining < _frame.size:
+            return True
+        length, _ = _frame.unpack_from(data, offset)
+        if length == 0 or remaining > _frame.size + length:
+            return False
+        return remaining == _frame.size or \
+            ord(data[offset + _frame.size]) < len(self._op_names)
+
+    def _bodies(self, data, offset):
+        # Yields the offset and a checksummed slice of the body of each record.
+        end = len(data)
+        while offset < end:
+            if end - offset < _frame.size:
+                raise TruncatedRecordError(offset)
+            length, checksum = _frame.unpack_from(data, offset)
+            start = offset + _frame.size
+            if end - start < length:
+                raise TruncatedRecordError(offset)
+            body = buffer(data, start, length)
+            if _checksum(body) != checksum:
+                if start + length == end:
+                    raise TruncatedRecordError(offset)
+                raise ValueError("Malformed input file", "Checksum mismatch")
+            yield offset, body
+            offset = start + length
+
+    def split(self, data, chunk_size):
+        """ Splits a buffer by walking the record lengths, without reading the
+        bodies. A truncated final record ends up in the last chunk. """
+        chunks = []
+        start = offset = 0
+        end = len(data)
+        while end - offset >= _frame.size:
+            length, _ = _frame.unpack_from(data, offset)
+            offset = min(offset + _frame.size + length, end)
+            if offset - start >= chunk_size:
+                chunks.append((start, offset))
+                start = offset
+        if start < end:
+            chunks.append((start, end))
+        return chunks
+
+    def _decode(self, body):
+        try:
+            opcode = ord(body[0])
+            if opcode == _batch_opcode:
+                return BATCH, list(self._split_batch(body))
+            parameters = marshal.loads(buffer(body, 1))
+            if opcode == _named_opcode:
+                op_name, parameters = parameters
+                return op_name, parameters
+            return self._op_names[opcode], parameters
+        except Exception as e:
+            raise ValueError("Malformed input file", e)
+
+    def _split_batch(self, body):
+        # The batch's own checksum covers the records within it.
+        offset = 1
+        while offset < len(body):
+            length, _ = _frame.unpack_from(body, offset)
+            offset += _frame.size
+            yield self._decode(buffer(body, offset, length))
+            offset += length
+
+def _checksum(body):
+    return zlib.crc32(body) & 0xffffffff
+
+def _frame_record(body):
+    return _frame.pack(len(body), _checksum(body)) + body
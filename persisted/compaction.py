@@ -0,0 +1,101 @@
+""" Policies deciding when a persisted.Log should be compacted. """
+
+# Initialize the compaction threshold to 1 MB for new logs.
+_initial_compaction_threshold = 1024 * 1024
+
+class CompactionPolicy(object):
+    """ Decides when a log should be compacted.
+
+    Subclasses must implement should_compact. A policy instance is used by a
+    single log, so it may keep state between calls.
+
+    """
+
+    def should_compact(self, stats):
+        """ Returns true iff the log should be compacted now.
+
+        Args:
+            stats (LogStats)
+                The log's current record counts and sizes.
+        Returns:
+            compact (bool)
+                True iff the log should be compacted.
+
+        """
+        raise NotImplementedError
+
+    def compacted(self, stats):
+        """ Called after the log has been compacted.
+
+        Args:
+            stats (LogStats)
+                The log's record counts and sizes after compaction.
+
+        """
+        pass
+
+class ThresholdPolicy(CompactionPolicy):
+    """ Compacts whenever the log grows past a size threshold.
+
+    If the log is still over the threshold after compaction, the threshold is
+    doubled to avoid thrashing.
+
+    """
+
+    def __init__(self, threshold=_initial_compaction_threshold):
+        """ Initializes the policy.
+
+        Args:
+            threshold (int)
+                The initial threshold, in bytes. Defaults to 1 MB.
+
+        """
+        self.threshold = threshold
+
+    def should_compact(self, stats):
+        """ Returns true iff the log is at least as large as the threshold. """
+        return stats.size >= self.threshold
+
+    def compacted(self, stats):
+        """ Raises the threshold if the compacted log is still over it. """
+        if stats.size > self.threshold:
+            self.threshold = stats.size * 2
+
+class GarbageRatioPolicy(CompactionPolicy):
+    """ Compacts once the log holds enough dead records.
+
+    Small logs are never compacted, so that churn on a few keys does not cause
+    constant rewrites. Large logs are compacted once their dead bytes reach the
+    configured ratio of their live bytes, and always once they pass the maximum
+    size if they hold any dead records at all.
+
+    """
+
+    def __init__(self, max_dead_ratio=1.0,
+            min_size=_initial_compaction_threshold, max_size=None):
+        """ Initializes the policy.
+
+        Args:
+            max_dead_ratio (float)
+                The ratio of dead bytes to live bytes at which the log is
+                compacted. Defaults to 1, i.e. when half the log is dead.
+                Lower values use less disk at the cost of more rewriting.
+            min_size (int)
+                Logs smaller than this many bytes are never compacted. Defaults
+                to 1 MB.
+            max_size (int)
+                If provided, logs larger than this many bytes are compacted
+                regardless of the ratio.
+
+        """
+        self.max_dead_ratio = max_dead_ratio
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def should_compact(self, stats):
+        """ Returns true iff the log is large enough and has enough garbage. """
+        if stats.size < self.min_size or not stats.dead_records:
+            return False
+        if self.max_size is not None and stats.size >= self.max_size:
+            return True
+        return stats.dead_bytes >= self.max_dead_ratio * stats.live_bytes
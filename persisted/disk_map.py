@@ -0,0 +1,323 @@
+import collections
+import contextlib
+
+from codec import BATCH
+from log import LOCKING_COORDINATED, Log
+from map import _delete, _load, _op_names, _set
+
+# The number of values kept in memory by default.
+_default_cache_size = 1024
+
+class DiskMap(object):
+    """ A persisted map which keeps its values on disk.
+
+    Only a directory from each key to the location of the record which last set
+    it is kept in memory. Values are read back from the backing file when they
+    are needed, which costs a seek and a read, and the most recently used ones
+    are kept in an LRU cache. This lets the map hold more data than fits in
+    memory. The backing file has the same format as a Map's, so either class
+    can open a file written by the other.
+
+    Compaction moves every record, so the directory is rebuilt from the backing
+    file after each compaction. Segmented logs, background compaction,
+    read-only logs and coordinated locking are not supported.
+
+    """
+
+    def __init__(self, path_to_backing_file, cache_size=_default_cache_size,
+            **log_options):
+        """ Initializes the map using the provided file.
+
+        Args:
+            path_to_backing_file (string):
+                The file at this path will be used to record the state of the
+                map. If no file currently exists at this location, one will be
+                created. Otherwise, the file will be used to initialize the
+                state of this map.
+            cache_size (int)
+                The number of values to keep in memory. Defaults to 1024.
+            **log_options (object)
+                Keyword arguments passed through to the backing Log, e.g.
+                durability or group_commit_size.
+        Raises:
+            ValueError
+                If the log options ask for a segmented log, background
+                compaction, a read-only log or coordinated locking.
+
+        """
+        if log_options.get("segment_size") is not None or \
+                log_options.get("background_compaction") or \
+                log_options.get("read_only") or \
+                log_options.get("locking") == LOCKING_COORDINATED:
+            raise ValueError("DiskMap does not support segmented logs, "
+                "background compaction, read-only logs or coordinated locking")
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        # Values whose records cannot be read back yet, because they are being
+        # saved or are part of an open batch. Their keys are mapped to None in
+        # the directory.
+        self._unwritten = {}
+        # The locations of the records saved in the open batch, if any. They
+        # only become valid once the batch has been written.
+        self._batch_locations = None
+        self._log = Log(path_to_backing_file, self._get_compaction_callback(),
+            op_names=_op_names, **log_options)
+        # Unlike Map, we do not compact on open: that would read back every
+        # value in the map.
+        self._load_directory()
+        self._log.reset_stats(len(self._directory))
+
+    def close(self):
+        """ Writes out any buffered operations and closes the backing file. """
+        self._log.close()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Returns a context manager which saves the changes made within it as
+        a single unit. See Map.batch.
+
+        Usage:
+            with disk_map.batch():
+                ...
+
+        """
+        outermost = self._batch_locations is None
+        if outermost:
+            self._batch_locations = {}
+            generation = self._log.generation
+        try:
+            with self._log.batch():
+                yield
+        finally:
+            if outermost:
+                locations, self._batch_locations = self._batch_locations, None
+                if self._log.generation != generation:
+                    # The batch was compacted away before it was written.
+                    self._load_directory()
+                else:
+                    self._directory.update(locations)
+                    for key in locations:
+                        del self._unwritten[key]
+                    self._check_generation()
+
+    def __len__(self):
+        """ Returns the number of key-value pairs in the map. """
+        return len(self._directory)
+
+    def __setitem__(self, key, value):
+        """ Puts the key / value pair into the map.
+
+        Args:
+            key (object)
+                The key by which the value will be retrievable. Must be
+                encodable by the log's codec (json.dumps by default).
+            value (object)
+                The value stored by the key. Must be encodable by the log's
+                codec (json.dumps by default).
+        Raises:
+            ValueError
+                If either the key or value are not JSON encodable.
+
+        """
+        record = self._log.encode_operation(_set, key, value)
+        obsoletes = 1 if key in self._directory else 0
+        # Saving the record may compact the log, which reads the new value
+        # back through the directory.
+        self._directory[key] = None
+        self._unwritten[key] = value
+        self._cache_value(key, value)
+        location = self._log.save_record(record, obsoletes, key=key)
+        if self._batch_locations is not None:
+            self._batch_locations[key] = location
+            return
+        self._directory[key] = location
+        del self._unwritten[key]
+        self._check_generation()
+
+    def __getitem__(self, key):
+        """ Used to query the value mapped to the input key.
+
+        Values may be shared with the cache, so they should not be modified.
+
+        Args:
+            key (object)
+                The key whose value should be retrieved.
+        Returns:
+            value (object)
+                The value mapped to by the input key.
+        Raises:
+            KeyError
+                If the key was not found in the map.
+
+        """
+        location = self._directory[key]
+        try:
+            value = self._cache.pop(key)
+        except KeyError:
+            value = self._read_value(key, location)
+        self._cache_value(key, value)
+        return value
+
+    def __delitem__(self, key):
+        """ Used to delete the mapping for the input key.
+
+        Args:
+            key (object)
+                The key for the mapping to be deleted.
+        Returns:
+            value (object)
+                The value which was removed from the map.
+        Raises:
+            KeyError
+                If the key was not found in the map.
+            ValueError
+                If the key is not JSON encodable.
+
+        """
+        record = self._log.encode_operation(_delete, key)
+        val = self[key]
+        del self._directory[key]
+        self._cache.pop(key, None)
+        self._unwritten.pop(key, None)
+        if self._batch_locations is not None:
+            self._batch_locations.pop(key, None)
+        self._log.save_record(record, obsoletes=1, live=False, key=key)
+        self._check_generation()
+        return val
+
+    def __contains__(self, key):
+        """ Returns true iff the key is present in the map. """
+        return key in self._directory
+
+    def __eq__(self, other):
+        """ Equality check. Returns NotImplemented for subclasses.
+
+        Args:
+            other (DiskMap)
+                Another map to run an equality check against.
+
+        Returns:
+            maps_equal (bool)
+                True iff the input map is equal to this one. Returns
+                NotImplemented if the input map is a subclass of DiskMap.
+
+        """
+        if not type(other) == type(self):
+            if isinstance(other, DiskMap):
+                return NotImplemented
+            return False
+        return len(self) == len(other) and \
+            dict(self.iteritems()) == dict(other.iteritems())
+
+    def __ne__(self, other):
+        """ Inequality check. Returns NotImplemented for subclasses.
+
+        Args:
+            other (DiskMap)
+                Another map to run an inequality check against.
+
+        Returns:
+            map_equal (bool)
+                True iff the input map is not equal to this one. Returns
+                NotImplemented if the input map is a subclass of DiskMap.
+
+        """
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __iter__(self):
+        """ Returns an iterator over the keys in the map. """
+        return self._directory.__iter__()
+
+    def iteritems(self):
+        """ Returns an iterator over the (key, value) pairs in the map.
+
+        Values are read in the order they are stored in, so that the backing
+        file is read sequentially, and without disturbing the cache. The map
+        must not be changed during iteration.
+
+        Raises:
+            RuntimeError
+                If the map was compacted during iteration.
+
+        """
+        generation = self._log.generation
+        for key, location in self._by_location():
+            if self._log.generation != generation:
+                raise RuntimeError("DiskMap changed during iteration")
+            yield key, self._peek(key, location)
+
+    def iterkeys(self):
+        """ Returns an iterator over the keys in the map. """
+        return self._directory.iterkeys()
+
+    def itervalues(self):
+        """ Returns an iterator over the values in the map. See iteritems. """
+        for _, value in self.iteritems():
+            yield value
+
+    def _get_compaction_callback(self):
+        # Snapshots hold one record per pair, so that each value can be read
+        # back on its own.
+        def callback():
+            for key, location in self._by_location():
+                yield (_set, [key, self._peek(key, location)])
+        return callback
+
+    def _by_location(self):
+        # Unwritten values, whose location is None, come first.
+        return sorted(self._directory.iteritems(), key=lambda item: item[1])
+
+    def _load_directory(self):
+        directory = {}
+        for op_name, parameters, location in self._log.scan():
+            if op_name == _set:
+                directory[parameters[0]] = location
+            elif op_name == _delete:
+                directory.pop(parameters[0], None)
+            elif op_name == _load:
+                # Snapshots written by a Map hold chunks of pairs. The index in
+                # the location is the position of the pair in the chunk.
+                path, offset, _ = location
+                for index, (key, _) in enumerate(parameters[0]):
+                    directory[key] = (path, offset, index)
+        self._directory = directory
+        self._unwritten = {}
+        self._last_read = (None, None)
+        self._generation = self._log.generation
+
+    def _check_generation(self):
+        # Compaction moves every record, so we have to find them again.
+        if self._log.generation != self._generation:
+            self._load_directory()
+
+    def _peek(self, key, location):
+        # Returns a value without making it the most recently used.
+        if key in self._cache:
+            return self._cache[key]
+        return self._read_value(key, location)
+
+    def _read_value(self, key, location):
+        if location is None:
+            return self._unwritten[key]
+        path, offset, index = location
+        # The last record read is kept, as records written by a Map's snapshot
+        # or in a batch hold many values, which are often read in a row.
+        if self._last_read[0] != (path, offset):
+            self._last_read = ((path, offset),
+                self._log.read_at(path, offset))
+        op_name, parameters = self._last_read[1]
+        if op_name == BATCH:
+            op_name, parameters = parameters[index]
+        if op_name == _load:
+            return parameters[0][index][1]
+        return parameters[1]
+
+    def _cache_value(self, key, value):
+        # The most recently used values are at the end of the cache.
+        self._cache.pop(key, None)
+        self._cache[key] = value
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
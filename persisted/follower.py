@@ -0,0 +1,99 @@
+""" Keeps read-only structures up to date as another process writes to them. """
+
+import threading
+import weakref
+
+# The number of seconds between checks of the backing file, by default.
+_default_interval = 0.1
+
+class Follower(object):
+    """ Follows the changes a writer process saves to a structure's file.
+
+    The structure, e.g. a Map, List or Stack opened with read_only=True, is
+    refreshed on a background thread whenever its backing file changes. The
+    structure's log remembers how far it has read the file, so only records
+    appended since are read and applied. If the writer has compacted the log,
+    sealed its tail or replaced the file, the structure is reloaded instead,
+    and the old contents stay readable until the reload is complete.
+
+    Checking for changes costs a couple of stat calls, so the file is polled
+    rather than watched with a platform-specific notification API.
+
+    Refreshing changes the structure, so iterate over a snapshot of it while it
+    is being followed.
+
+    """
+
+    def __init__(self, structure, interval=_default_interval):
+        """ Starts following the structure.
+
+        Args:
+            structure (object)
+                The structure to keep up to date. Anything with a refresh
+                method, such as a read-only Map.
+            interval (float)
+                The number of seconds between checks of the backing file.
+                Defaults to 0.1.
+
+        """
+        self._structure = structure
+        self._error = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=_follow,
+            args=(weakref.ref(self), self._stopped, interval))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def following(self):
+        """ False once the follower has been stopped, or has stopped itself
+        because a refresh failed. """
+        return self._thread.is_alive()
+
+    def poll(self):
+        """ Refreshes the structure now, rather than at the next check.
+
+        Raises:
+            Exception
+                Any error raised by a refresh on the background thread, which
+                stops following, or by this refresh.
+
+        """
+        self._raise_error()
+        self._structure.refresh()
+
+    def stop(self):
+        """ Stops following. The structure keeps the contents it was last
+        refreshed with.
+
+        Raises:
+            Exception
+                Any error raised by a refresh on the background thread, which
+                stops following.
+
+        """
+        self._stopped.set()
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+def _follow(follower_ref, stopped, interval):
+    # Runs on the follower's thread. We only hold a weak reference to the
+    # follower so that one which is dropped without being stopped can still be
+    # garbage collected, at which point this thread exits.
+    while not stopped.wait(interval):
+        follower = follower_ref()
+        if follower is None:
+            return
+        try:
+            follower._structure.refresh()
+        except Exception as e:
+            # The structure may be part way through a change, so we stop
+            # rather than carry on from an unknown state.
+            follower._error = e
+            return
+        del follower
@@ -1,4 +1,8 @@
-from log import Log, test_json_encoding
+import contextlib
+import threading
+
+from log import Log
+from snapshot import ListSnapshot, Snapshots
 
 # Keys for the operations map.
 _append = "append"
@@ -7,6 +11,12 @@ _delete = "delete"
 _remove = "remove"
 _push = "push"
 _pop = "pop"
+_extend = "extend"
+# The number of elements in each record of a snapshot.
+_snapshot_chunk_size = 1000
+# The operations saved by this structure, in the order the log's codec numbers
+# them. New operations must be added at the end.
+_op_names = [_append, _set, _delete, _remove, _push, _pop, _extend]
 
 class List(object):
     """ A persisted list.
@@ -16,7 +26,7 @@ class List(object):
 
     """
 
-    def __init__(self, path_to_backing_file):
+    def __init__(self, path_to_backing_file, **log_options):
         """ Initializes the list using the provided file.
 
         Args:
@@ -25,17 +35,52 @@ class List(object):
                 list. If no file currently exists at this location, one will be
                 created. Otherwise, the file will be used to initialize the
                 state of this list.
+            **log_options (object)
+                Keyword arguments passed through to the backing Log, e.g.
+                durability or group_commit_size. With coordinated locking,
+                several processes can change the list. See Map.__init__.
 
         """
-        self._log = Log(path_to_backing_file, self._get_compaction_callback())
+        self._log = Log(
+            path_to_backing_file, self._get_compaction_callback(),
+            op_names=_op_names, **log_options)
         self._inner_list = []
-        # We make sure persistence is turned off during the replay so that we
-        # don't duplicate everything in the log file.
-        self.persist = False
-        self._log.replay(self._get_op_map())
-        self.persist = True
-        # Compact during initialization as we'd rather take the time now.
-        self._log.compact()
+        self._snapshots = Snapshots()
+        # Held while a snapshot is taken and while the inner list is changed.
+        # See Map.__init__.
+        self._snapshot_lock = threading.Lock()
+        # Refreshes may run on a Follower's thread.
+        self._refresh_lock = threading.Lock()
+        with self._log.lock():
+            # Replaying applies operations directly to the inner structure
+            # rather than through the public methods, so nothing is
+            # re-validated or written back to the log.
+            self._log.replay(self._get_op_map())
+            # Fold the tail into a new snapshot during initialization as we'd
+            # rather take the time now.
+            self._log.compact()
+            self._log.reset_stats(len(self._inner_list))
+
+    def close(self):
+        """ Writes out any buffered operations and closes the backing file. """
+        self._log.close()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Returns a context manager which saves the changes made within it as
+        a single unit.
+
+        Changes are applied to the list immediately, but are only written to the
+        backing file when the with-block exits. If the process crashes before
+        then, none of them are persisted.
+
+        Usage:
+            with persisted_list.batch():
+                ...
+
+        """
+        with self._writing(), self._log.batch():
+            yield
 
     def __len__(self):
         """ Returns the number of elements in the list. """
@@ -52,9 +97,11 @@ class List(object):
             TODO: something if not JSON encodable
 
         """
-        test_json_encoding(new_element)
-        self._inner_list.append(new_element)
-        if self.persist: self._log.save_operation(_append, new_element)
+        with self._writing():
+            record = self._log.encode_operation(_append, new_element)
+            with self._changing():
+                self._inner_list.append(new_element)
+            self._log.save_record(record)
 
     def __getitem__(self, index):
         """ Returns the element at the input index in the list.
@@ -82,9 +129,11 @@ class List(object):
                 If the index is not in the range [0, len(list)).
             TODO: something if not JSON encodable
         """
-        test_json_encoding(element)
-        self._inner_list[index] = element
-        if self.persist: self._log.save_operation(_set, index, element)
+        with self._writing():
+            record = self._log.encode_operation(_set, index, element)
+            with self._changing():
+                self._inner_list[index] = element
+            self._log.save_record(record, obsoletes=1)
 
     def __delitem__(self, index):
         """ Deletes the element at the provided index.
@@ -96,8 +145,11 @@ class List(object):
             IndexError
                 If the index is not valid for the list.
         """
-        del self._inner_list[index]
-        if self.persist: self._log.save_operation(_delete, index)
+        with self._writing():
+            record = self._log.encode_operation(_delete, index)
+            with self._changing():
+                del self._inner_list[index]
+            self._log.save_record(record, obsoletes=1, live=False)
 
     def index(self, value):
         """ Returns the index of the first occurrence of the input value.
@@ -125,8 +177,11 @@ class List(object):
                 If the value was not found in the list.
 
         """
-        self._inner_list.remove(value)
-        if self.persist: self._log.save_operation(_remove, value)
+        with self._writing():
+            record = self._log.encode_operation(_remove, value)
+            with self._changing():
+                self._inner_list.remove(value)
+            self._log.save_record(record, obsoletes=1, live=False)
 
     def push(self, new_element):
         """ Pushes the input element into the first position in the list.
@@ -139,9 +194,11 @@ class List(object):
             something if not JSON encodable
 
         """
-        test_json_encoding(new_element)
-        self._inner_list = [new_element] + self._inner_list
-        if self.persist: self._log.save_operation(_push, new_element)
+        with self._writing():
+            record = self._log.encode_operation(_push, new_element)
+            with self._changing():
+                self._inner_list.insert(0, new_element)
+            self._log.save_record(record)
 
     def pop(self):
         """ Removes and returns the last element in the list.
@@ -154,8 +211,11 @@ class List(object):
                 If the list is currently empty.
 
         """
-        value = self._inner_list.pop()
-        if self.persist: self._log.save_operation(_pop)
+        with self._writing():
+            record = self._log.encode_operation(_pop)
+            with self._changing():
+                value = self._inner_list.pop()
+            self._log.save_record(record, obsoletes=1, live=False)
         return value
 
     def __eq__(self, other):
@@ -208,17 +268,77 @@ class List(object):
         """ Returns true iff the input element is in the list. """
         return element in self._inner_list
 
+    def snapshot(self):
+        """ Returns a read-only view of the list as it is now. See
+        Map.snapshot.
+
+        Returns:
+            snapshot (ListSnapshot)
+                The view of the list.
+
+        """
+        with self._snapshot_lock:
+            view = ListSnapshot(self._inner_list)
+            self._snapshots.add(view)
+        return view
+
+    def refresh(self):
+        """ Picks up the changes saved to the backing file by another process
+        since the list was opened or last refreshed. See Map.refresh. """
+        with self._log.lock(), self._refresh_lock:
+            with self._changing():
+                if self._log.refresh(self._get_op_map()):
+                    return
+            # The new list only replaces the old one once it is complete.
+            inner_list = []
+            self._log.replay(self._get_op_map(inner_list))
+            with self._snapshot_lock:
+                self._inner_list = inner_list
+                self._snapshots = Snapshots()
+
+    def _writing(self):
+        # Returns the context in which to change the list. See Map._writing.
+        if self._log.coordinated:
+            return self._catching_up()
+        return self._log.lock()
+
+    @contextlib.contextmanager
+    def _catching_up(self):
+        with self._log.lock():
+            self.refresh()
+            yield
+
+    @contextlib.contextmanager
+    def _changing(self):
+        # The inner list is changed within this context. See Map._changing.
+        with self._snapshot_lock:
+            if self._snapshots.must_copy():
+                self._inner_list = list(self._inner_list)
+            yield
+
     def _get_compaction_callback(self):
+        # Snapshots hold the list's elements in chunks which are loaded in bulk.
         def callback():
-            return [(_append, [ element ]) for element in self._inner_list]
+            elements = self._inner_list
+            if self._log.compacts_in_background:
+                # Writes carry on during a background compaction, so it reads
+                # from a snapshot of the list.
+                elements = self.snapshot()
+            return ((_extend, [elements[i:i + _snapshot_chunk_size]])
+                for i in xrange(0, len(elements), _snapshot_chunk_size))
         return callback
 
-    def _get_op_map(self):
+    def _get_op_map(self, inner_list=None):
+        # Replayed operations were valid when they were saved, so we apply them
+        # straight to the inner list, or to the given one.
+        if inner_list is None:
+            inner_list = self._inner_list
         return {
-            _append : self.append,
-            _set : self.__setitem__,
-            _delete : self.__delitem__,
-            _remove : self.remove,
-            _push : self.push,
-            _pop : self.pop
+            _append : inner_list.append,
+            _set : inner_list.__setitem__,
+            _delete : inner_list.__delitem__,
+            _remove : inner_list.remove,
+            _push : lambda new_element: inner_list.insert(0, new_element),
+            _pop : inner_list.pop,
+            _extend : inner_list.extend
         }
@@ -1,11 +1,63 @@
+import collections
+import contextlib
+import errno
 import json
+import marshal
+import mmap
+import multiprocessing
 import os
-from tempfile import TemporaryFile
+import shutil
+import threading
+import weakref
+try:
+    import fcntl
+except ImportError:
+    # Locking is only available where fcntl is, i.e. on POSIX systems.
+    fcntl = None
 
-_key = "key"
-_parameters = "parameters"
-# Initialize the compaction threshold to 1 MB for new logs.
-_initial_compaction_threshold = 1024 * 1024
+from codec import BATCH, CODEC_JSON, GENERATION, TruncatedRecordError, \
+    make_codec, recognize_codec
+from compaction import GarbageRatioPolicy
+from segment import Merge, Segment, list_segments, segment_path
+
+_snapshot_suffix = ".snapshot"
+_sealed_suffix = ".sealed"
+_lock_suffix = ".lock"
+_temporary_suffix = ".tmp"
+# The most segments which are merged at once, to bound the pause a merge causes.
+_max_merge_width = 4
+# The most merges run each time a segmented log seals its tail, for the same
+# reason.
+_max_merges_per_seal = 4
+# The size of the chunks logs are split into for parallel replay.
+_replay_chunk_size = 4 * 1024 * 1024
+_marshal_version = 2
+
+# Durability modes. These control what happens after operations are written to
+# the backing file (see the durability argument of Log.__init__).
+DURABILITY_NONE = "none"
+""" Writes are left to Python's and the OS's buffering. """
+DURABILITY_FLUSH = "flush"
+""" Writes are flushed to the OS after every write. """
+DURABILITY_FSYNC = "fsync"
+""" Writes are flushed and fsync'ed after every write. """
+DURABILITY_FSYNC_INTERVAL = "fsync_interval"
+""" Writes are flushed and fsync'ed periodically by a background thread. """
+_durability_modes = (DURABILITY_NONE, DURABILITY_FLUSH, DURABILITY_FSYNC,
+    DURABILITY_FSYNC_INTERVAL)
+
+# Locking modes. These control how writers in other processes are kept out of
+# the backing files (see the locking argument of Log.__init__). Every process
+# writing to a log must use the same mode.
+LOCKING_NONE = "none"
+""" Nothing stops other processes from writing to the log. """
+LOCKING_EXCLUSIVE = "exclusive"
+""" The log is locked for as long as it is open, so only one process at a time
+can open it for writing. """
+LOCKING_COORDINATED = "coordinated"
+""" Several processes can write to the log. Each change is made with the log
+locked, after catching up with the changes made by the others. """
+_locking_modes = (LOCKING_NONE, LOCKING_EXCLUSIVE, LOCKING_COORDINATED)
 
 def test_json_encoding(*objs):
     """ A helper function for users of this library.
@@ -21,42 +73,352 @@ def test_json_encoding(*objs):
     """
     for obj in objs: json.dumps(obj)
 
+class LogStats(object):
+    """ Counts of the live and dead records in a log.
+
+    A record is dead once compacting the log would drop it, e.g. because it set
+    a key which has been set again since. Logs only learn that records are dead
+    from the structures saving them, which report how many earlier records each
+    new one makes obsolete. The sizes of dead records are estimated from the
+    average size of live ones.
+
+    """
+
+    def __init__(self):
+        self.live_records = 0
+        """ The number of live records in the log. """
+        self.dead_records = 0
+        """ The number of dead records in the log. """
+        self.size = 0
+        """ The total size of the log in bytes. """
+        self.dead_bytes = 0
+        """ The (estimated) number of bytes taken up by dead records. """
+
+    @property
+    def live_bytes(self):
+        """ The (estimated) number of bytes taken up by live records. """
+        return self.size - self.dead_bytes
+
 class Log(object):
-    """ A log to back data structures in the 'persisted' library. """
+    """ A log to back data structures in the 'persisted' library.
+
+    The log is stored in two files. The snapshot, which lives beside the backing
+    file, holds the operations returned by the compaction callback when the log
+    was last compacted. The backing file itself is the tail, holding the
+    operations saved since then. Both start with a header recording the
+    generation of the snapshot they belong to. The snapshot's header also
+    records how much of the previous generation's tail it covers. This lets us
+    tell which parts of a tail were already folded into a snapshot, e.g. if we
+    crashed mid-compaction.
+
+    When the log is closed, a third file records the generation and length of
+    the tail. Snapshots are only ever installed once complete, so on open only
+    the part of the tail written since the log was last closed cleanly needs to
+    be checked.
+
+    A log can instead be segmented, in which case it never writes snapshots.
+    Once the tail grows past the segment size it is sealed into a segment file
+    and a new tail is started. Compaction merges runs of sealed segments,
+    dropping records which were overwritten later, so the work it does is
+    bounded by the segment size rather than by the size of the structure.
+    Segments are replayed after the snapshot, if any, and before the tail.
 
-    def __init__(self, filepath, compaction_callback):
+    """
+
+    def __init__(self, filepath, compaction_callback, group_commit_size=1,
+            group_commit_interval=None, durability=DURABILITY_FLUSH,
+            fsync_interval=0.1, fsync_ops=None, validate=True,
+            background_compaction=False, compaction_policy=None,
+            codec=CODEC_JSON, op_names=(), segment_size=None,
+            record_key=None, replay_processes=None,
+            replay_chunk_size=_replay_chunk_size, read_only=False,
+            locking=LOCKING_NONE):
         """ Initializes a log backed by a file at the given filepath.
 
         Args:
             filepath (string)
                 The path to the file which backs this log. If no file exists at
                 that path, one will be created.
-            compaction_callback (function: () -> (string, object list) list)
-                A function which returns a list of operations representing the
-                current state of the data structure backed by this log. The
-                operations should be 2-tuples. The first element should be a
+            compaction_callback (function: () -> (string, object list) iter)
+                A function which returns an iterable of operations representing
+                the current state of the data structure backed by this log. The
+                iterable is consumed as the snapshot is written, so it can be a
+                generator over the structure itself. The operations should be
+                2-tuples. The first element should be a
                 string defining the operation's name and the second should be a
                 list of parameters for the operation (can be empty). These
                 should be the same as would be passed to the save_operation
                 method. This function should be callable multiple times.
+            group_commit_size (int)
+                The number of operations to buffer before writing them to the
+                backing file in a single write. Defaults to 1, meaning every
+                operation is written as soon as it is saved.
+            group_commit_interval (float)
+                If provided, buffered operations are written at most this many
+                seconds after the first of them was saved, even if fewer than
+                group_commit_size operations have been buffered.
+            durability (string)
+                One of the DURABILITY_* constants in this module. Determines
+                whether writes are flushed and / or fsync'ed. With group commit,
+                this happens once per group rather than once per operation.
+                Defaults to DURABILITY_FLUSH.
+            fsync_interval (float)
+                Used with DURABILITY_FSYNC_INTERVAL. The number of seconds
+                between background fsyncs.
+            fsync_ops (int)
+                Used with DURABILITY_FSYNC_INTERVAL. If provided, a background
+                fsync is also triggered once this many operations have been
+                saved since the last one.
+            validate (bool)
+                Whether to check that the records written to the tail since the
+                log was last closed cleanly can be decoded. If the tail ends
+                with a record torn by a crash, that record is discarded. Passing
+                False skips the check, and the repair, altogether.
+            background_compaction (bool)
+                If True, compaction triggered by saving an operation runs on a
+                background thread while further operations are saved. The
+                compaction callback is still called on the saving thread, and
+                what it returns must not change as the structure is updated.
+            compaction_policy (CompactionPolicy)
+                Decides when the log is compacted. Defaults to a
+                GarbageRatioPolicy with its default settings.
+            codec (string or Codec)
+                How records are encoded in the backing file. One of the CODEC_*
+                constants in the codec module, or a Codec instance. Defaults to
+                CODEC_JSON. An existing log must be opened with the codec it
+                was written with, or a ValueError is raised. Only the binary
+                codec checksums records, so a corrupted JSON record goes
+                unnoticed as long as it still decodes as an operation.
+            op_names (string list)
+                The names of the operations which will be saved in the log.
+                Codecs may use this to encode the names compactly, so names
+                must only ever be appended to this list.
+            segment_size (int)
+                If provided, the log is segmented: the tail is sealed into a new
+                segment once it holds this many bytes, and compaction merges
+                sealed segments instead of calling the compaction callback.
+            record_key (function: (string, object list) -> (object, bool))
+                Required for segmented logs. Given an operation's name and
+                parameters, returns None if the record must always be kept, or
+                a (key, live) tuple. A record is overwritten by any later record
+                with the same key, e.g. the key of a map. Records which are not
+                live, such as deletions, are dropped once nothing older than
+                them remains.
+            replay_processes (int)
+                If greater than 1, large files are split into chunks on record
+                boundaries which are decoded by a pool of this many processes
+                during replay. Operations are still replayed in order, on the
+                calling thread. Custom codecs must be picklable.
+            replay_chunk_size (int)
+                The size, in bytes, of the chunks decoded by each process during
+                a parallel replay. Defaults to 4 MB.
+            read_only (bool)
+                If True, the log never creates, repairs, compacts or otherwise
+                writes to its files, so it can be read while another process
+                writes to them. The files are only read when the log is
+                replayed, and records appended since can be read with refresh.
+                Saving operations raises IOError. Parallel replay is not used.
+            locking (string)
+                One of the LOCKING_* constants in this module. Determines how
+                the log is locked against writers in other processes, using an
+                advisory lock on a file beside the backing file. Read-only logs
+                never lock, as they cope with changes made while they read.
+                Coordinated logs cannot be segmented or compacted in the
+                background, and structures must make their changes with the
+                log locked; see the lock method. Defaults to LOCKING_NONE.
+        Raises:
+            ValueError
+                If the durability or locking mode is not recognized, the backing
+                file is malformed or was written with another codec, a segment
+                size is given without a record_key or coordinated locking is
+                combined with segments or background compaction.
+            IOError
+                If the log is locked exclusively by another process.
 
         """
+        if durability not in _durability_modes:
+            raise ValueError("Unknown durability mode", durability)
+        if segment_size is not None and record_key is None:
+            raise ValueError("Segmented logs need a record_key function")
+        if locking not in _locking_modes:
+            raise ValueError("Unknown locking mode", locking)
+        if locking == LOCKING_COORDINATED and (segment_size is not None or
+                background_compaction):
+            raise ValueError("Coordinated logs cannot be segmented or "
+                "compacted in the background")
+        if locking != LOCKING_NONE and fcntl is None:
+            raise ValueError("Locking is not supported on this platform")
+        self._codec = make_codec(codec, op_names)
+        self._durability = durability
         self._backing_file = filepath
-        # We do this to create the file if it does not exist.
-        try:
-            log_file = open(self._backing_file, 'a+')
-            log_file.close()
-        except IOError as e:
-            raise IOError("Error initializing log file", e)
-        # Check that every line is decodable (we want to fail fast otherwise).
-        log_file = open(self._backing_file)
-        for line in log_file.readlines():
-            try:
-                json.loads(line)
-            except Exception as e:
-                raise ValueError("Malformed input file", e)
+        self._read_only = read_only
+        # Buffered operations may be written from the commit timer's thread and
+        # compaction may run on a background thread.
+        self._lock = threading.RLock()
+        self._pending = []
+        self._batch = None
+        # The offset in the tail at which the open batch will be written.
+        self._batch_offset = None
+        # Files opened by read_at, by path.
+        self._readers = {}
+        self._stats = LogStats()
+        self._snapshot_file = filepath + _snapshot_suffix
+        self._sealed_file = filepath + _sealed_suffix
+        self._segment_size = segment_size
+        self._record_key = record_key
+        self._replay_processes = replay_processes or 1
+        self._replay_chunk_size = replay_chunk_size
+        # Maps the key of every indexed record to the segment holding the
+        # latest record with that key, and lists the keys of the records in the
+        # tail if they are all known. Only used by segmented logs.
+        self._keys = {}
+        self._tail_keys = None
         self._compaction_callback = compaction_callback
-        self._compaction_threshold = _initial_compaction_threshold
+        if compaction_policy is None:
+            compaction_policy = GarbageRatioPolicy()
+        self._compaction_policy = compaction_policy
+        # Read-only logs keep the tail they last read open, along with the
+        # offset up to which they read it, so that refresh can carry on from
+        # there.
+        self._tail_reader = None
+        self._tail_offset = 0
+        self._locking = LOCKING_NONE if read_only else locking
+        self._lock_file = None
+        # How many times the current thread holds the lock of a coordinated
+        # log, and whether the structure has applied every change the other
+        # writers made before it was taken.
+        self._lock_depth = 0
+        self._caught_up = True
+        if read_only:
+            self._log_file = None
+            self._generation = 0
+            self._snapshot_size = self._segments_size = 0
+            self._segments = []
+            self._tail_header_size = 0
+            self._size = 0
+        elif self._locking == LOCKING_NONE:
+            self._open(validate)
+        else:
+            # Opening may finish a compaction, so it must be done with the lock
+            # held.
+            self._lock_file = open(filepath + _lock_suffix, 'a')
+            try:
+                if self._locking == LOCKING_EXCLUSIVE:
+                    self._lock_exclusively()
+                else:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    self._open(validate)
+                finally:
+                    if self._locking == LOCKING_COORDINATED:
+                        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+            except:
+                self._lock_file.close()
+                raise
+            if self._locking == LOCKING_COORDINATED:
+                self._tail_reader = open(filepath, 'rb')
+                self._tail_offset = os.fstat(self._tail_reader.fileno()).st_size
+        self._group_commit_size = group_commit_size
+        self._group_commit_interval = group_commit_interval
+        self._commit_timer = None
+        self._background_compaction = background_compaction
+        # Held for the duration of any compaction, including background ones.
+        self._compaction_lock = threading.Lock()
+        self._compaction_error = None
+        self._fsync_ops = fsync_ops
+        self._unsynced_ops = 0
+        self._closing = False
+        self._sync_thread = None
+        if durability == DURABILITY_FSYNC_INTERVAL and not read_only:
+            self._sync_wakeup = threading.Event()
+            self._sync_thread = threading.Thread(target=_sync_periodically,
+                args=(weakref.ref(self), self._sync_wakeup, fsync_interval))
+            self._sync_thread.daemon = True
+            self._sync_thread.start()
+
+    @property
+    def stats(self):
+        """ The log's LogStats. These should not be modified. """
+        return self._stats
+
+    @property
+    def _size(self):
+        # The size of the log. Operations still waiting to be written are
+        # included.
+        return self._stats.size
+
+    @_size.setter
+    def _size(self, size):
+        self._stats.size = size
+
+    @property
+    def _tail_number(self):
+        # The number the tail will take when it is sealed into a segment.
+        if not self._segments:
+            return 0
+        return self._segments[-1].number + 1
+
+    @property
+    def _tail_size(self):
+        # The size of the tail, including operations still waiting to be
+        # written.
+        return self._size - self._snapshot_size - self._segments_size
+
+    @property
+    def generation(self):
+        """ The number of snapshots written so far. Compaction moves records
+        around, so this changes whenever record locations do. """
+        return self._generation
+
+    @property
+    def read_only(self):
+        """ Whether the log was opened read-only. """
+        return self._read_only
+
+    @property
+    def coordinated(self):
+        """ Whether the log uses LOCKING_COORDINATED. """
+        return self._locking == LOCKING_COORDINATED
+
+    @property
+    def segmented(self):
+        """ Whether the log is sealed into segments as it grows. """
+        return self._segment_size is not None
+
+    @property
+    def compacts_in_background(self):
+        """ True iff compaction may run on a background thread. """
+        return self._background_compaction
+
+    def encode_operation(self, op_name, *parameters):
+        """ Encodes an operation as a record which can be saved in the log.
+
+        Encoding doubles as validation, so callers can encode an operation
+        before changing any state and then save the returned record without
+        serializing anything a second time.
+
+        Args:
+            op_name (string)
+                The name of the operation.
+            *parameters (object)
+                The parameters to the operation. These must be encodable by the
+                log's codec.
+        Returns:
+            record (string)
+                The encoded operation, suitable for save_record.
+        Raises:
+            TypeError
+                If any of the parameters is not encodable as JSON (with the JSON
+                codec).
+            ValueError
+                If any of the parameters cannot be marshalled (with the binary
+                codec).
+            IOError
+                If the log is read-only.
+
+        """
+        self._check_writable()
+        return self._codec.encode(op_name, parameters)
 
     def save_operation(self, op_name, *parameters):
         """ Saves an operation in the log.
@@ -68,14 +430,221 @@ class Log(object):
             *parameters (object)
                 The parameters to the operation. There need not be any. The only
                 requirement for these parameters is that they be encodable by
-                the json.dumps method.
+                the log's codec.
 
         """
-        op_as_json = json.dumps({_key : op_name, _parameters : parameters})
-        log_file = open(self._backing_file, 'a')
-        log_file.write(op_as_json + '\n')
-        log_file.close()
-        self._compact_if_necessary()
+        key = None
+        if self.segmented:
+            key = self._record_key(op_name, parameters)
+            key = key[0] if key is not None else None
+        self.save_record(self.encode_operation(op_name, *parameters), key=key)
+
+    def save_record(self, record, obsoletes=0, live=True, key=None):
+        """ Saves a record returned by encode_operation in the log.
+
+        Args:
+            record (string)
+                The encoded operation.
+            obsoletes (int)
+                The number of earlier records which this one makes obsolete,
+                e.g. 1 when a map key which was already set is set again.
+            live (bool)
+                Whether this record is itself needed to reconstruct the data
+                structure. Deletions, for example, are dead as soon as they are
+                saved.
+            key (object)
+                Used by segmented logs. The key of the record, as returned by
+                the record_key function. If every record in the tail was saved
+                with its key, the tail can be indexed without reading it back
+                when it is sealed.
+        Returns:
+            location ((string, int, int))
+                Where the operation can be read back with the read_at method,
+                as for the scan method. The location is only valid until the
+                log is compacted, i.e. until its generation changes, and the
+                operation can only be read back once any open batch is done.
+
+        """
+        self._check_writable()
+        with self._lock:
+            if self._batch is not None:
+                self._batch.append((record, obsoletes, live, key))
+                return (self._backing_file, self._batch_offset,
+                    len(self._batch) - 1)
+            location = (self._backing_file, self._tail_size, None)
+            self._count_record(len(record), obsoletes, live)
+            self._note_key(key)
+            self._append(record)
+            return location
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Groups the operations saved within a with-block into one record.
+
+        The record is written when the block exits, so no I/O happens for the
+        individual operations. On replay, either every operation in the batch
+        is applied or, if the record is malformed, none of them are. Batches
+        may be nested, in which case the outermost one determines the record.
+        Other threads saving operations wait until the batch is written. If
+        the block raises, the operations saved before the error are still
+        written, as they have already been applied to the structure.
+
+        Usage:
+            with log.batch():
+                log.save_operation("set", "a", 1)
+                log.save_operation("set", "b", 2)
+
+        """
+        with self._lock:
+            if self._batch is not None:
+                yield
+                return
+            self._batch = []
+            self._batch_offset = self._tail_size
+            try:
+                yield
+            finally:
+                batch, self._batch = self._batch, None
+                if len(batch) == 1:
+                    self.save_record(*batch[0])
+                elif batch:
+                    for record, obsoletes, live, key in batch:
+                        self._count_record(len(record), obsoletes, live)
+                        self._note_key(key)
+                    self._append(self._codec.encode_batch(
+                        [record for record, _, _, _ in batch]))
+
+    @property
+    def thread_lock(self):
+        """ The re-entrant lock held while operations are saved, batched,
+        flushed or compacted. Structures which save operations while holding a
+        lock of their own must take this lock first, so that the two are
+        always taken in the same order. """
+        return self._lock
+
+    def lock(self):
+        """ Returns a context manager which holds the log's lock.
+
+        Only coordinated logs are locked this way; for other logs the context
+        manager does nothing. Structures backed by a coordinated log must take
+        the lock before changing their state, then call refresh to catch up
+        with the changes which other processes have saved, and only then make
+        and save their own change. Buffered operations are written out before
+        the lock is released. The lock is re-entrant, and also keeps out other
+        threads of this process.
+
+        Usage:
+            with log.lock():
+                log.refresh(op_map)
+                log.save_operation("set", "a", 1)
+
+        """
+        if self._locking != LOCKING_COORDINATED:
+            return _no_lock
+        return self._coordinated_lock()
+
+    @contextlib.contextmanager
+    def _coordinated_lock(self):
+        with self._lock:
+            outermost = not self._lock_depth
+            if outermost:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    self._check_for_writers()
+                except:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+                    raise
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if outermost:
+                    try:
+                        self._track_tail()
+                    finally:
+                        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def flush(self):
+        """ Writes any buffered operations to the backing file. """
+        with self._lock:
+            if self._pending:
+                self._write_pending()
+
+    def _write_through(self):
+        # Writes buffered operations out of Python's buffer as well, which
+        # DURABILITY_NONE otherwise leaves them in, so that they can be read
+        # back from the backing file.
+        with self._lock:
+            self.flush()
+            if not self._read_only:
+                self._log_file.flush()
+
+    def reset_stats(self, live_records):
+        """ Marks every record in the log as live.
+
+        Structures call this once they have loaded (and compacted) the log, as
+        the log cannot tell which of the records it was opened with are dead.
+        The exception is records in the sealed segments of a segmented log,
+        which are known to be dead once the log has been replayed.
+
+        Args:
+            live_records (int)
+                The number of records the structure would write if compacted,
+                e.g. the number of keys in a map.
+
+        """
+        with self._lock:
+            self._stats.live_records = live_records
+            self._stats.dead_records = sum(
+                segment.dead for segment in self._segments)
+            self._stats.dead_bytes = sum(
+                segment.dead_bytes for segment in self._segments)
+
+    def close(self):
+        """ Flushes buffered operations and closes the backing file.
+
+        The log should not be used after this method has been called.
+
+        """
+        if self._read_only:
+            self._close_readers()
+            self._close_tail_reader()
+            return
+        # Stop the background sync thread first so that it never touches a
+        # closed file.
+        self._closing = True
+        self._wait_for_compaction()
+        if self._sync_thread is not None:
+            self._sync_wakeup.set()
+            self._sync_thread.join()
+        with self._lock:
+            with self.lock():
+                self.flush()
+                if self._durability != DURABILITY_NONE:
+                    self._log_file.flush()
+                    os.fsync(self._log_file.fileno())
+                # Coordinated logs have only checked the records they have
+                # read or written themselves.
+                self._seal(self._tail_offset if self.coordinated else None)
+            self._log_file.close()
+            self._close_readers()
+            self._close_tail_reader()
+            if self._lock_file is not None:
+                # Closing the file releases an exclusive lock.
+                self._lock_file.close()
+
+    def sync(self):
+        """ Writes out buffered operations and fsyncs the backing file. """
+        if self._read_only:
+            return
+        with self._lock:
+            self.flush()
+            self._log_file.flush()
+            self._unsynced_ops = 0
+            fileno = self._log_file.fileno()
+        # Other threads may keep writing while we wait on the disk.
+        os.fsync(fileno)
 
     def replay(self, op_map):
         """ Replays the log to update the persisted data structure.
@@ -86,45 +655,1085 @@ class Log(object):
                 has a name and a record of the parameters saved with it. The
                 name will be used to look up the corresponding function in the
                 map which will then be called with the saved parameters.
+        Read-only logs read the files as they are now, so replaying one again
+        picks up everything saved to it since, including by compactions.
+
+        Raises:
+            ValueError
+                If a record in the log cannot be decoded. Operations preceding
+                the malformed record will already have been replayed.
+
+        """
+        self._wait_for_compaction()
+        self._write_through()
+        pool = None
+        # Starting the pool only pays off if there are chunks to share out.
+        if self._replay_processes > 1 and not self._read_only and \
+                self._size >= 2 * self._replay_chunk_size:
+            pool = multiprocessing.Pool(self._replay_processes)
+        if self._read_only:
+            operations = self._read_view()
+        else:
+            operations = self._read_operations(pool)
+        try:
+            for op_name, parameters in operations:
+                # Retrieve the operation function from the input map and call
+                # it with the saved parameters.
+                op_map[op_name](*parameters)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        if self.coordinated:
+            self._track_tail()
+            self._caught_up = True
+
+    def refresh(self, op_map):
+        """ Replays the operations appended to a read-only log since it was
+        last read, or those saved by other processes to a coordinated log since
+        this one was last locked.
+
+        Only the end of the tail is read. If a writer has since replaced the
+        tail, by compacting the log or sealing the tail into a segment, or has
+        truncated it, nothing is replayed, and the structure must be rebuilt
+        from scratch with replay instead. A record which the writer is still
+        writing is left for the next refresh. Coordinated logs must be locked,
+        and a record left torn by a writer which crashed is discarded.
+
+        Args:
+            op_map (dict)
+                Maps operation names to functions, as for replay.
+        Returns:
+            refreshed (bool)
+                False iff the log must be replayed instead.
+        Raises:
+            ValueError
+                If the log is neither read-only nor coordinated, or if a record
+                in the log cannot be decoded.
+
+        """
+        if self.coordinated:
+            return self._catch_up(op_map)
+        if not self._read_only:
+            raise ValueError("Only read-only or coordinated logs can be "
+                "refreshed", self._backing_file)
+        if _path_identity(self._backing_file) != \
+                _file_identity(self._tail_reader):
+            return False
+        if self._tail_reader is not None and \
+                os.fstat(self._tail_reader.fileno()).st_size < \
+                self._tail_offset:
+            # The file was truncated and rewritten in place.
+            return False
+        for op_name, parameters in self._read_tail():
+            op_map[op_name](*parameters)
+        return True
+
+    def _catch_up(self, op_map):
+        # Refreshes a coordinated log, which must be locked.
+        if self._caught_up:
+            return True
+        if self._tail_reader is None:
+            # Another writer replaced the tail, so we reopened the log.
+            return False
+        for op_name, parameters in self._read_tail():
+            op_map[op_name](*parameters)
+        if os.fstat(self._log_file.fileno()).st_size > self._tail_offset:
+            # A writer crashed part way through a record. Nobody else can be
+            # writing, as we hold the lock.
+            self._log_file.truncate(self._tail_offset)
+        self._caught_up = True
+        return True
+
+    def _check_for_writers(self):
+        # Called once a coordinated log is locked. Notes whether other writers
+        # have saved anything since we last held the lock. If one compacted the
+        # log, we reopen it, and the structure must replay it.
+        if _path_identity(self._backing_file) != \
+                _file_identity(self._log_file):
+            self._log_file.close()
+            self._close_readers()
+            self._close_tail_reader()
+            self._open(True)
+            self._caught_up = False
+        elif os.fstat(self._log_file.fileno()).st_size > self._tail_offset:
+            self._caught_up = False
+
+    def _track_tail(self):
+        # Called with a coordinated log locked, once the structure reflects
+        # every record in the tail. Later changes by other writers are read
+        # from the end of the tail as it is now.
+        self.flush()
+        self._log_file.flush()
+        if _file_identity(self._tail_reader) != \
+                _file_identity(self._log_file):
+            self._close_tail_reader()
+            self._tail_reader = open(self._backing_file, 'rb')
+        self._tail_offset = os.fstat(self._log_file.fileno()).st_size
+
+    def _read_operations(self, pool=None):
+        # Streams the decoded operations from the snapshot, the segments, then
+        # the tail. Segments which have not been indexed yet are indexed as we
+        # go, saving another pass over them.
+        for operation in self._read_file(self._snapshot_file, pool):
+            yield operation
+        for segment in list(self._segments):
+            if segment.indexed or not self.segmented:
+                for operation in self._read_file(segment.path, pool):
+                    yield operation
+                continue
+            segment.records = segment.dead = 0
+            for op_name, parameters in self._read_file(segment.path, pool):
+                self._index_operation(segment, op_name, parameters)
+                yield op_name, parameters
+            segment.indexed = True
+        for operation in self._read_file(self._backing_file, pool):
+            yield operation
+
+    def _read_file(self, path, pool=None):
+        # Streams the decoded operations from a single file. Files are mapped
+        # into memory and decoded record by record, so that we never hold more
+        # than one decoded record at a time.
+        if not os.path.exists(path):
+            return
+        if pool is not None and \
+                os.stat(path).st_size > self._replay_chunk_size:
+            for operation in self._read_chunks(path, pool):
+                yield operation
+            return
+        with _mapped(path) as data:
+            for operation in self._read_data(data):
+                yield operation
+
+    def _read_data(self, data, offset=0):
+        # Streams the decoded operations from a buffer holding a whole file.
+        for op_name, parameters in self._codec.read_buffer(data, offset):
+            if op_name == BATCH:
+                for operation in parameters:
+                    yield operation
+            elif op_name != GENERATION:
+                yield op_name, parameters
+
+    def _read_view(self):
+        # Streams the decoded operations from a read-only log's files as they
+        # are now. The tail is kept open for refresh.
+        files, tail, tail_offset = self._open_view()
+        self._close_tail_reader()
+        self._tail_reader, self._tail_offset = tail, tail_offset
+        try:
+            for view_file in files:
+                with _mapped_file(view_file) as data:
+                    for operation in self._read_data(data):
+                        yield operation
+        finally:
+            for view_file in files:
+                view_file.close()
+        for operation in self._read_tail():
+            yield operation
+
+    def _read_tail(self):
+        # Streams the decoded operations appended to a read-only log's tail
+        # since it was last read. The writer may be part way through writing
+        # the last record, so we stop before it if it is torn.
+        if self._tail_reader is None:
+            return
+        start = self._tail_offset
+        if os.fstat(self._tail_reader.fileno()).st_size <= start:
+            # Nothing new, which is the common case when polling.
+            return
+        with _mapped_file(self._tail_reader) as data:
+            end = len(data)
+            try:
+                for operation in self._read_data(data, start):
+                    yield operation
+            except TruncatedRecordError as e:
+                end = e.offset
+        self._tail_offset = max(start, end)
+        self._size += self._tail_offset - start
+
+    def _open_view(self):
+        # Opens the snapshot, segments and tail of a read-only log. A writer
+        # may compact the log or seal its tail while we open them, so we start
+        # over unless the snapshot and segments are unchanged once the tail is
+        # open. Open files can still be read after they are replaced or
+        # removed. Returns the files to read in order, the tail (None if there
+        # is none yet) and the offset at which to start reading the tail.
+        while True:
+            opened = []
+            try:
+                view = self._try_open_view(opened)
+            except (IOError, OSError) as e:
+                for open_file in opened:
+                    open_file.close()
+                if e.errno != errno.ENOENT:
+                    raise
+                # A file was removed before we could open it.
+                continue
+            if view is not None:
+                return view
+            for open_file in opened:
+                open_file.close()
+
+    def _try_open_view(self, opened):
+        # Called by _open_view, which closes the files added to 'opened' if we
+        # return None because the files changed while we opened them.
+        snapshot = _open_existing(self._snapshot_file)
+        snapshot_header = [0, 0]
+        snapshot_size = 0
+        if snapshot is not None:
+            opened.append(snapshot)
+            snapshot_header = self._file_header(snapshot) or [0, 0]
+            snapshot_size = os.fstat(snapshot.fileno()).st_size
+        generation = snapshot_header[0]
+        files = opened[:]
+        listed = list_segments(self._backing_file)
+        segments = []
+        for segment in listed:
+            segment_file = open(segment.path, 'rb')
+            opened.append(segment_file)
+            # Segments older than the snapshot were folded into it by a
+            # compaction which has not removed them yet.
+            if (self._file_header(segment_file) or [0])[0] >= generation:
+                files.append(segment_file)
+                segments.append(segment)
+            else:
+                opened.pop().close()
+        tail = _open_existing(self._backing_file)
+        tail_header = None
+        if tail is not None:
+            opened.append(tail)
+            tail_header = self._file_header(tail)
+        tail_generation = (tail_header or [0])[0]
+        if _path_identity(self._snapshot_file) != _file_identity(snapshot) or \
+                [segment.path for segment in listed] != \
+                [segment.path for segment in list_segments(self._backing_file)]:
+            return None
+        if tail_generation > generation:
+            raise ValueError("Missing snapshot for log", self._backing_file)
+        tail_offset = 0
+        if tail is not None and tail_generation < generation:
+            # A compaction is replacing the tail, or crashed before it could.
+            # The start of the tail is in the snapshot already.
+            tail_offset = snapshot_header[1]
+            if tail_generation < generation - 1:
+                tail_offset = os.fstat(tail.fileno()).st_size
+        self._generation = generation
+        self._snapshot_size = snapshot_size
+        self._segments = segments
+        self._segments_size = sum(segment.size for segment in segments)
+        self._tail_header_size = 0
+        if tail_header is not None:
+            self._tail_header_size = len(
+                self._codec.encode(GENERATION, tail_header))
+        self._size = snapshot_size + self._segments_size + tail_offset
+        return files, tail, tail_offset
+
+    def _read_chunks(self, path, pool):
+        # Streams the decoded operations from a single file, which is split
+        # into chunks decoded by the pool. Only a few chunks are decoded ahead
+        # of the one being replayed, to bound how much we hold in memory.
+        with _mapped(path) as data:
+            chunks = self._codec.split(data, self._replay_chunk_size)
+        decoding = collections.deque()
+        for start, end in chunks:
+            decoding.append(pool.apply_async(_decode_chunk,
+                ((self._codec, path, start, end),)))
+            if len(decoding) > 2 * self._replay_processes:
+                for operation in _decoded(decoding.popleft()):
+                    yield operation
+        while decoding:
+            for operation in _decoded(decoding.popleft()):
+                yield operation
+
+    def scan(self):
+        """ Reads every operation in the log along with its location.
+
+        Returns:
+            operations (iterator of (string, object list, location))
+                The operations in the log, in the order they would be replayed.
+                Each location is a (path, offset, index) tuple giving the file
+                and offset of the record holding the operation. The index is
+                the position of the operation in a batch record, or None.
+        Raises:
+            ValueError
+                If a record in the log cannot be decoded.
 
         """
-        log_file = open(self._backing_file, 'r')
-        op_strings = log_file.readlines()
-        log_file.close()
-        for op_string in op_strings:
-            op_dict = json.loads(op_string)
-            # Retrieve the operation function from the input map and call it
-            # with the saved parameters.
-            op = op_map[op_dict[_key]]
-            op(*op_dict[_parameters])
+        self._wait_for_compaction()
+        self._write_through()
+        paths = [self._snapshot_file] + \
+            [segment.path for segment in self._segments] + [self._backing_file]
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with _mapped(path) as data:
+                for offset, op_name, parameters in \
+                        self._codec.scan_buffer(data):
+                    if op_name == BATCH:
+                        for index, (name, batched) in enumerate(parameters):
+                            yield name, batched, (path, offset, index)
+                    elif op_name != GENERATION:
+                        yield op_name, parameters, (path, offset, None)
+
+    def read_at(self, path, offset):
+        """ Reads a single record, e.g. from a location returned by scan.
+
+        This costs a seek and a read, as the files read from are kept open
+        until the log is compacted or closed.
+
+        Args:
+            path (string)
+                The file holding the record.
+            offset (int)
+                The position of the record in the file.
+        Returns:
+            operation ((string, object list))
+                The operation decoded from the record. For BATCH records, the
+                parameters are the list of operations in the batch.
+        Raises:
+            ValueError
+                If no record can be decoded at the location.
+
+        """
+        with self._lock:
+            if path == self._backing_file:
+                # The record may not have been written out yet.
+                self._write_through()
+            reader = self._readers.get(path)
+            if reader is None:
+                reader = self._readers[path] = open(path, 'rb')
+            reader.seek(offset)
+            for operation in self._codec.read(reader):
+                return operation
+            raise ValueError("No record at location", path, offset)
 
     def compact(self):
         """ Uses the compaction callback to reduce the log.
 
         After this method returns, the log will consist of only the operations
-        returned by the compaction callback. Compaction is run automatically
-        when thresholds are met, so users of the log do not usually need to
-        worry about calling this method.
+        returned by the compaction callback, which are written to a new
+        snapshot. If no operations have been saved since the last snapshot,
+        this does nothing. Compaction is run automatically when thresholds are
+        met, so users of the log do not usually need to worry about calling
+        this method.
+
+        Segmented logs instead merge every run of sealed segments which holds
+        overwritten records. The tail is left as it is. Read-only logs are never
+        compacted.
+
+        Raises:
+            Exception
+                Any error raised by a background compaction which failed since
+                this method was last called.
 
         """
-        new_log = TemporaryFile()
-        for op_name, params in self._compaction_callback():
-            op_as_json = json.dumps({_key : op_name, _parameters : params})
-            new_log.write(op_as_json + '\n')
-        # If all went well, we overwrite the old log file with the new one.
-        new_log.seek(0)
-        log_file = open(self._backing_file, 'w')
-        log_file.writelines(new_log.readlines())
-        new_log.close()
-        log_file.close()
+        if self._read_only:
+            return
+        with self._compaction_lock:
+            with self._lock, self.lock():
+                while self._compact(): pass
+        if self._compaction_error is not None:
+            error, self._compaction_error = self._compaction_error, None
+            raise error
+
+    def _compact(self):
+        # Returns true iff anything was compacted. Segmented logs merge a single
+        # run of segments per call.
+        if self.coordinated and not self._caught_up:
+            # The structure has yet to apply changes saved by other writers,
+            # so its state cannot be snapshotted.
+            return False
+        if self.segmented:
+            merge = self._plan_merge()
+            if merge is None:
+                return False
+            self._write_merge(merge)
+            self._install_merge(merge)
+            return True
+        if not self._tail_has_operations():
+            # The snapshot is already up to date.
+            return False
+        # Operations in an open batch are already reflected in the state
+        # returned by the compaction callback, so there is no need to write
+        # them out. Buffered operations are written, as the callback may read
+        # them back with read_at.
+        self.flush()
+        if self._batch is not None:
+            del self._batch[:]
+        tail_size = self._tail_size
+        self._write_snapshot(self._compaction_callback(), tail_size)
+        self._install_snapshot(tail_size)
+        return True
+
+    def _start_background_compaction(self, dead_only=False):
+        # Called with the lock held. Does nothing if a compaction is already
+        # running. Everything up to the current end of the tail will be covered
+        # by the new snapshot. Buffered operations are written out so that they
+        # are covered too, as they would otherwise only be in memory until the
+        # snapshot is written. Segmented logs merge segments instead, which are
+        # planned as by _plan_merge.
+        if not self._compaction_lock.acquire(False):
+            return
+        try:
+            if self.segmented:
+                merge = self._plan_merge(dead_only)
+                if merge is None:
+                    self._compaction_lock.release()
+                    return
+                write = lambda: self._write_merge(merge)
+                install = lambda: self._install_merge(merge)
+            else:
+                self._write_through()
+                tail_size = self._tail_size
+                records = self._compaction_callback()
+                write = lambda: self._write_snapshot(records, tail_size)
+                install = lambda: self._install_snapshot(tail_size)
+        except:
+            self._compaction_lock.release()
+            raise
+        def compact():
+            try:
+                write()
+                with self._lock:
+                    install()
+                    self._compaction_policy.compacted(self._stats)
+            except Exception as e:
+                # The old snapshot, segments and tail are intact, so we can
+                # carry on.
+                self._compaction_error = e
+            finally:
+                self._compaction_lock.release()
+        thread = threading.Thread(target=compact)
+        thread.daemon = True
+        thread.start()
+
+    def _wait_for_compaction(self):
+        with self._compaction_lock:
+            pass
+
+    def _write_snapshot(self, records, covered):
+        # Writes the next generation's snapshot. It covers the first 'covered'
+        # bytes of the current tail. Records are streamed into a file beside the
+        # snapshot which is renamed over it once it is safely on disk. Renaming
+        # is atomic, so if we crash we are left with either the old snapshot and
+        # tail or the new snapshot and a tail whose start will be discarded on
+        # open.
+        generation = self._generation + 1
+        temporary_file = self._snapshot_file + _temporary_suffix
+        encode = self._codec.encode
+        with open(temporary_file, 'wb') as snapshot:
+            snapshot.write(self._header(generation, covered))
+            for op_name, params in records:
+                snapshot.write(encode(op_name, params))
+            _sync_file(snapshot)
+        _rename(temporary_file, self._snapshot_file)
+
+    def _install_snapshot(self, covered):
+        # Called with the lock held once a new snapshot has been written.
+        # Operations saved since the snapshot was started are carried over to
+        # the new tail. Any segments are covered by the snapshot.
+        self._generation += 1
+        self._snapshot_size = os.stat(self._snapshot_file).st_size
+        for segment in self._segments:
+            os.remove(segment.path)
+        self._segments = []
+        self._segments_size = 0
+        self._keys = {}
+        self._replace_tail(covered)
+        # Compaction drops dead records but keeps every live one.
+        self._stats.dead_records = 0
+        self._stats.dead_bytes = 0
+
+    def _replace_tail(self, covered):
+        # Replaces the tail with one for the current generation, holding what
+        # followed the first 'covered' bytes of the old tail, which is copied
+        # from the file, so nothing may be left in the append handle's buffer.
+        self._write_through()
+        self._close_readers()
+        header = self._header(self._generation)
+        temporary_file = self._backing_file + _temporary_suffix
+        with open(temporary_file, 'wb') as new_tail:
+            new_tail.write(header)
+            with open(self._backing_file, 'rb') as old_tail:
+                old_tail.seek(covered)
+                shutil.copyfileobj(old_tail, new_tail)
+            _sync_file(new_tail)
+        _rename(temporary_file, self._backing_file)
+        self._log_file.close()
+        self._log_file = open(self._backing_file, 'ab')
+        self._tail_header_size = len(header)
+        self._size = self._snapshot_size + self._segments_size + \
+            os.fstat(self._log_file.fileno()).st_size
+
+    def _tail_has_operations(self):
+        return bool(self._segments) or \
+            self._tail_size > self._tail_header_size
+
+    def _note_key(self, key):
+        # Called with the lock held for every record added to the tail.
+        if self._tail_keys is None or not self.segmented:
+            return
+        if key is None:
+            # We will have to read the tail back to index it.
+            self._tail_keys = None
+        else:
+            self._tail_keys.append(key)
+
+    def _rotate_tail(self):
+        # Called with the lock held. Seals the tail into a new segment and
+        # starts an empty tail. The new tail is prepared first, so if we crash
+        # between the two renames we are left with no tail at all, which
+        # opening treats as an empty one.
+        self.flush()
+        self._log_file.flush()
+        if self._durability != DURABILITY_NONE:
+            os.fsync(self._log_file.fileno())
+        self._close_readers()
+        self._index_segments()
+        number = self._tail_number
+        segment = Segment(segment_path(self._backing_file, number, 0), number,
+            0, os.fstat(self._log_file.fileno()).st_size)
+        header = ''
+        if self._generation > 0:
+            header = self._header(self._generation)
+        temporary_file = self._backing_file + _temporary_suffix
+        with open(temporary_file, 'wb') as new_tail:
+            new_tail.write(header)
+            _sync_file(new_tail)
+        _rename(self._backing_file, segment.path)
+        _rename(temporary_file, self._backing_file)
+        self._log_file.close()
+        self._log_file = open(self._backing_file, 'ab')
+        self._tail_header_size = len(header)
+        self._size += len(header)
+        self._segments.append(segment)
+        self._segments_size += segment.size
+        if self._tail_keys is None:
+            self._index_segment(segment)
+        else:
+            for key in self._tail_keys:
+                self._index_key(segment, key)
+            segment.indexed = True
+        self._tail_keys = []
+
+    def _index_segments(self):
+        # Indexes every segment which has not been indexed yet, in order.
+        for segment in self._segments:
+            if not segment.indexed:
+                self._index_segment(segment)
+
+    def _index_segment(self, segment):
+        segment.records = segment.dead = 0
+        for op_name, parameters in self._read_file(segment.path):
+            self._index_operation(segment, op_name, parameters)
+        segment.indexed = True
+
+    def _index_operation(self, segment, op_name, parameters):
+        key = self._record_key(op_name, parameters)
+        if key is None:
+            segment.records += 1
+        else:
+            self._index_key(segment, key[0])
+
+    def _index_key(self, segment, key):
+        segment.records += 1
+        previous = self._keys.get(key)
+        if previous is not None:
+            previous.dead += 1
+        self._keys[key] = segment
+
+    def _plan_merge(self, dead_only=False):
+        # Called with the lock held. Picks the run of sealed segments whose
+        # merge would drop the most dead bytes, while writing at most about one
+        # segment's worth of live records. If dead_only is true, the run may
+        # only hold segments whose records are all dead, so that merging it
+        # writes nothing. Returns None if there is no such run.
+        self._index_segments()
+        best_window, best_dead_bytes = None, 0
+        for start in range(len(self._segments)):
+            live_bytes = dead_bytes = 0
+            end = min(start + _max_merge_width, len(self._segments))
+            for index in range(start, end):
+                segment = self._segments[index]
+                if dead_only and segment.dead < segment.records:
+                    break
+                live_bytes += segment.live_bytes
+                if index > start and live_bytes > self._segment_size:
+                    break
+                dead_bytes += segment.dead_bytes
+                if segment.dead and dead_bytes > best_dead_bytes:
+                    best_window = self._segments[start:index + 1]
+                    best_dead_bytes = dead_bytes
+        if best_window is None:
+            return None
+        number = best_window[-1].number
+        level = 1 + max(segment.level for segment in self._segments
+            if segment.number == number)
+        output = Segment(segment_path(self._backing_file, number, level),
+            number, level, 0)
+        # Tombstones can only be dropped if nothing they cancel could remain
+        # outside the window.
+        drop_tombstones = best_window[0] is self._segments[0] and \
+            not os.path.exists(self._snapshot_file)
+        return Merge(best_window, output, drop_tombstones)
+
+    def _write_merge(self, merge):
+        # Writes the records of the merge's window which were not overwritten
+        # later to its output segment. Only reads sealed segments, so this can
+        # run without the lock.
+        # Windows are bounded, so we can hold their operations in memory rather
+        # than reading them twice.
+        window = set(merge.window)
+        operations = list(self._read_window(merge.window))
+        last_positions = {}
+        for position, (op_name, parameters) in enumerate(operations):
+            key = self._record_key(op_name, parameters)
+            if key is not None:
+                last_positions[key[0]] = position
+        output = merge.output
+        temporary_file = output.path + _temporary_suffix
+        encode = self._codec.encode
+        with open(temporary_file, 'wb') as new_segment:
+            if self._generation > 0:
+                new_segment.write(self._header(self._generation))
+            for position, (op_name, parameters) in enumerate(operations):
+                key = self._record_key(op_name, parameters)
+                if key is not None:
+                    key, live = key
+                    latest = self._keys.get(key)
+                    if last_positions[key] != position or \
+                            (latest is not None and latest not in window):
+                        # Overwritten later, in or after the window.
+                        merge.dropped_records += 1
+                        continue
+                    if not live and merge.drop_tombstones:
+                        merge.dropped_keys.add(key)
+                        merge.dropped_records += 1
+                        continue
+                    merge.kept_keys.add(key)
+                new_segment.write(encode(op_name, parameters))
+                output.records += 1
+            _sync_file(new_segment)
+            output.size = new_segment.tell()
+        if not output.records:
+            # Everything in the window was overwritten.
+            os.remove(temporary_file)
+            merge.output = None
+            return
+        output.indexed = True
+        _rename(temporary_file, output.path)
+
+    def _read_window(self, window):
+        for segment in window:
+            for operation in self._read_file(segment.path):
+                yield operation
+
+    def _install_merge(self, merge):
+        # Called with the lock held once a merge's output has been written. The
+        # output sorts after the window, so if we crash while deleting the
+        # window its remaining segments are replayed before the output, which
+        # already reflects them.
+        window = set(merge.window)
+        index = self._segments.index(merge.window[0])
+        output = [merge.output] if merge.output is not None else []
+        self._segments[index:index + len(merge.window)] = output
+        for key in merge.kept_keys:
+            if self._keys.get(key) in window:
+                self._keys[key] = merge.output
+        for key in merge.dropped_keys:
+            if self._keys.get(key) in window:
+                del self._keys[key]
+        self._close_readers()
+        for segment in merge.window:
+            os.remove(segment.path)
+        reclaimed = sum(segment.size for segment in merge.window) - \
+            sum(segment.size for segment in output)
+        self._size -= reclaimed
+        self._segments_size -= reclaimed
+        self._stats.dead_records = \
+            max(0, self._stats.dead_records - merge.dropped_records)
+        self._stats.dead_bytes = max(0, self._stats.dead_bytes - reclaimed)
+
+    def _check_writable(self):
+        if self._read_only:
+            raise IOError("Log is read-only", self._backing_file)
+
+    def _close_tail_reader(self):
+        if self._tail_reader is not None:
+            self._tail_reader.close()
+            self._tail_reader = None
+
+    def _lock_exclusively(self):
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            raise IOError(e.errno, "Log is locked by another process",
+                self._backing_file)
+
+    def _close_readers(self):
+        # Called whenever files are replaced or removed.
+        for reader in self._readers.itervalues():
+            reader.close()
+        self._readers.clear()
+
+    def _open(self, validate):
+        # Opens the log for writing, finishing any compaction we crashed in the
+        # middle of.
+        # The append handle is kept open for the lifetime of the log. Opening it
+        # also creates the file if it does not exist.
+        try:
+            self._log_file = open(self._backing_file, 'ab')
+        except IOError as e:
+            raise IOError("Error initializing log file", e)
+        snapshot_header = self._read_header(self._snapshot_file) or [0, 0]
+        self._generation = snapshot_header[0]
+        self._snapshot_size = 0
+        if os.path.exists(self._snapshot_file):
+            self._snapshot_size = os.stat(self._snapshot_file).st_size
+        self._segments = []
+        for segment in list_segments(self._backing_file):
+            if (self._read_header(segment.path) or [0])[0] < self._generation:
+                # The segment was folded into the snapshot before we crashed.
+                os.remove(segment.path)
+            else:
+                self._segments.append(segment)
+        self._segments_size = sum(segment.size for segment in self._segments)
+        tail_header = self._read_header(self._backing_file)
+        tail_generation = (tail_header or [0])[0]
+        if tail_generation > self._generation:
+            raise ValueError("Missing snapshot for log", self._backing_file)
+        self._tail_header_size = 0
+        if tail_generation < self._generation:
+            # We must have crashed after writing a snapshot but before replacing
+            # the tail. The start of the tail is in the snapshot already.
+            covered = snapshot_header[1]
+            if tail_generation < self._generation - 1:
+                covered = os.fstat(self._log_file.fileno()).st_size
+            self._replace_tail(covered)
+        elif tail_header is not None:
+            self._tail_header_size = len(
+                self._codec.encode(GENERATION, tail_header))
+        # Check that the unsealed part of the tail is decodable (we want to fail
+        # fast otherwise).
+        if validate:
+            self._verify_tail(self._read_seal())
+        # We track the size of the log ourselves rather than asking the file
+        # system after every write. Operations still waiting to be written are
+        # included.
+        self._size = self._snapshot_size + self._segments_size + \
+            os.fstat(self._log_file.fileno()).st_size
+        if os.fstat(self._log_file.fileno()).st_size <= \
+                self._tail_header_size:
+            self._tail_keys = []
+
+    def _read_header(self, path):
+        # Returns the parameters of the header of the given file, None if it has
+        # no header or the file does not exist.
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as log_file:
+            return self._file_header(log_file)
+
+    def _file_header(self, log_file):
+        # As _read_header, for a file which is already open. Raises ValueError
+        # if the file was written with another codec. Headers name the codec,
+        # but files of the first generation have no header, so they (and files
+        # written before headers named the codec) are recognized by their first
+        # record instead.
+        with _mapped_file(log_file) as data:
+            try:
+                for op_name, parameters in self._codec.read_buffer(data):
+                    break
+                else:
+                    return None
+            except ValueError as e:
+                codec_name = recognize_codec(data)
+                if codec_name not in (None, self._codec.name):
+                    raise ValueError("Log was written with another codec",
+                        log_file.name, codec_name)
+                if isinstance(e, TruncatedRecordError):
+                    # Headers are never torn, so this is a torn first operation.
+                    return None
+                raise
+        if op_name != GENERATION:
+            return None
+        if len(parameters) > 2 and parameters[2] != self._codec.name:
+            raise ValueError("Log was written with another codec",
+                log_file.name, parameters[2])
+        return parameters
+
+    def _header(self, generation, covered=0):
+        # Encodes the header which starts every file. Snapshots cover the first
+        # 'covered' bytes of the previous generation's tail.
+        return self._codec.encode(GENERATION,
+            [generation, covered, self._codec.name])
+
+    def _seal(self, size=None):
+        # Records how much of the tail was written when the log was closed, or
+        # the given amount. The file is replaced atomically, so it never
+        # describes more of the tail than was actually on disk. The tail's
+        # generation and number tell us whether the tail has been replaced
+        # since.
+        self._log_file.flush()
+        if size is None:
+            size = os.fstat(self._log_file.fileno()).st_size
+        temporary_file = self._sealed_file + _temporary_suffix
+        with open(temporary_file, 'wb') as sealed:
+            json.dump([self._generation, self._tail_number, size], sealed)
+            if self._durability != DURABILITY_NONE:
+                _sync_file(sealed)
+        if self._durability != DURABILITY_NONE:
+            _rename(temporary_file, self._sealed_file)
+        else:
+            os.rename(temporary_file, self._sealed_file)
+
+    def _read_seal(self):
+        # Returns the length of the start of the tail which was sealed when the
+        # log was last closed, or 0 if the seal does not belong to this tail.
+        try:
+            with open(self._sealed_file, 'rb') as sealed:
+                generation, tail_number, size = json.load(sealed)
+        except (IOError, ValueError, TypeError):
+            return 0
+        if generation != self._generation or \
+                tail_number != self._tail_number or \
+                size > os.fstat(self._log_file.fileno()).st_size:
+            return 0
+        return size
+
+    def _verify_tail(self, offset):
+        # Decodes the tail from the given offset. If the tail ends with a torn
+        # record, we truncate it rather than refusing to open the log. Only the
+        # last write can be torn, so the record must look like the start of
+        # one. A first generation tail has no header, so the first write to a
+        # new log may be torn at the very start, as long as the file is not
+        # one written with another codec. Anything else raises, leaving the
+        # file as it is.
+        with _mapped(self._backing_file) as tail:
+            try:
+                for _ in self._codec.read_buffer(tail, offset): pass
+                return
+            except TruncatedRecordError as e:
+                if not self._codec.is_torn(tail, e.offset) or not e.offset \
+                        and recognize_codec(tail) not in \
+                        (None, self._codec.name):
+                    raise
+                torn_offset = e.offset
+        self._log_file.truncate(torn_offset)
+        if self._durability != DURABILITY_NONE:
+            _sync_file(self._log_file)
+
+    def _append(self, record):
+        # Called with the lock held.
+        self._pending.append(record)
+        self._size += len(record)
+        if len(self._pending) >= self._group_commit_size:
+            self._write_pending()
+        elif self._commit_timer is None and \
+                self._group_commit_interval is not None:
+            self._commit_timer = threading.Timer(
+                self._group_commit_interval, self.flush)
+            self._commit_timer.daemon = True
+            self._commit_timer.start()
+        self._compact_if_necessary()
+        if self._sync_thread is not None:
+            self._unsynced_ops += 1
+            if self._fsync_ops is not None and \
+                    self._unsynced_ops >= self._fsync_ops:
+                self._sync_wakeup.set()
+
+    def _write_pending(self):
+        # Group commit: every buffered operation goes out in a single write.
+        self._log_file.write(''.join(self._pending))
+        if self._durability != DURABILITY_NONE:
+            self._log_file.flush()
+        if self._durability == DURABILITY_FSYNC:
+            os.fsync(self._log_file.fileno())
+        del self._pending[:]
+        self._cancel_commit_timer()
+
+    def _cancel_commit_timer(self):
+        if self._commit_timer is not None:
+            self._commit_timer.cancel()
+            self._commit_timer = None
+
+    def _count_record(self, size, obsoletes, live):
+        stats = self._stats
+        obsoletes = min(obsoletes, stats.live_records)
+        if obsoletes:
+            # We don't know the sizes of the obsolete records, so we assume they
+            # are of average size.
+            obsolete_bytes = stats.live_bytes * obsoletes / stats.live_records
+            stats.live_records -= obsoletes
+            stats.dead_records += obsoletes
+            stats.dead_bytes += obsolete_bytes
+        if live:
+            stats.live_records += 1
+        else:
+            stats.dead_records += 1
+            stats.dead_bytes += size
 
     def _compact_if_necessary(self):
-        size = os.stat(self._backing_file).st_size
-        if size < self._compaction_threshold:
+        if self.segmented:
+            # Segmented logs only compact once they have a new sealed segment.
+            if self._tail_size < self._segment_size:
+                return
+            self._rotate_tail()
+            self._merge_segments()
+            return
+        if not self._compaction_policy.should_compact(self._stats):
+            return
+        if self._background_compaction:
+            self._start_background_compaction()
+            return
+        self._compact()
+        self._compaction_policy.compacted(self._stats)
+
+    def _merge_segments(self):
+        # Called with the lock held once the tail has been sealed. Merging one
+        # run of segments may leave most of the garbage behind, so we keep
+        # merging while the policy asks for compaction. Runs of segments whose
+        # records are all dead are merged whatever the policy says, as that
+        # only deletes them, so that overwritten segments never pile up.
+        for _ in range(_max_merges_per_seal):
+            dead_only = not self._compaction_policy.should_compact(self._stats)
+            if self._background_compaction:
+                self._start_background_compaction(dead_only)
+                return
+            merge = self._plan_merge(dead_only)
+            if merge is None:
+                return
+            self._write_merge(merge)
+            self._install_merge(merge)
+            self._compaction_policy.compacted(self._stats)
+
+
+@contextlib.contextmanager
+def _mapped(path):
+    # Maps a file into memory for reading.
+    with open(path, 'rb') as mapped_file:
+        with _mapped_file(mapped_file) as data:
+            yield data
+
+@contextlib.contextmanager
+def _mapped_file(mapped_file):
+    # Maps an open file into memory, as far as it extends now. Empty files
+    # cannot be mapped, so an empty string stands in for them.
+    size = os.fstat(mapped_file.fileno()).st_size
+    if not size:
+        yield ''
+        return
+    data = mmap.mmap(mapped_file.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        yield data
+    finally:
+        data.close()
+
+class _NoLock(object):
+    # Returned by the lock method of logs which are not coordinated.
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_no_lock = _NoLock()
+
+def _open_existing(path):
+    # Opens a file for reading, or returns None if there is no such file.
+    try:
+        return open(path, 'rb')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+def _identity(stat):
+    # Identifies the file a stat result describes, even once it is renamed.
+    return stat.st_dev, stat.st_ino
+
+def _file_identity(open_file):
+    if open_file is None:
+        return None
+    return _identity(os.fstat(open_file.fileno()))
+
+def _path_identity(path):
+    # The identity of the file at path, or None if there is none.
+    try:
+        return _identity(os.stat(path))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+def _decode_chunk(task):
+    # Runs in a replay worker process. Decodes the records in part of a file.
+    # If a record cannot be decoded, the operations before it are returned
+    # along with the error, so that they are still replayed.
+    codec, path, start, end = task
+    with open(path, 'rb') as log_file:
+        log_file.seek(start)
+        data = log_file.read(end - start)
+    operations = []
+    error = None
+    try:
+        for op_name, parameters in codec.read_buffer(data):
+            if op_name == BATCH:
+                operations.extend(parameters)
+            elif op_name != GENERATION:
+                operations.append((op_name, parameters))
+    except TruncatedRecordError as e:
+        error = TruncatedRecordError(start + e.offset)
+    except ValueError as e:
+        error = e
+    # The operations are sent back to the replaying process, which has to load
+    # them on its single core. Marshalled data is far quicker to pickle and
+    # load than the operations themselves, but custom codecs may decode
+    # records into objects which cannot be marshalled.
+    try:
+        return marshal.dumps(operations, _marshal_version), True, error
+    except ValueError:
+        return operations, False, error
+
+def _decoded(result):
+    # Waits for a chunk being decoded by _decode_chunk and returns its
+    # operations, raising its error after them if it had one.
+    operations, marshalled, error = result.get()
+    if marshalled:
+        operations = marshal.loads(operations)
+    for operation in operations:
+        yield operation
+    if error is not None:
+        raise error
+
+def _sync_file(open_file):
+    open_file.flush()
+    os.fsync(open_file.fileno())
+
+def _rename(source, destination):
+    # Atomically replaces the destination (os.rename does so on POSIX systems)
+    # and makes sure the rename itself survives a crash.
+    os.rename(source, destination)
+    directory = os.path.dirname(os.path.abspath(destination))
+    directory = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+def _sync_periodically(log_ref, wakeup, interval):
+    # Runs on the background thread for DURABILITY_FSYNC_INTERVAL. We only hold
+    # a weak reference to the log so that an unclosed log can still be garbage
+    # collected, at which point this thread exits.
+    while True:
+        wakeup.wait(interval)
+        wakeup.clear()
+        log = log_ref()
+        if log is None or log._closing:
             return
-        self.compact()
-        size = os.stat(self._backing_file).st_size
-        if size > self._compaction_threshold:
-            # If we are still over the threshold, we need to increase it to
-            # avoid thrashing.
-            self._compaction_threshold = size * 2
+        if log._unsynced_ops:
+            log.sync()
+        del log
@@ -1,8 +1,21 @@
-from log import Log, test_json_encoding
+import collections
+import contextlib
+import marshal
+import threading
+
+from log import LOCKING_COORDINATED, Log
+from snapshot import MapSnapshot, Snapshots
 
 # Keys for the operations map.
 _set = "set"
 _delete = "delete"
+_load = "load"
+# The number of key-value pairs in each record of a snapshot.
+_snapshot_chunk_size = 1000
+# The operations saved by this structure, in the order the log's codec numbers
+# them. New operations must be added at the end.
+_op_names = [_set, _delete, _load]
+_marshal_version = 2
 
 class Map(object):
     """ A persisted map.
@@ -12,7 +25,9 @@ class Map(object):
 
     """
 
-    def __init__(self, path_to_backing_file):
+    def __init__(self, path_to_backing_file, coalesce_size=None,
+            coalesce_interval=None, indexes=None, compact_values=False,
+            value_cache_size=0, **log_options):
         """ Initializes the map using the provided file.
 
         Args:
@@ -21,17 +36,120 @@ class Map(object):
                 map. If no file currently exists at this location, one will be
                 created. Otherwise, the file will be used to initialize the
                 state of this map.
+            coalesce_size (int)
+                If provided, writes are coalesced: changes are held back until
+                this many keys have been changed, and only the last set or
+                delete of each key is then saved to the log. Reads always see
+                the latest changes. Changes which have not been flushed are
+                lost if the process crashes.
+            coalesce_interval (float)
+                If provided, writes are coalesced as above and held back for at
+                most this many seconds.
+            indexes (dict: string -> function: object -> object)
+                Secondary indexes to maintain, by name. See add_index.
+            compact_values (bool)
+                If True, values are kept in memory as marshalled strings and
+                decoded whenever they are read, which takes far less memory
+                than the objects themselves. Values must then be built from the
+                types the marshal module supports, and each read returns a new
+                copy of the value unless it comes from the cache.
+            value_cache_size (int)
+                Used with compact_values. The number of recently decoded values
+                to keep. Cached values are shared between readers, so they
+                should not be modified. Defaults to 0.
+            **log_options (object)
+                Keyword arguments passed through to the backing Log, e.g.
+                durability, group_commit_size or codec. Only the binary codec
+                checksums records, so corruption which leaves a JSON record
+                decodable goes unnoticed. With coordinated locking, several
+                processes can change the map. Each catches up with the others'
+                changes before making its own, and on refresh.
+        Raises:
+            ValueError
+                If writes are to be coalesced with coordinated locking, as the
+                changes held back would be saved out of order.
 
         """
+        if (coalesce_size is not None or coalesce_interval is not None) and \
+                log_options.get("locking") == LOCKING_COORDINATED:
+            raise ValueError("Coordinated maps cannot coalesce writes")
         self._inner_map = {}
-        self._log = Log(path_to_backing_file, self._get_compaction_callback())
-        # We make sure persistence is turned off during the replay so that we
-        # don't duplicate everything in the log file.
-        self._persist = False
-        self._log.replay(self._get_op_map())
-        self._persist = True
-        # Compact during initialization as we'd rather take the time now.
-        self._log.compact()
+        self._compact_values = compact_values
+        self._value_cache = collections.OrderedDict()
+        self._value_cache_size = value_cache_size
+        self._coalescing = coalesce_size is not None or \
+            coalesce_interval is not None
+        self._coalesce_size = coalesce_size
+        self._coalesce_interval = coalesce_interval
+        # Maps each key changed since the last flush to its latest record, the
+        # number of records in the log it makes obsolete and whether it is live.
+        # Flushes may happen on the timer's thread.
+        self._coalesced = {}
+        self._coalesce_lock = threading.Lock()
+        self._coalesce_timer = None
+        self._batch_depth = 0
+        self._indexes = {}
+        self._snapshots = Snapshots()
+        # Held while a snapshot is taken, and while the inner map is changed,
+        # so that no snapshot starts sharing the inner map after a change has
+        # found it unshared.
+        self._snapshot_lock = threading.Lock()
+        # Refreshes may run on a Follower's thread.
+        self._refresh_lock = threading.Lock()
+        self._log = Log(
+            path_to_backing_file, self._get_compaction_callback(),
+            op_names=_op_names, record_key=_record_key, **log_options)
+        with self._log.lock():
+            # Replaying applies operations directly to the inner structure
+            # rather than through the public methods, so nothing is
+            # re-validated or written back to the log.
+            self._log.replay(self._get_op_map())
+            # Fold the tail into a new snapshot during initialization as we'd
+            # rather take the time now. Segmented logs are merged bit by bit as
+            # they grow instead, so that opening a large map stays quick.
+            if not self._log.segmented:
+                self._log.compact()
+            self._log.reset_stats(len(self._inner_map))
+        for name, extractor in (indexes or {}).iteritems():
+            self.add_index(name, extractor)
+
+    def close(self):
+        """ Writes out any buffered operations and closes the backing file. """
+        self.flush()
+        self._log.close()
+
+    def flush(self):
+        """ Writes any coalesced changes, and any operations buffered by the
+        log, to the backing file. """
+        with self._log.thread_lock, self._coalesce_lock:
+            self._flush_coalesced()
+        self._log.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ Returns a context manager which saves the changes made within it as
+        a single unit.
+
+        Changes are applied to the map immediately, but are only written to the
+        backing file when the with-block exits. If the process crashes before
+        then, none of them are persisted. Changes made within a batch are not
+        coalesced.
+
+        Usage:
+            with persisted_map.batch():
+                ...
+
+        """
+        # Coalesced changes are older than the batch, so they must be saved
+        # before it.
+        with self._log.thread_lock, self._coalesce_lock:
+            self._flush_coalesced()
+        with self._writing(), self._log.batch():
+            self._batch_depth += 1
+            try:
+                yield
+            finally:
+                self._batch_depth -= 1
 
     def __len__(self):
         """ Returns the number of key-value pairs in the map. """
@@ -43,18 +161,20 @@ class Map(object):
         Args:
             key (object)
                 The key by which the value will be retrievable. Must be
-                encodable by the json.dumps method.
+                encodable by the log's codec (json.dumps by default).
             value (object)
-                The value stored by the key. Must be encodable by the json.dumps
-                method.
+                The value stored by the key. Must be encodable by the log's
+                codec (json.dumps by default).
         Raises:
             ValueError
-                If either the key or value are not JSON encodable.
+                If either the key or value are not JSON encodable, or if values
+                are kept compact and the value cannot be marshalled.
 
         """
-        test_json_encoding(key, value)
-        self._inner_map[key] = value
-        if self._persist: self._log.save_operation(_set, key, value)
+        with self._writing():
+            record = self._log.encode_operation(_set, key, value)
+            obsoletes = self._apply_set(key, value)
+            self._save_record(key, record, obsoletes, True)
 
     def __getitem__(self, key):
         """ Used to query the value mapped to the input key.
@@ -70,7 +190,24 @@ class Map(object):
                 If the key was not found in the map.
 
         """
-        return self._inner_map[key]
+        stored = self._inner_map[key]
+        if not self._compact_values:
+            return stored
+        if not self._value_cache_size:
+            return marshal.loads(stored)
+        # Values leave the cache in the order they were decoded. Moving hits
+        # to the end would make them as slow as decoding the value again.
+        # Entries keep the string they were decoded from, so that a value
+        # decoded just as another thread set the key again, e.g. a Follower's,
+        # is not returned once the key has changed.
+        cached = self._value_cache.get(key)
+        if cached is not None and cached[0] is stored:
+            return cached[1]
+        value = marshal.loads(stored)
+        self._value_cache[key] = stored, value
+        if len(self._value_cache) > self._value_cache_size:
+            self._value_cache.popitem(last=False)
+        return value
 
     def __delitem__(self, key):
         """ Used to delete the mapping for the input key.
@@ -88,10 +225,10 @@ class Map(object):
                 If the key is not JSON encodable.
 
         """
-        test_json_encoding(key)
-        val = self._inner_map[key]
-        del self._inner_map[key]
-        if self._persist: self._log.save_operation(_delete, key)
+        with self._writing():
+            record = self._log.encode_operation(_delete, key)
+            val = self._apply_delete(key)
+            self._save_record(key, record, 1, False)
         return val
 
     def __contains__(self, key):
@@ -115,6 +252,11 @@ class Map(object):
             if isinstance(other, Map):
                 return NotImplemented
             return False
+        if self._compact_values or other._compact_values:
+            # Equal values may marshal differently, e.g. dicts built in a
+            # different order.
+            return len(self) == len(other) and \
+                dict(self.iteritems()) == dict(other.iteritems())
         return self._inner_map == other._inner_map
 
     def __ne__(self, other):
@@ -134,6 +276,8 @@ class Map(object):
             if isinstance(other, Map):
                 return NotImplemented
             return True
+        if self._compact_values or other._compact_values:
+            return not self.__eq__(other)
         return self._inner_map != other._inner_map
 
     def __iter__(self):
@@ -142,6 +286,9 @@ class Map(object):
 
     def iteritems(self):
         """ Returns an iterator over the (key, value) pairs in the map. """
+        if self._compact_values:
+            return ((key, marshal.loads(stored))
+                for key, stored in self._inner_map.iteritems())
         return self._inner_map.iteritems()
 
     def iterkeys(self):
@@ -150,14 +297,316 @@ class Map(object):
 
     def itervalues(self):
         """ Returns an iterator over the values in the map. """
+        if self._compact_values:
+            return (marshal.loads(stored)
+                for stored in self._inner_map.itervalues())
         return self._inner_map.itervalues()
 
+    def add_index(self, name, extractor):
+        """ Adds a secondary index on the values in the map.
+
+        The index maps the result of the extractor function for each value to
+        the keys of the values it was extracted from. It is built from the
+        current contents of the map and updated as values are set and deleted.
+        Indexes are not persisted; declare them with the indexes argument of
+        __init__ to have them rebuilt whenever the map is opened.
+
+        Args:
+            name (string)
+                The name of the index, as passed to lookup.
+            extractor (function: object -> object)
+                Given a value in the map, returns the hashable value to index
+                it by, or None to leave it out of the index. It is called again
+                with the old value when a value is replaced or deleted, so it
+                must always return the same result for the same value.
+        Raises:
+            ValueError
+                If an index with that name already exists.
+
+        """
+        if name in self._indexes:
+            raise ValueError("Index already exists", name)
+        self._indexes[name] = self._build_index(extractor, self._inner_map)
+
+    def remove_index(self, name):
+        """ Removes a secondary index. Raises KeyError if there is none by that
+        name. """
+        del self._indexes[name]
+
+    def lookup(self, name, index_value):
+        """ Returns the keys of the values with the given indexed value.
+
+        Args:
+            name (string)
+                The name of the index.
+            index_value (object)
+                The value returned by the index's extractor function.
+        Returns:
+            keys (frozenset)
+                The keys of the values for which the extractor returned
+                index_value. Empty if there are none.
+        Raises:
+            KeyError
+                If there is no index by that name.
+
+        """
+        return frozenset(self._indexes[name].buckets.get(index_value, ()))
+
+    def refresh(self):
+        """ Picks up the changes saved to the backing file by another process
+        since the map was opened or last refreshed.
+
+        Only maps opened with read_only=True or coordinated locking can be
+        refreshed. Usually only the records appended since are read, and they
+        are applied as if they had been made through this map. If the writer
+        has compacted the log since, the map is reloaded from scratch instead.
+        Snapshots taken earlier are unaffected either way.
+
+        Raises:
+            ValueError
+                If the map can not be refreshed, or if a record in the backing
+                file cannot be decoded.
+
+        """
+        with self._log.lock(), self._refresh_lock:
+            if not self._log.refresh(self._get_refresh_op_map()):
+                self._reload()
+
+    def _writing(self):
+        # Returns the context in which to change the map. Other processes may
+        # write to a coordinated log, so we lock it and catch up with them
+        # first.
+        if self._log.coordinated:
+            return self._catching_up()
+        return self._log.lock()
+
+    @contextlib.contextmanager
+    def _catching_up(self):
+        with self._log.lock():
+            self.refresh()
+            yield
+
+    def _apply_set(self, key, value):
+        # Sets the key in memory, keeping indexes up to date. Returns the
+        # number of records in the log which this makes obsolete.
+        indexed = [(index, index.extractor(value))
+            for index in self._indexes.itervalues()]
+        stored = self._pack(value)
+        obsoletes = 1 if key in self._inner_map else 0
+        if obsoletes and self._indexes:
+            self._unindex(key, self._unpack(self._inner_map[key]))
+        with self._changing():
+            self._inner_map[key] = stored
+        if self._value_cache:
+            self._value_cache.pop(key, None)
+        for index, index_value in indexed:
+            index.add(index_value, key)
+        return obsoletes
+
+    def _apply_delete(self, key):
+        # Deletes the key in memory, keeping indexes up to date. Returns the
+        # value which was deleted.
+        val = self._unpack(self._inner_map[key])
+        with self._changing():
+            del self._inner_map[key]
+        if self._value_cache:
+            self._value_cache.pop(key, None)
+        self._unindex(key, val)
+        return val
+
+    def _reload(self):
+        # Rebuilds the map from the backing file. The new inner map only
+        # replaces the old one once it is complete, so that reads made
+        # meanwhile see the old contents rather than part of the new ones.
+        # Snapshots keep the old inner map.
+        inner_map = {}
+        self._log.replay(self._get_op_map(inner_map))
+        indexes = dict((name, self._build_index(index.extractor, inner_map))
+            for name, index in self._indexes.iteritems())
+        with self._snapshot_lock:
+            self._inner_map, self._indexes = inner_map, indexes
+            self._snapshots = Snapshots()
+        self._value_cache.clear()
+
+    def _build_index(self, extractor, inner_map):
+        index = _Index(extractor)
+        for key, stored in inner_map.iteritems():
+            index.add(extractor(self._unpack(stored)), key)
+        return index
+
+    def _unindex(self, key, value):
+        for index in self._indexes.itervalues():
+            index.remove(index.extractor(value), key)
+
+    def _save_record(self, key, record, obsoletes, live):
+        if not self._coalescing or self._batch_depth:
+            self._log.save_record(record, obsoletes, live, key=key)
+            return
+        # Flushing takes the log's lock, which must be taken first.
+        with self._log.thread_lock, self._coalesce_lock:
+            if key in self._coalesced:
+                # Only the first change since the last flush knows whether the
+                # key has a record in the log.
+                obsoletes = self._coalesced[key][1]
+            self._coalesced[key] = (record, obsoletes, live)
+            if self._coalesce_size is not None and \
+                    len(self._coalesced) >= self._coalesce_size:
+                self._flush_coalesced()
+            elif self._coalesce_timer is None and \
+                    self._coalesce_interval is not None:
+                self._coalesce_timer = threading.Timer(
+                    self._coalesce_interval, self.flush)
+                self._coalesce_timer.daemon = True
+                self._coalesce_timer.start()
+
+    def _flush_coalesced(self):
+        # Called with the log's lock and the coalesce lock held. The changes are
+        # saved as a batch so that a crash never leaves only some of them in the
+        # log.
+        if self._coalesce_timer is not None:
+            self._coalesce_timer.cancel()
+            self._coalesce_timer = None
+        coalesced, self._coalesced = self._coalesced, {}
+        with self._log.batch():
+            for key, (record, obsoletes, live) in coalesced.iteritems():
+                # A key which was added and then deleted again since the last
+                # flush needs no record at all.
+                if live or obsoletes:
+                    self._log.save_record(record, obsoletes, live, key=key)
+
+    def snapshot(self):
+        """ Returns a read-only view of the map as it is now.
+
+        The view does not change as the map does, so it can be iterated while
+        the map is changed, e.g. by another thread, without copying the map up
+        front or locking. If the view is still in use when the map is next
+        changed, the map copies its table of keys and values first.
+
+        Snapshots can be taken by any thread, including while another thread
+        changes the map.
+
+        Returns:
+            snapshot (MapSnapshot)
+                The view of the map.
+
+        """
+        with self._snapshot_lock:
+            view = MapSnapshot(self._inner_map,
+                marshal.loads if self._compact_values else None)
+            self._snapshots.add(view)
+        return view
+
+    def _pack(self, value):
+        # Returns the value as it is kept in the inner map. Raises ValueError if
+        # the value cannot be marshalled.
+        if self._compact_values:
+            return marshal.dumps(value, _marshal_version)
+        return value
+
+    def _unpack(self, stored):
+        # Returns the value kept in the inner map as stored.
+        if self._compact_values:
+            return marshal.loads(stored)
+        return stored
+
+    @contextlib.contextmanager
+    def _changing(self):
+        # The inner map is changed within this context, after copying it if a
+        # snapshot shares it.
+        with self._snapshot_lock:
+            if self._snapshots.must_copy():
+                self._inner_map = dict(self._inner_map)
+            yield
+
     def _get_compaction_callback(self):
-        def make_kv_tuple(key):
-            return (_set, [key, self._inner_map[key]])
+        # Snapshots hold the map's pairs in chunks which are loaded in bulk.
         def callback():
-            return [make_kv_tuple(key) for key in self._inner_map]
+            if self._log.compacts_in_background:
+                # Writes carry on during a background compaction, so it reads
+                # from a snapshot of the map.
+                return _snapshot_records(self.snapshot().iteritems())
+            # Subclasses may order iteration by state built after compaction,
+            # so we read the pairs the way Map does.
+            return _snapshot_records(Map.iteritems(self))
         return callback
 
-    def _get_op_map(self):
-        return {_set : self.__setitem__, _delete : self.__delitem__}
+    def _get_refresh_op_map(self):
+        # Operations read by refresh were saved by another process, so they
+        # are applied as changes made through the map would be, keeping
+        # indexes and subclasses up to date, but are not saved.
+        def delete(key):
+            if key in self._inner_map:
+                self._apply_delete(key)
+        def load(pairs):
+            for key, value in pairs:
+                self._apply_set(key, value)
+        return {
+            _set : self._apply_set,
+            _delete : delete,
+            _load : load
+        }
+
+    def _get_op_map(self, inner_map=None):
+        # Replayed operations were valid when they were saved, so we apply them
+        # straight to the inner map, or to the given one. Merging a segmented
+        # log can drop the records a deletion cancelled while keeping the
+        # deletion itself, so missing keys are ignored.
+        if inner_map is None:
+            inner_map = self._inner_map
+        if self._compact_values:
+            pack = self._pack
+            return {
+                _set : lambda key, value: inner_map.__setitem__(key,
+                    pack(value)),
+                _delete : lambda key: inner_map.pop(key, None),
+                _load : lambda pairs: inner_map.update(
+                    (key, pack(value)) for key, value in pairs)
+            }
+        return {
+            _set : inner_map.__setitem__,
+            _delete : lambda key: inner_map.pop(key, None),
+            _load : inner_map.update
+        }
+
+def _record_key(op_name, parameters):
+    # Identifies the key each record writes, so that segmented logs can drop
+    # records which were overwritten later. Deletions are tombstones.
+    if op_name == _set:
+        return parameters[0], True
+    if op_name == _delete:
+        return parameters[0], False
+    return None
+
+def _snapshot_records(items):
+    chunk = []
+    for key, value in items:
+        chunk.append([key, value])
+        if len(chunk) == _snapshot_chunk_size:
+            yield (_load, [chunk])
+            chunk = []
+    if chunk:
+        yield (_load, [chunk])
+
+class _Index(object):
+    # A secondary index on a map's values. Keys are grouped into sets by the
+    # value extracted from their values; empty sets are dropped.
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.buckets = {}
+
+    def add(self, index_value, key):
+        if index_value is None:
+            return
+        bucket = self.buckets.get(index_value)
+        if bucket is None:
+            bucket = self.buckets[index_value] = set()
+        bucket.add(key)
+
+    def remove(self, index_value, key):
+        if index_value is None:
+            return
+        bucket = self.buckets[index_value]
+        bucket.discard(key)
+        if not bucket:
+            del self.buckets[index_value]
@@ -0,0 +1,101 @@
+""" Sealed segments of a segmented persisted.Log. """
+
+import os
+import re
+
+_segment_suffix = ".segment"
+
+class Segment(object):
+    """ A sealed, immutable part of a log's history.
+
+    When a segmented log's tail grows past the segment size, it is renamed to
+    become a new segment at level 0. Merging a run of segments replaces them
+    with one holding only their records which were not overwritten later. The
+    new segment takes the number of the last segment in the run and a higher
+    level. Segments are replayed in order of number, then level.
+
+    """
+
+    def __init__(self, path, number, level, size):
+        """ Describes a segment.
+
+        Args:
+            path (string)
+                The path to the segment's file.
+            number (int)
+                The position of the segment in the log.
+            level (int)
+                Orders segments with the same number. Merges write their output
+                at a higher level than their input.
+            size (int)
+                The size of the segment's file in bytes.
+
+        """
+        self.path = path
+        self.number = number
+        self.level = level
+        self.size = size
+        # The number of operations in the segment, and how many of them have
+        # been overwritten since. These are only known once the segment has
+        # been indexed.
+        self.records = 0
+        self.dead = 0
+        self.indexed = False
+
+    @property
+    def dead_bytes(self):
+        """ The (estimated) number of bytes taken up by dead records. """
+        if not self.records:
+            return 0
+        return self.size * self.dead / self.records
+
+    @property
+    def live_bytes(self):
+        """ The (estimated) number of bytes taken up by live records. """
+        return self.size - self.dead_bytes
+
+class Merge(object):
+    """ A merge of a run of segments into a single new segment. """
+
+    def __init__(self, window, output, drop_tombstones):
+        """ Describes a merge.
+
+        Args:
+            window (Segment list)
+                The run of segments to merge, in order.
+            output (Segment)
+                The segment to write. Set to None if it would be empty.
+            drop_tombstones (bool)
+                Whether records which only cancel earlier ones, e.g. deletions,
+                can be dropped. This is only the case if no earlier records
+                exist outside the window.
+
+        """
+        self.window = window
+        self.output = output
+        self.drop_tombstones = drop_tombstones
+        # Filled in as the output is written: the keys of the records it holds
+        # and of the tombstones which were dropped.
+        self.kept_keys = set()
+        self.dropped_keys = set()
+        self.dropped_records = 0
+
+def segment_path(filepath, number, level):
+    """ Returns the path to a segment of the log backed by filepath. """
+    return "%s.%d.%d%s" % (filepath, number, level, _segment_suffix)
+
+def list_segments(filepath):
+    """ Returns the segments of the log backed by filepath, in order. """
+    directory = os.path.dirname(os.path.abspath(filepath))
+    pattern = re.compile(re.escape(os.path.basename(filepath)) +
+        r"\.(\d+)\.(\d+)" + re.escape(_segment_suffix) + "$")
+    segments = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match is None:
+            continue
+        number, level = int(match.group(1)), int(match.group(2))
+        path = segment_path(filepath, number, level)
+        segments.append(Segment(path, number, level, os.stat(path).st_size))
+    segments.sort(key=lambda segment: (segment.number, segment.level))
+    return segments
@@ -0,0 +1,177 @@
+import copy
+import itertools
+import json
+import os
+import re
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from map import Map
+
+_shard_suffix = ".shard"
+# The number of shards used by default.
+_default_shards = 4
+
+class ShardedMap(object):
+    """ A persisted map spread over several independent maps.
+
+    Keys are assigned to shards by a hash of their JSON encoding, so a key is
+    always found in the same shard. Numbers which are equal as dict keys, such
+    as 1, 1.0 and True, are hashed alike. Each shard has its own backing file,
+    log and lock, so writes to different shards do not wait for each other, and
+    each shard is compacted on its own schedule. Shards are opened in parallel.
+
+    Changes to several shards cannot be made atomic, so there is no batch
+    method.
+
+    """
+
+    def __init__(self, path_to_backing_file, shards=_default_shards,
+            map_class=Map, **map_options):
+        """ Initializes the map using the provided file path.
+
+        Args:
+            path_to_backing_file (string):
+                The path from which the shards' backing files are named. The
+                number of shards is part of the names.
+            shards (int)
+                The number of shards. An existing map must be opened with the
+                number of shards it was created with. Defaults to 4.
+            map_class (class)
+                The class of the shards, e.g. Map or DiskMap. Defaults to Map.
+            **map_options (object)
+                Keyword arguments passed through to each shard, e.g. durability
+                or replay_processes. Policies keep state for a single log, so
+                each shard gets its own copy of any compaction_policy.
+        Raises:
+            ValueError
+                If the map was created with a different number of shards.
+
+        """
+        for existing in _list_shard_counts(path_to_backing_file):
+            if existing != shards:
+                raise ValueError("Map was created with another number of "
+                    "shards", path_to_backing_file, existing)
+        def open_shard(index):
+            options = dict(map_options)
+            if options.get("compaction_policy") is not None:
+                options["compaction_policy"] = \
+                    copy.deepcopy(options["compaction_policy"])
+            try:
+                return map_class(shard_path(path_to_backing_file, index,
+                    shards), **options)
+            except Exception as e:
+                return e
+        pool = ThreadPool(shards)
+        try:
+            opened = pool.map(open_shard, range(shards))
+        finally:
+            pool.close()
+            pool.join()
+        errors = [shard for shard in opened if isinstance(shard, Exception)]
+        if errors:
+            for shard in opened:
+                if not isinstance(shard, Exception):
+                    shard.close()
+            raise errors[0]
+        self._shards = opened
+
+    def close(self):
+        """ Writes out any buffered operations and closes the backing files. """
+        for shard in self._shards:
+            shard.close()
+
+    def __len__(self):
+        """ Returns the number of key-value pairs in the map. """
+        return sum(len(shard) for shard in self._shards)
+
+    def __setitem__(self, key, value):
+        """ Puts the key / value pair into the map. See Map.__setitem__. """
+        self._shard(key)[key] = value
+
+    def __getitem__(self, key):
+        """ Returns the value mapped to the input key. See Map.__getitem__. """
+        return self._shard(key)[key]
+
+    def __delitem__(self, key):
+        """ Deletes the mapping for the input key. See Map.__delitem__. """
+        return self._shard(key).__delitem__(key)
+
+    def __contains__(self, key):
+        """ Returns true iff the key is present in the map. """
+        return key in self._shard(key)
+
+    def __eq__(self, other):
+        """ Equality check. Returns NotImplemented for subclasses.
+
+        Args:
+            other (ShardedMap)
+                Another map to run an equality check against.
+
+        Returns:
+            maps_equal (bool)
+                True iff the input map holds the same pairs as this one.
+                Returns NotImplemented if the input map is a subclass of
+                ShardedMap.
+
+        """
+        if not type(other) == type(self):
+            if isinstance(other, ShardedMap):
+                return NotImplemented
+            return False
+        return len(self) == len(other) and \
+            dict(self.iteritems()) == dict(other.iteritems())
+
+    def __ne__(self, other):
+        """ Inequality check. Returns NotImplemented for subclasses. """
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __iter__(self):
+        """ Returns an iterator over the keys in the map. """
+        return self.iterkeys()
+
+    def iteritems(self):
+        """ Returns an iterator over the (key, value) pairs in the map. """
+        return itertools.chain.from_iterable(
+            shard.iteritems() for shard in self._shards)
+
+    def iterkeys(self):
+        """ Returns an iterator over the keys in the map. """
+        return itertools.chain.from_iterable(
+            shard.iterkeys() for shard in self._shards)
+
+    def itervalues(self):
+        """ Returns an iterator over the values in the map. """
+        return itertools.chain.from_iterable(
+            shard.itervalues() for shard in self._shards)
+
+    def _shard(self, key):
+        # Python's own hash differs between platforms, and keys come back from
+        # the log as unicode strings, so we hash their encoding instead. Keys
+        # which are equal to an integer are encoded as that integer, as they
+        # find each other in a dict.
+        if isinstance(key, bool) or \
+                isinstance(key, float) and key.is_integer():
+            key = int(key)
+        encoded = json.dumps(key, sort_keys=True)
+        return self._shards[(zlib.crc32(encoded) & 0xffffffff) %
+            len(self._shards)]
+
+def shard_path(filepath, index, shards):
+    """ Returns the path to the backing file of a shard. """
+    return "%s.%d-of-%d%s" % (filepath, index, shards, _shard_suffix)
+
+def _list_shard_counts(filepath):
+    # Returns the numbers of shards which existing shard files were created for.
+    directory = os.path.dirname(os.path.abspath(filepath))
+    pattern = re.compile(re.escape(os.path.basename(filepath)) +
+        r"\.\d+-of-(\d+)" + re.escape(_shard_suffix) + "$")
+    counts = set()
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match is not None:
+            counts.add(int(match.group(1)))
+    return counts
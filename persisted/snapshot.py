@@ -0,0 +1,130 @@
+""" Read-only, point-in-time views of persisted structures. """
+
+import weakref
+
+class Snapshots(object):
+    """ Tracks the snapshots which share a structure's inner container.
+
+    Taking a snapshot does not copy anything: the snapshot refers to the
+    structure's inner container, and the structure copies the container the
+    next time it changes, but only if one of the snapshots is still in use.
+    The copy is of the container's references, made in C, not of the values.
+
+    """
+
+    def __init__(self):
+        self._views = None
+
+    def add(self, view):
+        """ Records that the view shares the current inner container. """
+        if self._views is None:
+            self._views = weakref.WeakSet()
+        self._views.add(view)
+
+    def must_copy(self):
+        """ Called before the inner container is changed. Returns true iff a
+        snapshot still refers to it, in which case the structure must change a
+        copy of it instead. """
+        if self._views is None:
+            return False
+        views, self._views = self._views, None
+        return len(views) > 0
+
+class MapSnapshot(object):
+    """ A read-only view of a Map as it was when the snapshot was taken.
+
+    Values are shared with the map, so they should not be modified.
+
+    """
+
+    def __init__(self, inner_map, decode=None):
+        self._inner_map = inner_map
+        # Decodes the values of maps which keep them encoded.
+        self._decode = decode
+
+    def __len__(self):
+        """ Returns the number of key-value pairs in the snapshot. """
+        return len(self._inner_map)
+
+    def __getitem__(self, key):
+        """ Returns the value mapped to the input key. Raises KeyError if the
+        key was not found. """
+        if self._decode is not None:
+            return self._decode(self._inner_map[key])
+        return self._inner_map[key]
+
+    def get(self, key, default=None):
+        """ Returns the value mapped to the input key, or the default. """
+        if key not in self._inner_map:
+            return default
+        return self[key]
+
+    def __contains__(self, key):
+        """ Returns true iff the key is present in the snapshot. """
+        return key in self._inner_map
+
+    def __iter__(self):
+        """ Returns an iterator over the keys in the snapshot. """
+        return self.iterkeys()
+
+    def iteritems(self):
+        """ Returns an iterator over the (key, value) pairs in the snapshot. """
+        if self._decode is not None:
+            decode = self._decode
+            return _iterate(self, ((key, decode(stored))
+                for key, stored in self._inner_map.iteritems()))
+        return _iterate(self, self._inner_map.iteritems())
+
+    def iterkeys(self):
+        """ Returns an iterator over the keys in the snapshot. """
+        return _iterate(self, self._inner_map.iterkeys())
+
+    def itervalues(self):
+        """ Returns an iterator over the values in the snapshot. """
+        if self._decode is not None:
+            decode = self._decode
+            return _iterate(self, (decode(stored)
+                for stored in self._inner_map.itervalues()))
+        return _iterate(self, self._inner_map.itervalues())
+
+class ListSnapshot(object):
+    """ A read-only view of a List as it was when the snapshot was taken.
+
+    Elements are shared with the list, so they should not be modified.
+
+    """
+
+    def __init__(self, inner_list):
+        self._inner_list = inner_list
+
+    def __len__(self):
+        """ Returns the number of elements in the snapshot. """
+        return len(self._inner_list)
+
+    def __getitem__(self, index):
+        """ Returns the element at the input index. Raises IndexError if the
+        index is out of range. """
+        return self._inner_list[index]
+
+    def __iter__(self):
+        """ Returns an iterator over the elements in the snapshot. """
+        return _iterate(self, self._inner_list.__iter__())
+
+    def __reversed__(self):
+        """ Returns an iterator over the elements in reverse order. """
+        return _iterate(self, self._inner_list.__reversed__())
+
+    def __contains__(self, element):
+        """ Returns true iff the input element is in the snapshot. """
+        return element in self._inner_list
+
+    def index(self, value):
+        """ Returns the index of the first occurrence of the input value.
+        Raises ValueError if the value was not found. """
+        return self._inner_list.index(value)
+
+def _iterate(view, iterator):
+    # Iterators over a view refer to the view, so that the structure keeps
+    # copying its container before changes for as long as they are in use.
+    for item in iterator:
+        yield item
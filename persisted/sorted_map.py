@@ -0,0 +1,196 @@
+from bisect import bisect_left, bisect_right, insort
+
+from map import Map
+
+# Blocks of the sorted key index are split once they hold twice this many keys.
+_block_size = 512
+
+class SortedMap(Map):
+    """ A persisted map which keeps its keys in order.
+
+    Besides the Map interface, this supports range, prefix and nearest-key
+    queries. Iteration is in key order. The order is kept in an index which is
+    built when the map is opened and updated as keys are added and removed.
+    Keys must be comparable with each other.
+
+    """
+
+    def __init__(self, path_to_backing_file, **map_options):
+        """ Initializes the map using the provided file.
+
+        Args:
+            path_to_backing_file (string):
+                The file at this path will be used to record the state of the
+                map. See Map.__init__.
+            **map_options (object)
+                Keyword arguments passed through to Map.__init__.
+
+        """
+        Map.__init__(self, path_to_backing_file, **map_options)
+        self._keys = _SortedKeys(self._inner_map)
+
+    def __iter__(self):
+        """ Returns an iterator over the keys in the map, in order. """
+        return self._keys.irange()
+
+    def iteritems(self):
+        """ Returns an iterator over the (key, value) pairs in the map, in order
+        of key. """
+        return ((key, self._unpack(self._inner_map[key]))
+            for key in self._keys.irange())
+
+    def iterkeys(self):
+        """ Returns an iterator over the keys in the map, in order. """
+        return self._keys.irange()
+
+    def itervalues(self):
+        """ Returns an iterator over the values in the map, in order of key. """
+        return (self._unpack(self._inner_map[key])
+            for key in self._keys.irange())
+
+    def irange(self, lo=None, hi=None):
+        """ Returns an iterator over the keys in a range, in order.
+
+        Finding the start of the range takes O(log n) time, after which each key
+        is returned in constant time. The map must not be changed during
+        iteration.
+
+        Args:
+            lo (object)
+                The smallest key to return. If None, the range is unbounded
+                below.
+            hi (object)
+                The largest key to return. If None, the range is unbounded
+                above.
+        Returns:
+            keys (iterator of object)
+                The keys k in the map with lo <= k <= hi.
+
+        """
+        return self._keys.irange(lo, hi)
+
+    def prefix(self, prefix):
+        """ Returns an iterator over the string keys which start with the input
+        prefix, in order. See irange. """
+        for key in self._keys.irange(prefix):
+            if not isinstance(key, basestring) or not key.startswith(prefix):
+                return
+            yield key
+
+    def first(self):
+        """ Returns the smallest key. Raises KeyError if the map is empty. """
+        return self._keys.ceiling(None)
+
+    def last(self):
+        """ Returns the largest key. Raises KeyError if the map is empty. """
+        return self._keys.floor(None)
+
+    def floor(self, key):
+        """ Returns the largest key less than or equal to the input key. Raises
+        KeyError if there is none. """
+        return self._keys.floor(key)
+
+    def ceiling(self, key):
+        """ Returns the smallest key greater than or equal to the input key.
+        Raises KeyError if there is none. """
+        return self._keys.ceiling(key)
+
+    def _apply_set(self, key, value):
+        added = key not in self._inner_map
+        obsoletes = Map._apply_set(self, key, value)
+        if added:
+            self._keys.add(key)
+        return obsoletes
+
+    def _apply_delete(self, key):
+        val = Map._apply_delete(self, key)
+        self._keys.remove(key)
+        return val
+
+    def _reload(self):
+        Map._reload(self)
+        self._keys = _SortedKeys(self._inner_map)
+
+class _SortedKeys(object):
+    # A sorted list split into blocks, with the largest key of each block kept
+    # in a separate list. Lookups bisect the block maxima and then one block,
+    # and insertions and deletions only shift the keys within one block.
+
+    def __init__(self, keys):
+        keys = sorted(keys)
+        self._blocks = [keys[start:start + _block_size]
+            for start in range(0, len(keys), _block_size)]
+        self._maxes = [block[-1] for block in self._blocks]
+
+    def add(self, key):
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            return
+        index = bisect_left(self._maxes, key)
+        if index == len(self._maxes):
+            # The key is larger than every other key.
+            index -= 1
+            self._blocks[index].append(key)
+            self._maxes[index] = key
+        else:
+            insort(self._blocks[index], key)
+        block = self._blocks[index]
+        if len(block) > 2 * _block_size:
+            self._blocks[index:index + 1] = \
+                [block[:_block_size], block[_block_size:]]
+            self._maxes[index:index + 1] = [block[_block_size - 1], block[-1]]
+
+    def remove(self, key):
+        index = bisect_left(self._maxes, key)
+        block = self._blocks[index]
+        del block[bisect_left(block, key)]
+        if not block:
+            del self._blocks[index]
+            del self._maxes[index]
+        else:
+            self._maxes[index] = block[-1]
+
+    def irange(self, lo=None, hi=None):
+        index, position = 0, 0
+        if lo is not None:
+            index, position = self._locate(lo, bisect_left)
+        while index < len(self._blocks):
+            block = self._blocks[index]
+            if hi is not None and block[-1] > hi:
+                for key in block[position:bisect_right(block, hi)]:
+                    yield key
+                return
+            for key in block[position:]:
+                yield key
+            index, position = index + 1, 0
+
+    def floor(self, key):
+        # The greatest key <= key, or the largest key if key is None.
+        if key is None:
+            index, position = len(self._blocks), 0
+        else:
+            index, position = self._locate(key, bisect_right)
+        if position > 0:
+            return self._blocks[index][position - 1]
+        if index > 0:
+            return self._blocks[index - 1][-1]
+        raise KeyError(key)
+
+    def ceiling(self, key):
+        # The smallest key >= key, or the smallest key if key is None.
+        if key is None:
+            index, position = 0, 0
+        else:
+            index, position = self._locate(key, bisect_left)
+        if index < len(self._blocks):
+            return self._blocks[index][position]
+        raise KeyError(key)
+
+    def _locate(self, key, bisect):
+        # Returns the block and position at which key would be inserted before
+        # (bisect_left) or after (bisect_right) any equal keys.
+        index = bisect(self._maxes, key)
+        if index == len(self._maxes):
+            return index, 0
+        return index, bisect(self._blocks[index], key)
@@ -0,0 +1,146 @@
+""" Tests for persisted.codec """
+
+from StringIO import StringIO
+import mmap
+import tempfile
+import unittest
+
+from persisted.codec import BATCH, GENERATION, CODEC_JSON, CODEC_BINARY, \
+    BinaryCodec, JSONCodec, TruncatedRecordError, make_codec
+
+def read_all(codec, data):
+    operations = list(codec.read(StringIO(data)))
+    # Reading from a buffer must give the same results.
+    assert list(codec.read_buffer(data)) == operations
+    return operations
+
+class TestCodecs(unittest.TestCase):
+
+    def test_make_codec(self):
+        " Tests that codecs are built from their names. "
+        assert isinstance(make_codec(CODEC_JSON), JSONCodec)
+        assert isinstance(make_codec(CODEC_BINARY), BinaryCodec)
+        codec = BinaryCodec()
+        assert make_codec(codec) is codec
+        self.assertRaises(ValueError, make_codec, "unknown")
+
+    def test_round_trip(self):
+        " Tests that operations survive being encoded and read back. "
+        for codec in [JSONCodec(), BinaryCodec(["set"])]:
+            data = codec.encode(GENERATION, [1, 0]) + \
+                codec.encode("set", ["key", [1, 2.5, None]]) + \
+                codec.encode("unnamed", [])
+            assert read_all(codec, data) == [
+                (GENERATION, [1, 0]),
+                ("set", ["key", [1, 2.5, None]]),
+                ("unnamed", [])]
+
+    def test_batch(self):
+        " Tests that batch records are read back as lists of operations. "
+        for codec in [JSONCodec(), BinaryCodec(["set"])]:
+            batch = codec.encode_batch(
+                [codec.encode("set", ["a", 1]), codec.encode("other", [2])])
+            assert read_all(codec, batch) == \
+                [(BATCH, [("set", ["a", 1]), ("other", [2])])]
+
+    def test_binary_fidelity(self):
+        " Tests that the binary codec preserves tuples and non-string keys. "
+        codec = BinaryCodec()
+        parameters = [(1, "a"), {1: "one"}]
+        assert read_all(codec, codec.encode("op", parameters)) == \
+            [("op", parameters)]
+
+    def test_binary_is_smaller(self):
+        " Tests that named operations take a single byte to identify. "
+        codec = BinaryCodec(["set"])
+        named = codec.encode("set", ["key", "value"])
+        unnamed = BinaryCodec().encode("set", ["key", "value"])
+        assert len(named) < len(unnamed)
+        assert len(named) < len(JSONCodec().encode("set", ["key", "value"]))
+
+    def test_binary_truncated(self):
+        " Tests that truncated binary records are rejected. "
+        codec = BinaryCodec()
+        record = codec.encode("op", ["value"])
+        for length in range(1, len(record)):
+            self.assertRaises(ValueError, read_all, codec, record[:length])
+
+    def test_truncated_offset(self):
+        " Tests that truncated records report where they start. "
+        for codec in [JSONCodec(), BinaryCodec()]:
+            record = codec.encode("op", ["value"])
+            try:
+                read_all(codec, record + record[:-1])
+            except TruncatedRecordError as e:
+                assert e.offset == len(record)
+            else:
+                self.fail("Truncated record was not detected")
+
+    def test_read_buffer_offset(self):
+        " Tests reading a buffer from part way through it. "
+        for codec in [JSONCodec(), BinaryCodec()]:
+            first = codec.encode("op", [1])
+            second = codec.encode("op", [2])
+            assert list(codec.read_buffer(first + second, len(first))) == \
+                [("op", [2])]
+            try:
+                list(codec.read_buffer(first + second[:-1]))
+            except TruncatedRecordError as e:
+                assert e.offset == len(first)
+            else:
+                self.fail("Truncated record was not detected")
+
+    def test_read_mapped_file(self):
+        " Tests reading records from a memory-mapped file. "
+        for codec in [JSONCodec(), BinaryCodec()]:
+            with tempfile.TemporaryFile() as log_file:
+                for i in range(3):
+                    log_file.write(codec.encode("op", [i, "value"]))
+                log_file.flush()
+                data = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    assert list(codec.read_buffer(data)) == \
+                        [("op", [i, "value"]) for i in range(3)]
+                finally:
+                    data.close()
+
+    def test_binary_checksum(self):
+        " Tests that corrupted binary records are rejected. "
+        codec = BinaryCodec()
+        record = codec.encode("op", ["value"])
+        corrupted = record[:-1] + "!"
+        # A corrupted final record may have been torn by a crash.
+        self.assertRaises(TruncatedRecordError, read_all, codec, corrupted)
+        try:
+            read_all(codec, corrupted + record)
+        except TruncatedRecordError:
+            self.fail("Corrupted record was treated as truncated")
+        except ValueError:
+            pass
+        else:
+            self.fail("Corrupted record was not detected")
+
+    def test_split(self):
+        " Tests that buffers are split into independently readable chunks. "
+        for codec in [JSONCodec(), BinaryCodec()]:
+            records = [codec.encode("op", [i, "x" * (i % 7)])
+                for i in range(50)]
+            data = ''.join(records)
+            for chunk_size in [1, 10, 100, len(data)]:
+                chunks = codec.split(data, chunk_size)
+                assert chunks[0][0] == 0 and chunks[-1][1] == len(data)
+                operations = []
+                for (start, end), following in zip(chunks, chunks[1:]):
+                    assert end == following[0]
+                for start, end in chunks:
+                    operations.extend(read_all(codec, data[start:end]))
+                assert operations == [("op", [i, "x" * (i % 7)])
+                    for i in range(50)]
+            # A truncated record stays whole, at the end of the last chunk.
+            chunks = codec.split(data + records[0][:-1], len(records[0]))
+            assert chunks[-1] == (len(data), len(data) + len(records[0]) - 1)
+
+    def test_binary_too_many_names(self):
+        " Tests that opcodes must fit in a byte. "
+        self.assertRaises(ValueError, BinaryCodec, map(str, range(254)))
+        BinaryCodec(map(str, range(253)))
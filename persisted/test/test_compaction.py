@@ -0,0 +1,53 @@
+""" Tests for persisted.compaction """
+
+import unittest
+
+from persisted.compaction import GarbageRatioPolicy, ThresholdPolicy
+from persisted.log import LogStats
+
+def make_stats(size, dead_bytes, live_records=1, dead_records=1):
+    stats = LogStats()
+    stats.size = size
+    stats.dead_bytes = dead_bytes
+    stats.live_records = live_records
+    stats.dead_records = dead_records
+    return stats
+
+class TestThresholdPolicy(unittest.TestCase):
+
+    def test_should_compact(self):
+        " Tests that logs are compacted once they reach the threshold. "
+        policy = ThresholdPolicy(threshold=100)
+        assert not policy.should_compact(make_stats(99, 0))
+        assert policy.should_compact(make_stats(100, 0))
+
+    def test_compacted(self):
+        " Tests that the threshold is raised if compaction did not help. "
+        policy = ThresholdPolicy(threshold=100)
+        policy.compacted(make_stats(50, 0))
+        assert policy.threshold == 100
+        policy.compacted(make_stats(150, 0))
+        assert policy.threshold == 300
+
+class TestGarbageRatioPolicy(unittest.TestCase):
+
+    def test_min_size(self):
+        " Tests that small logs are never compacted. "
+        policy = GarbageRatioPolicy(min_size=1000)
+        assert not policy.should_compact(make_stats(999, 900))
+        assert policy.should_compact(make_stats(1000, 900))
+
+    def test_ratio(self):
+        " Tests that logs are compacted once they hold enough garbage. "
+        policy = GarbageRatioPolicy(max_dead_ratio=0.5, min_size=0)
+        assert not policy.should_compact(make_stats(1000, 300))
+        assert policy.should_compact(make_stats(1000, 400))
+
+    def test_max_size(self):
+        " Tests that large logs are compacted regardless of the ratio. "
+        policy = GarbageRatioPolicy(min_size=0, max_size=1000)
+        assert not policy.should_compact(make_stats(999, 1))
+        assert policy.should_compact(make_stats(1000, 1))
+        # Logs with no garbage at all are never compacted.
+        assert not policy.should_compact(
+            make_stats(1000, 0, dead_records=0))
@@ -0,0 +1,106 @@
+""" Tests for persisted.DiskMap """
+
+import tempfile
+import unittest
+
+from persisted import CODEC_BINARY, DiskMap, Map, ThresholdPolicy
+
+class TestDiskMap(unittest.TestCase):
+
+    def test_set_get_delete(self):
+        " Tests the dict-like interface of the map. "
+        test_map = DiskMap(tempfile.NamedTemporaryFile().name)
+        test_map["a"] = 1
+        test_map["b"] = [1, 2]
+        test_map["a"] = 3
+        assert len(test_map) == 2 and "a" in test_map
+        assert test_map["a"] == 3 and test_map["b"] == [1, 2]
+        assert del_item(test_map, "b") == [1, 2]
+        assert "b" not in test_map
+        self.assertRaises(KeyError, test_map.__getitem__, "b")
+        self.assertRaises(KeyError, del_item, test_map, "b")
+        assert dict(test_map.iteritems()) == {"a": 3}
+        assert list(test_map) == list(test_map.iterkeys()) == ["a"]
+        assert list(test_map.itervalues()) == [3]
+
+    def test_init_existing(self):
+        " Tests that only the directory is loaded on open. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = DiskMap(path)
+        for i in range(100):
+            test_map[i % 10] = i
+        del test_map[0]
+        test_map.close()
+        reloaded = DiskMap(path)
+        assert not reloaded._cache
+        assert dict(reloaded.iteritems()) == \
+            dict((i, 90 + i) for i in range(1, 10))
+        assert reloaded == DiskMap(path)
+
+    def test_cache_bounded(self):
+        " Tests that at most cache_size values are kept in memory. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = DiskMap(path, cache_size=5, codec=CODEC_BINARY)
+        for i in range(50):
+            test_map[i] = {"value": i}
+        assert len(test_map._cache) == 5
+        for i in range(50):
+            assert test_map[i] == {"value": i}
+        assert list(test_map._cache) == range(45, 50)
+        # Reads make a value the most recently used.
+        test_map[45]
+        assert list(test_map._cache) == range(46, 50) + [45]
+
+    def test_compaction(self):
+        " Tests that values are found again after compaction moves them. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = DiskMap(path, cache_size=0, group_commit_size=10,
+            compaction_policy=ThresholdPolicy(2000))
+        for i in range(500):
+            test_map[i % 20] = i
+        assert test_map._log.generation > 0
+        assert dict(test_map.iteritems()) == \
+            dict((i, 480 + i) for i in range(20))
+        test_map.close()
+        assert dict(DiskMap(path).iteritems()) == \
+            dict((i, 480 + i) for i in range(20))
+
+    def test_batch(self):
+        " Tests that values set in a batch can be read before it is saved. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = DiskMap(path, cache_size=0)
+        test_map["a"] = 0
+        with test_map.batch():
+            test_map["a"] = 1
+            test_map["b"] = 2
+            assert test_map["a"] == 1 and test_map["b"] == 2
+            test_map._log.compact()
+            test_map["c"] = 3
+        assert dict(test_map.iteritems()) == {"a": 1, "b": 2, "c": 3}
+        test_map.close()
+        assert dict(DiskMap(path).iteritems()) == \
+            {"a": 1, "b": 2, "c": 3}
+
+    def test_opens_map_files(self):
+        " Tests that maps and disk maps can open each other's files. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = Map(path)
+        for i in range(2500):
+            test_map[str(i)] = i
+        test_map.close()
+        # Opening the map compacted it into a snapshot of chunked records.
+        Map(path).close()
+        disk_map = DiskMap(path, cache_size=0)
+        assert disk_map["1234"] == 1234 and len(disk_map) == 2500
+        disk_map["x"] = "y"
+        disk_map._log.compact()
+        disk_map.close()
+        assert Map(path)["x"] == "y"
+
+    def test_segmented_unsupported(self):
+        " Tests that segmented logs are rejected. "
+        self.assertRaises(ValueError, DiskMap,
+            tempfile.NamedTemporaryFile().name, segment_size=1000)
+
+def del_item(test_map, key):
+    return test_map.__delitem__(key)
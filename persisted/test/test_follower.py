@@ -0,0 +1,77 @@
+""" Tests for persisted.Follower """
+
+import multiprocessing
+import tempfile
+import time
+import unittest
+
+from persisted import Follower, Map
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.01)
+
+def write_pages(path, pages):
+    # Runs in a writer process. Reopening the map compacts it part way.
+    for start in range(0, pages, pages / 2):
+        writer = Map(path)
+        for i in range(start, start + pages / 2):
+            writer[str(i)] = {"title" : "Page %d" % i}
+        writer.close()
+
+class TestFollower(unittest.TestCase):
+
+    def test_follow(self):
+        " Tests that followed maps see appends, compactions and reloads. "
+        path = tempfile.NamedTemporaryFile().name
+        writer = Map(path)
+        writer["a"] = 1
+        reader = Map(path, read_only=True, indexes={"odd" : lambda v: v % 2})
+        follower = Follower(reader, interval=0.01)
+        writer["b"] = 2
+        wait_until(lambda: "b" in reader)
+        generation = reader._log.generation
+        writer._log.compact()
+        del writer["a"]
+        writer["c"] = 3
+        wait_until(lambda: "a" not in reader and "c" in reader)
+        # The map was reloaded rather than read past the compaction.
+        assert reader._log.generation == generation + 1
+        assert dict(reader.iteritems()) == {"b" : 2, "c" : 3}
+        assert reader.lookup("odd", 1) == frozenset(["c"])
+        follower.stop()
+        assert not follower.following
+        writer["d"] = 4
+        follower.poll()
+        assert "d" in reader
+        reader.close()
+        writer.close()
+
+    def test_follow_writer_process(self):
+        " Tests following a map written by another process. "
+        path = tempfile.NamedTemporaryFile().name
+        Map(path).close()
+        reader = Map(path, read_only=True)
+        follower = Follower(reader, interval=0.01)
+        writer = multiprocessing.Process(target=write_pages, args=(path, 200))
+        writer.start()
+        writer.join()
+        wait_until(lambda: len(reader) == 200)
+        follower.stop()
+        assert reader["199"] == {"title" : "Page 199"}
+        reader.close()
+
+    def test_follow_error(self):
+        " Tests that a follower stops once a refresh fails. "
+        path = tempfile.NamedTemporaryFile().name
+        Map(path).close()
+        reader = Map(path, read_only=True)
+        follower = Follower(reader, interval=0.01)
+        with open(path, 'ab') as backing_file:
+            backing_file.write("not a record\n")
+        wait_until(lambda: not follower.following)
+        self.assertRaises(ValueError, follower.stop)
+        reader.close()
@@ -1,9 +1,11 @@
 """ Tests for persisted.list.List """
 
+import sys
 import tempfile
+import threading
 import unittest
 
-from persisted import List
+from persisted import DURABILITY_NONE, List
 
 class TestList(unittest.TestCase):
 
@@ -213,3 +215,93 @@ class TestList(unittest.TestCase):
         assert test_list.__contains__(1)
         assert not "someOtherElement" in test_list
         assert not test_list.__contains__("someOtherElement")
+
+    def test_replay_every_operation(self):
+        " Tests that every list operation is replayed correctly. "
+        existing_list = List(tempfile.NamedTemporaryFile().name)
+        for i in range(5):
+            existing_list.append(i)
+        existing_list.push("pushed")
+        existing_list[1] = "set"
+        del existing_list[2]
+        existing_list.remove(3)
+        existing_list.pop()
+        loaded_list = List(existing_list._log._backing_file)
+        assert loaded_list == existing_list
+        assert list(loaded_list) == ["pushed", "set", 2]
+
+    def test_init_from_snapshot(self):
+        " Tests that a list larger than one snapshot record is reloaded. "
+        existing_list = List(tempfile.NamedTemporaryFile().name)
+        for i in range(2500):
+            existing_list.append(i)
+        # The first load writes the snapshot, the second reads it.
+        for _ in range(2):
+            loaded_list = List(existing_list._log._backing_file)
+            assert loaded_list == existing_list
+
+    def test_snapshot(self):
+        " Tests that snapshots are unaffected by later changes. "
+        test_list = List(tempfile.NamedTemporaryFile().name)
+        for i in range(5):
+            test_list.append(i)
+        snapshot = test_list.snapshot()
+        elements = iter(snapshot)
+        test_list.append(5)
+        test_list[0] = "changed"
+        test_list.pop()
+        test_list.push(-1)
+        assert list(elements) == range(5)
+        assert list(reversed(snapshot)) == range(4, -1, -1)
+        assert snapshot[1:3] == [1, 2] and snapshot.index(3) == 3
+        assert list(test_list) == [-1, "changed", 1, 2, 3, 4]
+
+    def test_snapshot_threads(self):
+        " Tests taking snapshots on one thread while another changes the list. "
+        test_list = List(tempfile.NamedTemporaryFile().name,
+            durability=DURABILITY_NONE)
+        errors = []
+        done = threading.Event()
+
+        def read():
+            try:
+                while not done.is_set():
+                    snapshot = test_list.snapshot()
+                    elements = list(snapshot)
+                    assert list(snapshot) == elements
+            except Exception as e:
+                errors.append(e)
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        # Switch threads as often as possible, to hit the races.
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for i in range(5000):
+                test_list.append(i)
+                if i % 3 == 0:
+                    test_list.pop()
+        finally:
+            sys.setcheckinterval(check_interval)
+            done.set()
+            reader.join()
+        assert not errors, errors
+
+    def test_read_only(self):
+        " Tests that read-only lists pick up changes made by a writer. "
+        writer = List(tempfile.NamedTemporaryFile().name)
+        writer.append(0)
+        reader = List(writer._log._backing_file, read_only=True)
+        self.assertRaises(IOError, reader.pop)
+        assert list(reader) == [0]
+        writer.push(-1)
+        writer.pop()
+        reader.refresh()
+        assert list(reader) == [-1]
+        writer._log.compact()
+        writer.append(1)
+        reader.refresh()
+        assert reader == writer
+        reader.close()
+        writer.close()
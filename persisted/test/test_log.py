@@ -4,13 +4,22 @@ import os
 import random
 import string
 import tempfile
+import threading
+import time
 import unittest
 
-from persisted.log import Log
+from persisted.codec import CODEC_BINARY, CODEC_JSON
+from persisted.compaction import ThresholdPolicy
+from persisted.log import Log, DURABILITY_NONE, DURABILITY_FSYNC, \
+    DURABILITY_FSYNC_INTERVAL, LOCKING_COORDINATED, LOCKING_EXCLUSIVE
 
 # Used in tests which don't care about compaction.
 dummy_compaction_callback = lambda: []
 
+def keyed_record(op_name, parameters):
+    # A record_key function for tests of segmented logs.
+    return parameters[0], op_name != "delete"
+
 
 class DummyOperation():
     """ A dummy operation for testing the log. """
@@ -97,6 +106,16 @@ class TestLog(unittest.TestCase):
             return
         raise Exception("Init call on corrupted file should have failed")
 
+    def test_init_malformed_record(self):
+        " Tests initialization from a JSON record missing its fields. "
+        backing_file = tempfile.NamedTemporaryFile()
+        backing_file.write('{"key": "op", "parameters": [0]}\n')
+        backing_file.write('{"kez": "op", "parameters": [1]}\n')
+        backing_file.write('["op", [2]]\n')
+        backing_file.flush()
+        self.assertRaises(ValueError, Log, backing_file.name,
+            dummy_compaction_callback)
+
     def test_init_bad_permissions(self):
         """ Tests initialization from a file without read/write permissions. """
         backing_file = tempfile.NamedTemporaryFile()
@@ -144,6 +163,17 @@ class TestLog(unittest.TestCase):
         for dummy_op in dummy_ops:
             assert dummy_op.function_called
 
+    def test_save_and_replay_unflushed(self):
+        " Tests that operations left in Python's buffer are replayed. "
+        log = Log(tempfile.NamedTemporaryFile().name,
+            dummy_compaction_callback, durability=DURABILITY_NONE)
+        for i in range(10):
+            log.save_operation("op", i)
+        calls = []
+        log.replay({"op" : calls.append})
+        assert calls == range(10)
+        assert len(list(log.scan())) == 10
+
     def test_compact(self):
         " Tests that compaction reduces log file size when possible. "
         operation = DummyOperation()
@@ -166,14 +196,15 @@ class TestLog(unittest.TestCase):
         operation = DummyOperation()
         backing_file = tempfile.NamedTemporaryFile()
         compaction_callback = lambda: [(operation.name, operation.parameters)]
-        log = Log(backing_file.name, compaction_callback)
+        log = Log(backing_file.name, compaction_callback,
+            compaction_policy=ThresholdPolicy())
         # Save the same operation many times.
         for _ in range(100):
             log.save_operation(operation.name, *operation.parameters)
         # Set the compaction threshold to less than the current size of the backing
         # file.
         original_size = os.stat(log._backing_file).st_size
-        log._compaction_threshold = original_size - 1
+        log._compaction_policy.threshold = original_size - 1
         # Save an operation to trigger compaction.
         log.save_operation(operation.name, *operation.parameters)
         compacted_size = os.stat(log._backing_file).st_size
@@ -181,7 +212,7 @@ class TestLog(unittest.TestCase):
         assert compacted_size > 0
         # Now check that the log never goes over the threshold over the course of
         # many saves.
-        threshold = log._compaction_threshold
+        threshold = log._compaction_policy.threshold
         for _ in range(1000):
             log.save_operation(operation.name, *operation.parameters)
             current_size = os.stat(log._backing_file).st_size
@@ -194,12 +225,613 @@ class TestLog(unittest.TestCase):
         elements = []
         backing_file = tempfile.NamedTemporaryFile()
         compaction_callback = lambda: [(operation_name, i) for i in elements]
-        log = Log(backing_file.name, compaction_callback)
+        log = Log(backing_file.name, compaction_callback,
+            compaction_policy=ThresholdPolicy())
         # Set the threshold to be 1 KB so we don't have to add quite so many
         # elements.
-        log._compaction_threshold = 1024
-        original_threshold = log._compaction_threshold
+        log._compaction_policy.threshold = 1024
+        original_threshold = log._compaction_policy.threshold
         for i in range(0, 100):
             elements.append(i)
             log.save_operation(operation_name, i)
-        assert log._compaction_threshold > original_threshold
+        assert log._compaction_policy.threshold > original_threshold
+
+    def test_group_commit_size(self):
+        " Tests that buffered operations are written together. "
+        operation = DummyOperation()
+        log = Log(tempfile.NamedTemporaryFile().name, dummy_compaction_callback,
+            group_commit_size=5)
+        for _ in range(4):
+            log.save_operation(operation.name, *operation.parameters)
+        # Nothing should have been written yet.
+        assert os.stat(log._backing_file).st_size == 0
+        log.save_operation(operation.name, *operation.parameters)
+        assert len(open(log._backing_file).readlines()) == 5
+
+    def test_group_commit_interval(self):
+        " Tests that buffered operations are written once the interval passes. "
+        operation = DummyOperation()
+        log = Log(tempfile.NamedTemporaryFile().name, dummy_compaction_callback,
+            group_commit_size=100, group_commit_interval=0.01)
+        log.save_operation(operation.name, *operation.parameters)
+        log.save_operation(operation.name, *operation.parameters)
+        deadline = time.time() + 5
+        while os.stat(log._backing_file).st_size == 0:
+            if time.time() > deadline:
+                self.fail("Buffered operations were never written")
+            time.sleep(0.01)
+        assert len(open(log._backing_file).readlines()) == 2
+
+    def test_close(self):
+        " Tests that closing the log writes out buffered operations. "
+        operation = DummyOperation()
+        log = Log(tempfile.NamedTemporaryFile().name, dummy_compaction_callback,
+            group_commit_size=100)
+        for _ in range(3):
+            log.save_operation(operation.name, *operation.parameters)
+        log.close()
+        assert len(open(log._backing_file).readlines()) == 3
+
+    def test_durability_unknown(self):
+        " Tests that unknown durability modes are rejected. "
+        try:
+            Log(tempfile.NamedTemporaryFile().name, dummy_compaction_callback,
+                durability="sometimes")
+        except ValueError:
+            return
+        self.fail("Init call with unknown durability mode should have failed")
+
+    def test_durability_modes(self):
+        " Tests that operations survive in every durability mode. "
+        operation = DummyOperation()
+        for durability in [DURABILITY_NONE, DURABILITY_FSYNC,
+                DURABILITY_FSYNC_INTERVAL]:
+            log = Log(tempfile.NamedTemporaryFile().name,
+                dummy_compaction_callback, durability=durability)
+            for _ in range(3):
+                log.save_operation(operation.name, *operation.parameters)
+            log.close()
+            assert len(open(log._backing_file).readlines()) == 3
+
+    def test_durability_fsync_ops(self):
+        " Tests that the background thread syncs after enough operations. "
+        operation = DummyOperation()
+        log = Log(tempfile.NamedTemporaryFile().name, dummy_compaction_callback,
+            durability=DURABILITY_FSYNC_INTERVAL, fsync_interval=60,
+            fsync_ops=5)
+        for _ in range(5):
+            log.save_operation(operation.name, *operation.parameters)
+        deadline = time.time() + 5
+        while log._unsynced_ops:
+            if time.time() > deadline:
+                self.fail("Background sync never ran")
+            time.sleep(0.01)
+        log.close()
+        assert not log._sync_thread.is_alive()
+
+    def test_encode_and_save_record(self):
+        " Tests that encoded records can be saved and replayed. "
+        log = Log(
+            tempfile.NamedTemporaryFile().name, dummy_compaction_callback)
+        dummy_op = DummyOperation()
+        record = log.encode_operation(dummy_op.name, *dummy_op.parameters)
+        log.save_record(record)
+        assert open(log._backing_file).read() == record
+        log.replay({dummy_op.name : dummy_op.get_function()})
+        assert dummy_op.function_called
+        # Encoding should fail for objects which are not JSON encodable.
+        self.assertRaises(TypeError, log.encode_operation, "op", object())
+
+    def test_replay_validates(self):
+        " Tests that replay rejects malformed records when init did not. "
+        backing_file = tempfile.NamedTemporaryFile()
+        backing_file.write('{"key": "op", "parameters": []}\n')
+        backing_file.write("ooga booga I'm corrupted data\n")
+        backing_file.flush()
+        log = Log(backing_file.name, dummy_compaction_callback, validate=False)
+        calls = []
+        self.assertRaises(
+            ValueError, log.replay, {"op" : lambda: calls.append(True)})
+        # The record preceding the corrupted one was still replayed.
+        assert calls == [True]
+
+    def test_compact_writes_snapshot(self):
+        " Tests that compaction moves the log's state into a snapshot. "
+        operation = DummyOperation()
+        compaction_callback = lambda: [(operation.name, operation.parameters)]
+        log = Log(tempfile.NamedTemporaryFile().name, compaction_callback)
+        for _ in range(10):
+            log.save_operation(operation.name, *operation.parameters)
+        log.compact()
+        assert os.path.exists(log._snapshot_file)
+        log.save_operation(operation.name, *operation.parameters)
+        # Both the snapshot and the tail are replayed.
+        calls = []
+        reopened_log = Log(log._backing_file, compaction_callback)
+        reopened_log.replay({operation.name : lambda *args: calls.append(args)})
+        assert len(calls) == 2
+
+    def test_stale_tail(self):
+        " Tests that a tail already folded into the snapshot is discarded. "
+        operation = DummyOperation()
+        compaction_callback = lambda: [(operation.name, operation.parameters)]
+        log = Log(tempfile.NamedTemporaryFile().name, compaction_callback)
+        for _ in range(10):
+            log.save_operation(operation.name, *operation.parameters)
+        old_tail = open(log._backing_file).read()
+        log.compact()
+        # Simulate a crash between writing the snapshot and resetting the tail.
+        with open(log._backing_file, 'w') as tail:
+            tail.write(old_tail)
+        calls = []
+        reopened_log = Log(log._backing_file, compaction_callback)
+        reopened_log.replay({operation.name : lambda *args: calls.append(args)})
+        assert len(calls) == 1
+
+    def test_missing_snapshot(self):
+        " Tests that a tail whose snapshot has gone missing is rejected. "
+        operation = DummyOperation()
+        compaction_callback = lambda: [(operation.name, operation.parameters)]
+        log = Log(tempfile.NamedTemporaryFile().name, compaction_callback)
+        log.save_operation(operation.name, *operation.parameters)
+        log.compact()
+        os.remove(log._snapshot_file)
+        self.assertRaises(
+            ValueError, Log, log._backing_file, compaction_callback)
+
+    def test_background_compaction(self):
+        " Tests that operations saved during a background compaction are kept. "
+        operation = DummyOperation()
+        resume = threading.Event()
+        def compaction_callback():
+            # Hold the compaction up until we have saved some more operations.
+            def records():
+                resume.wait()
+                yield (operation.name, operation.parameters)
+            return records()
+        log = Log(tempfile.NamedTemporaryFile().name, compaction_callback,
+            background_compaction=True,
+            compaction_policy=ThresholdPolicy(threshold=float("inf")))
+        for _ in range(10):
+            log.save_operation(operation.name, *operation.parameters)
+        log._compaction_policy.threshold = 1
+        log.save_operation(operation.name, *operation.parameters)
+        # The compaction is now waiting on the background thread.
+        for _ in range(3):
+            log.save_operation(operation.name, *operation.parameters)
+        resume.set()
+        log._wait_for_compaction()
+        assert log._generation == 1
+        calls = []
+        reopened_log = Log(log._backing_file, compaction_callback)
+        reopened_log.replay({operation.name : lambda *args: calls.append(args)})
+        # One operation from the snapshot and three from the tail.
+        assert len(calls) == 4
+
+    def test_background_compaction_crash(self):
+        " Tests recovery when we crash before the new tail is swapped in. "
+        operation = DummyOperation()
+        compaction_callback = lambda: [(operation.name, operation.parameters)]
+        log = Log(tempfile.NamedTemporaryFile().name, compaction_callback)
+        for _ in range(10):
+            log.save_operation(operation.name, *operation.parameters)
+        covered = log._size - log._snapshot_size
+        # Write a snapshot covering the tail so far, but leave the tail as is.
+        log._write_snapshot(compaction_callback(), covered)
+        for _ in range(3):
+            log.save_operation(operation.name, *operation.parameters)
+        calls = []
+        reopened_log = Log(log._backing_file, compaction_callback)
+        reopened_log.replay({operation.name : lambda *args: calls.append(args)})
+        assert len(calls) == 4
+
+    def test_compact_streams_callback(self):
+        " Tests that compaction consumes a generator and leaves no temp files. "
+        operation = DummyOperation()
+        def compaction_callback():
+            for _ in range(3):
+                yield (operation.name, operation.parameters)
+        log = Log(tempfile.NamedTemporaryFile().name, compaction_callback)
+        log.save_operation(operation.name, *operation.parameters)
+        log.compact()
+        assert not os.path.exists(log._snapshot_file + ".tmp")
+        assert not os.path.exists(log._backing_file + ".tmp")
+        calls = []
+        log.replay({operation.name : lambda *args: calls.append(args)})
+        assert len(calls) == 3
+
+    def test_batch(self):
+        " Tests that a batch of operations is written as one record. "
+        log = Log(
+            tempfile.NamedTemporaryFile().name, dummy_compaction_callback)
+        dummy_ops = [DummyOperation() for _ in range(5)]
+        with log.batch():
+            for dummy_op in dummy_ops:
+                log.save_operation(dummy_op.name, *dummy_op.parameters)
+            # Nothing is written until the batch is done.
+            assert os.stat(log._backing_file).st_size == 0
+        assert len(open(log._backing_file).readlines()) == 1
+        log.replay(dict((dummy_op.name, dummy_op.get_function())
+            for dummy_op in dummy_ops))
+        for dummy_op in dummy_ops:
+            assert dummy_op.function_called
+
+    def test_batch_torn(self):
+        " Tests that no part of a torn batch is replayed. "
+        log = Log(
+            tempfile.NamedTemporaryFile().name, dummy_compaction_callback)
+        log.save_operation("op", 0)
+        size_before_batch = os.stat(log._backing_file).st_size
+        with log.batch():
+            log.save_operation("op", 1)
+            with log.batch():
+                log.save_operation("op", 2)
+            log.save_operation("op", 3)
+        # Cut the batch record in half.
+        size = os.stat(log._backing_file).st_size
+        with open(log._backing_file, 'r+') as backing_file:
+            backing_file.truncate((size_before_batch + size) / 2)
+        calls = []
+        reopened_log = Log(log._backing_file, dummy_compaction_callback,
+            validate=False)
+        self.assertRaises(ValueError, reopened_log.replay,
+            {"op" : lambda *args: calls.append(args)})
+        assert calls == [(0,)]
+
+    def test_parallel_replay(self):
+        " Tests that replaying in parallel matches replaying serially. "
+        for codec in [CODEC_JSON, CODEC_BINARY]:
+            path = tempfile.NamedTemporaryFile().name
+            log = Log(path, dummy_compaction_callback, codec=codec)
+            for i in range(200):
+                if i % 10 == 0:
+                    with log.batch():
+                        log.save_operation("op", i, "batched")
+                        log.save_operation("other", [i])
+                else:
+                    log.save_operation("op", i, "x" * (i % 13))
+            log.close()
+            replayed = []
+            for processes in [None, 3]:
+                calls = []
+                reopened_log = Log(path, dummy_compaction_callback,
+                    codec=codec, replay_processes=processes,
+                    replay_chunk_size=256)
+                reopened_log.replay({
+                    "op" : lambda *args: calls.append(("op", args)),
+                    "other" : lambda *args: calls.append(("other", args))})
+                reopened_log.close()
+                replayed.append(calls)
+            assert len(replayed[0]) == 220
+            assert replayed[0] == replayed[1]
+
+    def test_parallel_replay_validates(self):
+        " Tests that a parallel replay stops at the first malformed record. "
+        backing_file = tempfile.NamedTemporaryFile()
+        for i in range(100):
+            backing_file.write('{"key": "op", "parameters": [%d]}\n' % i)
+        backing_file.write("ooga booga I'm corrupted data\n")
+        for i in range(100):
+            backing_file.write('{"key": "op", "parameters": [%d]}\n' % i)
+        backing_file.flush()
+        log = Log(backing_file.name, dummy_compaction_callback,
+            validate=False, replay_processes=2, replay_chunk_size=512)
+        calls = []
+        self.assertRaises(ValueError, log.replay, {"op" : calls.append})
+        assert calls == range(100)
+
+    def test_torn_record_truncated(self):
+        " Tests that a record torn by a crash is discarded on open. "
+        for codec in [CODEC_JSON, CODEC_BINARY]:
+            log = Log(tempfile.NamedTemporaryFile().name,
+                dummy_compaction_callback, codec=codec)
+            log.save_operation("op", 0)
+            size = os.stat(log._backing_file).st_size
+            log.save_operation("op", 1)
+            # Cut the second record short, as a crash mid-write would.
+            with open(log._backing_file, 'r+') as backing_file:
+                backing_file.truncate(size + 3)
+            reopened_log = Log(log._backing_file, dummy_compaction_callback,
+                codec=codec)
+            assert os.stat(log._backing_file).st_size == size
+            calls = []
+            reopened_log.replay({"op" : lambda *args: calls.append(args)})
+            assert calls == [(0,)]
+            # New records are written after the last intact one.
+            reopened_log.save_operation("op", 2)
+            calls = []
+            reopened_log.replay({"op" : lambda *args: calls.append(args)})
+            assert calls == [(0,), (2,)]
+
+    def test_torn_record_checked(self):
+        " Tests that only what could be a torn last write is discarded. "
+        for codec, fragment in [(CODEC_JSON, 'not a record'),
+                (CODEC_BINARY, '\0' * 12)]:
+            log = Log(tempfile.NamedTemporaryFile().name,
+                dummy_compaction_callback, codec=codec)
+            log.save_operation("op", 0)
+            with open(log._backing_file, 'ab') as backing_file:
+                backing_file.write(fragment)
+            size = os.stat(log._backing_file).st_size
+            self.assertRaises(ValueError, Log, log._backing_file,
+                dummy_compaction_callback, codec=codec)
+            assert os.stat(log._backing_file).st_size == size
+        # The first write to a new log can be torn at the start of the file.
+        for codec in [CODEC_JSON, CODEC_BINARY]:
+            log = Log(tempfile.NamedTemporaryFile().name,
+                dummy_compaction_callback, codec=codec)
+            record = log.encode_operation("op", 0)
+            with open(log._backing_file, 'wb') as backing_file:
+                backing_file.write(record[:len(record) / 2])
+            reopened_log = Log(log._backing_file, dummy_compaction_callback,
+                codec=codec)
+            assert os.stat(log._backing_file).st_size == 0
+            reopened_log.save_operation("op", 1)
+            calls = []
+            reopened_log.replay({"op" : calls.append})
+            assert calls == [1]
+
+    def test_codec_mismatch(self):
+        " Tests that a log opened with another codec is left untouched. "
+        for codec, other_codec in [(CODEC_BINARY, CODEC_JSON),
+                (CODEC_JSON, CODEC_BINARY)]:
+            # The log is not closed, so its tail is unsealed.
+            log = Log(tempfile.NamedTemporaryFile().name,
+                lambda: [("op", [0])], codec=codec)
+            log.save_operation("op", 0)
+            size = os.stat(log._backing_file).st_size
+            for read_only in [False, True]:
+                with self.assertRaises(ValueError) as raised:
+                    # Read-only logs read their files when replayed.
+                    Log(log._backing_file, dummy_compaction_callback,
+                        codec=other_codec, read_only=read_only).replay(
+                        {"op" : id})
+                assert raised.exception.args[0] == \
+                    "Log was written with another codec"
+                assert os.stat(log._backing_file).st_size == size
+            # Once compacted, the files' headers name the codec.
+            log.compact()
+            log.save_operation("op", 1)
+            with self.assertRaises(ValueError) as raised:
+                Log(log._backing_file, dummy_compaction_callback,
+                    codec=other_codec)
+            assert raised.exception.args[2] == codec
+            log.close()
+
+    def test_sealed_tail_trusted(self):
+        " Tests that only the tail written since a clean close is checked. "
+        log = Log(tempfile.NamedTemporaryFile().name, dummy_compaction_callback,
+            codec=CODEC_BINARY)
+        log.save_operation("op", "value")
+        log.save_operation("op", "value")
+        log.close()
+        # Corrupt the last sealed record. Opening does not read it, so this goes
+        # unnoticed until the log is replayed.
+        with open(log._backing_file, 'r+') as backing_file:
+            backing_file.seek(-1, os.SEEK_END)
+            backing_file.write("!")
+        reopened_log = Log(log._backing_file, dummy_compaction_callback,
+            codec=CODEC_BINARY)
+        self.assertRaises(ValueError, reopened_log.replay, {"op" : id})
+        # Records written after the seal are checked.
+        size = os.stat(log._backing_file).st_size
+        reopened_log.save_operation("op", "value")
+        reopened_log.save_operation("op", "value")
+        with open(log._backing_file, 'r+') as backing_file:
+            backing_file.seek(size + 10)
+            backing_file.write("!")
+        self.assertRaises(ValueError, Log, log._backing_file,
+            dummy_compaction_callback, codec=CODEC_BINARY)
+
+    def test_seal_ignored_after_compaction(self):
+        " Tests that a seal from an earlier generation is not trusted. "
+        log = Log(tempfile.NamedTemporaryFile().name,
+            lambda: [("op", [0])])
+        log.save_operation("op", 0)
+        log.close()
+        reopened_log = Log(log._backing_file, lambda: [("op", [0])])
+        reopened_log.save_operation("op", 1)
+        reopened_log.compact()
+        assert reopened_log._read_seal() == 0
+
+    def test_segments_rotate(self):
+        " Tests that the tail is sealed into segments as it grows. "
+        log = Log(tempfile.NamedTemporaryFile().name, dummy_compaction_callback,
+            segment_size=100, record_key=keyed_record,
+            compaction_policy=ThresholdPolicy(float("inf")))
+        for i in range(20):
+            log.save_operation("set", i, i)
+        assert len(log._segments) > 1
+        for segment in log._segments:
+            assert os.path.exists(segment.path)
+            assert segment.size >= 100
+        assert os.stat(log._backing_file).st_size < 100
+        log.close()
+        reopened_log = Log(log._backing_file, dummy_compaction_callback,
+            segment_size=100, record_key=keyed_record)
+        calls = []
+        reopened_log.replay({"set" : lambda *args: calls.append(args)})
+        assert calls == [(i, i) for i in range(20)]
+
+    def test_segments_merge(self):
+        " Tests that merging segments drops overwritten records. "
+        log = Log(tempfile.NamedTemporaryFile().name, dummy_compaction_callback,
+            segment_size=100, record_key=keyed_record,
+            compaction_policy=ThresholdPolicy(float("inf")))
+        for i in range(50):
+            log.save_operation("set", i % 5, i)
+        log.save_operation("delete", 0)
+        for i in range(50):
+            log.save_operation("set", 1, i)
+        segments_size = log._segments_size
+        log.compact()
+        assert log._segments_size < segments_size
+        # Merges only ever write about one segment's worth of records.
+        for segment in log._segments:
+            assert segment.size < 200
+        # Deletions may outlive the records they deleted.
+        state = {}
+        log.replay({"set" : state.__setitem__,
+            "delete" : lambda key: state.pop(key, None)})
+        assert state == {1: 49, 2: 47, 3: 48, 4: 49}
+        sets = [params[0] for op_name, params in
+            log._read_window(log._segments) if op_name == "set"]
+        assert 0 not in sets
+        assert len(sets) < 20
+
+    def test_segments_merge_interrupted(self):
+        " Tests that a crash while deleting merged segments loses nothing. "
+        log = Log(tempfile.NamedTemporaryFile().name, dummy_compaction_callback,
+            segment_size=100, record_key=keyed_record,
+            compaction_policy=ThresholdPolicy(float("inf")))
+        for i in range(50):
+            log.save_operation("set", i % 3, i)
+        originals = dict((segment.path, open(segment.path).read())
+            for segment in log._segments)
+        log.compact()
+        # Put back the segments which were merged, as if we had crashed just
+        # after writing the merge's output.
+        for path, contents in originals.items():
+            with open(path, 'w') as segment:
+                segment.write(contents)
+        log.close()
+        reopened_log = Log(log._backing_file, dummy_compaction_callback,
+            segment_size=100, record_key=keyed_record)
+        state = {}
+        reopened_log.replay({"set" : state.__setitem__})
+        assert state == {0: 48, 1: 49, 2: 47}
+        reopened_log.compact()
+        # Only the segment holding the latest value of each key is left.
+        assert len(reopened_log._segments) == 1
+
+    def test_segments_folded_into_snapshot(self):
+        " Tests that an unsegmented log folds segments into its snapshot. "
+        log = Log(tempfile.NamedTemporaryFile().name, dummy_compaction_callback,
+            segment_size=100, record_key=keyed_record,
+            compaction_policy=ThresholdPolicy(float("inf")))
+        for i in range(20):
+            log.save_operation("set", i, i)
+        segments = list(log._segments)
+        log.close()
+        reopened_log = Log(log._backing_file, lambda: [("set", [0, 0])])
+        reopened_log.compact()
+        for segment in segments:
+            assert not os.path.exists(segment.path)
+        calls = []
+        reopened_log.replay({"set" : lambda *args: calls.append(args)})
+        assert calls == [(0, 0)]
+
+    def test_segments_need_record_key(self):
+        " Tests that segmented logs must be able to identify records. "
+        self.assertRaises(ValueError, Log, tempfile.NamedTemporaryFile().name,
+            dummy_compaction_callback, segment_size=100)
+
+    def test_segments_indexed_without_keys(self):
+        " Tests that segments are indexed even if records were saved unkeyed. "
+        log = Log(tempfile.NamedTemporaryFile().name, dummy_compaction_callback,
+            segment_size=100, record_key=keyed_record,
+            compaction_policy=ThresholdPolicy(float("inf")))
+        for i in range(50):
+            log.save_record(log.encode_operation("set", i % 2, i))
+        assert all(segment.indexed for segment in log._segments)
+        assert sum(segment.dead for segment in log._segments) > 0
+        log.compact()
+        state = {}
+        log.replay({"set" : state.__setitem__})
+        assert state == {0: 48, 1: 49}
+
+    def test_read_only(self):
+        " Tests that read-only logs never write and can be refreshed. "
+        for codec in [CODEC_JSON, CODEC_BINARY]:
+            path = tempfile.NamedTemporaryFile().name
+            reader = Log(path, dummy_compaction_callback, codec=codec,
+                read_only=True)
+            state = {}
+            op_map = {"set" : state.__setitem__}
+            reader.replay(op_map)
+            assert not os.path.exists(path) and state == {}
+            written = {}
+            log = Log(path, lambda: [("set", [key, value])
+                for key, value in written.items()], codec=codec)
+            def save(key, value):
+                written[key] = value
+                log.save_operation("set", key, value)
+            save(0, 0)
+            # The backing file did not exist when the log was read.
+            assert not reader.refresh(op_map)
+            reader.replay(op_map)
+            assert state == {0: 0}
+            save(1, 1)
+            # A record which is still being written is left for later.
+            record = log.encode_operation("set", 2, 2)
+            written[2] = 2
+            with open(path, 'ab') as tail:
+                tail.write(record[:3])
+            assert reader.refresh(op_map) and state == {0: 0, 1: 1}
+            with open(path, 'ab') as tail:
+                tail.write(record[3:])
+            assert reader.refresh(op_map) and state == written
+            self.assertRaises(IOError, reader.save_operation, "set", 3, 3)
+            reader.compact()
+            assert not os.path.exists(log._snapshot_file)
+            # Once the writer compacts, the reader must replay from scratch.
+            save(3, 3)
+            log.compact()
+            assert not reader.refresh(op_map)
+            state.clear()
+            reader.replay(op_map)
+            assert state == written
+            save(4, 4)
+            assert reader.refresh(op_map) and state == written
+            reader.close()
+            log.close()
+
+    def test_read_only_stale_tail(self):
+        " Tests that read-only logs skip a tail already in the snapshot. "
+        operation = DummyOperation()
+        compaction_callback = lambda: [(operation.name, operation.parameters)]
+        log = Log(tempfile.NamedTemporaryFile().name, compaction_callback)
+        for _ in range(10):
+            log.save_operation(operation.name, *operation.parameters)
+        old_tail = open(log._backing_file).read()
+        log.compact()
+        # Simulate a compaction which has not yet replaced the tail.
+        with open(log._backing_file, 'w') as tail:
+            tail.write(old_tail)
+        log.save_operation(operation.name, *operation.parameters)
+        log.flush()
+        tail = open(log._backing_file).read()
+        calls = []
+        reader = Log(log._backing_file, compaction_callback, read_only=True)
+        reader.replay({operation.name : lambda *args: calls.append(args)})
+        assert len(calls) == 2
+        assert open(log._backing_file).read() == tail
+
+    def test_locking_exclusive(self):
+        " Tests that an exclusively locked log keeps out other writers. "
+        path = tempfile.NamedTemporaryFile().name
+        log = Log(path, dummy_compaction_callback, locking=LOCKING_EXCLUSIVE)
+        log.save_operation("op", 0)
+        self.assertRaises(IOError, Log, path, dummy_compaction_callback,
+            locking=LOCKING_EXCLUSIVE)
+        # Readers do not lock.
+        calls = []
+        reader = Log(path, dummy_compaction_callback, read_only=True,
+            locking=LOCKING_EXCLUSIVE)
+        reader.replay({"op" : lambda *args: calls.append(args)})
+        assert calls == [(0,)]
+        log.close()
+        Log(path, dummy_compaction_callback, locking=LOCKING_EXCLUSIVE).close()
+
+    def test_locking_modes(self):
+        " Tests that unknown or unsupported locking setups are rejected. "
+        path = tempfile.NamedTemporaryFile().name
+        self.assertRaises(ValueError, Log, path, dummy_compaction_callback,
+            locking="unknown")
+        self.assertRaises(ValueError, Log, path, dummy_compaction_callback,
+            locking=LOCKING_COORDINATED, segment_size=100,
+            record_key=keyed_record)
+        self.assertRaises(ValueError, Log, path, dummy_compaction_callback,
+            locking=LOCKING_COORDINATED, background_compaction=True)
+        log = Log(path, dummy_compaction_callback)
+        self.assertRaises(ValueError, log.refresh, {})
@@ -1,9 +1,24 @@
 """ Tests for persisted_map.Map """
 
+import collections
+import multiprocessing
+import os
+import sys
 import tempfile
+import threading
+import time
 import unittest
 
-from persisted import Map
+from persisted import Map, GarbageRatioPolicy, ThresholdPolicy, CODEC_BINARY, \
+    DURABILITY_NONE, LOCKING_COORDINATED
+
+def increment(path, times):
+    # Runs in a writer process of a coordinated map.
+    test_map = Map(path, locking=LOCKING_COORDINATED)
+    for _ in range(times):
+        with test_map.batch():
+            test_map["count"] = test_map["count"] + 1
+    test_map.close()
 
 class TestMap(unittest.TestCase):
 
@@ -203,3 +218,404 @@ class TestMap(unittest.TestCase):
         except StopIteration:
             # This is what we expect to happen
             return
+
+    def test_close(self):
+        " Tests that buffered writes survive closing and re-opening the map. "
+        backing_file = tempfile.NamedTemporaryFile().name
+        test_map = Map(backing_file, group_commit_size=100)
+        for i in range(10):
+            test_map[i] = i * 10
+        test_map.close()
+        assert Map(backing_file) == test_map
+
+    def test_setitem_not_encodable(self):
+        " Tests that unencodable values are rejected without changing the map. "
+        test_map = Map(tempfile.NamedTemporaryFile().name)
+        self.assertRaises(TypeError, test_map.__setitem__, "key", object())
+        assert "key" not in test_map
+        assert Map(test_map._log._backing_file) == test_map
+
+    def test_replay_bypasses_mutators(self):
+        " Tests that loading a map does not go through its public mutators. "
+        existing_map = Map(tempfile.NamedTemporaryFile().name)
+        existing_map["key"] = "value"
+        existing_map["to be deleted"] = "value"
+        del existing_map["to be deleted"]
+        class ReadOnlyMap(Map):
+            def __setitem__(self, key, value):
+                raise AssertionError("__setitem__ called during replay")
+            def __delitem__(self, key):
+                raise AssertionError("__delitem__ called during replay")
+        loaded_map = ReadOnlyMap(existing_map._log._backing_file)
+        assert loaded_map._inner_map == existing_map._inner_map
+
+    def test_init_from_snapshot(self):
+        " Tests that a map larger than one snapshot record is reloaded. "
+        existing_map = Map(tempfile.NamedTemporaryFile().name)
+        for i in range(2500):
+            existing_map[i] = str(i)
+        # The first load writes the snapshot, the second reads it.
+        for _ in range(2):
+            loaded_map = Map(existing_map._log._backing_file)
+            assert loaded_map == existing_map
+
+    def test_background_compaction(self):
+        " Tests that a map compacted in the background reloads correctly. "
+        backing_file = tempfile.NamedTemporaryFile().name
+        test_map = Map(backing_file, background_compaction=True,
+            compaction_policy=ThresholdPolicy(threshold=1024))
+        for i in range(1000):
+            test_map[i % 100] = i
+        test_map._log._wait_for_compaction()
+        assert test_map._log._generation > 0
+        assert Map(backing_file) == test_map
+
+    def test_background_compaction_unflushed(self):
+        " Tests that records in the log's buffer survive compaction. "
+        backing_file = tempfile.NamedTemporaryFile().name
+        test_map = Map(backing_file, durability=DURABILITY_NONE,
+            background_compaction=True,
+            compaction_policy=ThresholdPolicy(threshold=20000))
+        for i in range(3000):
+            test_map[i] = i
+        test_map.close()
+        assert len(Map(backing_file)) == 3000
+
+    def test_stats(self):
+        " Tests that the map reports dead records to its log. "
+        test_map = Map(tempfile.NamedTemporaryFile().name,
+            compaction_policy=GarbageRatioPolicy(min_size=float("inf")))
+        for i in range(10):
+            test_map[i] = i
+        for i in range(5):
+            test_map[i] = i * 10
+        del test_map[9]
+        stats = test_map._log.stats
+        assert stats.live_records == 9
+        # Five overwritten sets, the deleted set and the deletion itself.
+        assert stats.dead_records == 7
+        assert 0 < stats.dead_bytes < stats.size
+        # Re-opening compacts, after which every record is live.
+        stats = Map(test_map._log._backing_file)._log.stats
+        assert stats.live_records == 9
+        assert stats.dead_records == 0
+
+    def test_garbage_ratio_compaction(self):
+        " Tests that rewriting the same keys triggers compaction. "
+        test_map = Map(tempfile.NamedTemporaryFile().name,
+            compaction_policy=GarbageRatioPolicy(min_size=1024))
+        for i in range(1000):
+            test_map[i % 10] = i
+        assert test_map._log._generation > 0
+        assert test_map._log.stats.size < 2048
+        assert Map(test_map._log._backing_file) == test_map
+
+    def test_batch(self):
+        " Tests that changes made in a batch are applied and persisted. "
+        test_map = Map(tempfile.NamedTemporaryFile().name)
+        test_map["to be deleted"] = 0
+        with test_map.batch():
+            for i in range(10):
+                test_map[i] = i
+            del test_map["to be deleted"]
+            # Changes are visible straight away.
+            assert test_map[9] == 9
+        assert len(open(test_map._log._backing_file).readlines()) == 2
+        assert Map(test_map._log._backing_file) == test_map
+
+    def test_binary_codec(self):
+        " Tests that maps can be persisted with the binary codec. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = Map(path, codec=CODEC_BINARY)
+        test_map[(1, 2)] = {3: "three"}
+        test_map["key"] = "value"
+        del test_map["key"]
+        with test_map.batch():
+            test_map["a"] = 1
+            test_map["b"] = [1.5, None]
+        test_map.close()
+        reloaded = Map(path, codec=CODEC_BINARY)
+        assert reloaded._inner_map == \
+            {(1, 2): {3: "three"}, "a": 1, "b": [1.5, None]}
+        reloaded._log.compact()
+        assert Map(path, codec=CODEC_BINARY) == reloaded
+
+    def test_segmented(self):
+        " Tests that segmented maps stay small as keys are overwritten. "
+        path = tempfile.NamedTemporaryFile().name
+        for background in [False, True]:
+            test_map = Map(path, segment_size=1000,
+                background_compaction=background,
+                compaction_policy=GarbageRatioPolicy(min_size=0))
+            for i in range(2000):
+                test_map[i % 10] = i
+                if i % 100 == 0:
+                    del test_map[i % 10]
+            test_map._log._wait_for_compaction()
+            assert test_map._log.stats.size < 5000
+            test_map.close()
+            reloaded = Map(path, segment_size=1000)
+            assert reloaded == test_map
+            reloaded.close()
+
+    def test_segmented_default_policy(self):
+        " Tests that overwritten segments do not pile up below min_size. "
+        path = tempfile.NamedTemporaryFile().name
+        for background in [False, True]:
+            test_map = Map(path, segment_size=2000,
+                background_compaction=background)
+            for i in range(6000):
+                test_map[i % 60] = i
+            test_map._log._wait_for_compaction()
+            assert len(test_map._log._segments) < 10
+            test_map.close()
+            assert Map(path, segment_size=2000) == test_map
+
+    def test_coalesce(self):
+        " Tests that only the last change to each key is saved. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = Map(path, coalesce_size=3)
+        test_map["a"] = 1
+        test_map["a"] = 2
+        test_map["b"] = 1
+        del test_map["b"]
+        # Reads see changes which have not been saved yet.
+        assert test_map["a"] == 2 and "b" not in test_map
+        assert os.stat(path).st_size == 0
+        test_map["c"] = 1
+        # The third key flushed the changes. "b" never reached the log.
+        records = open(path).read()
+        assert records.count('"set"') == 2 and '"b"' not in records
+        test_map["c"] = 2
+        del test_map["a"]
+        test_map.close()
+        assert Map(path)._inner_map == {"c": 2}
+
+    def test_coalesce_interval(self):
+        " Tests that coalesced changes are flushed after the interval. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = Map(path, coalesce_interval=0.05)
+        test_map["a"] = 1
+        assert os.stat(path).st_size == 0
+        time.sleep(0.2)
+        assert open(path).read().count('"set"') == 1
+        test_map.close()
+
+    def test_coalesce_batch(self):
+        " Tests that coalesced changes are saved before a batch. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = Map(path, coalesce_size=100)
+        test_map["a"] = 1
+        with test_map.batch():
+            test_map["a"] = 2
+            test_map["b"] = 2
+        # The batch was written straight away, after the older change.
+        assert open(path).read().count('"set"') == 3
+        test_map.close()
+        assert Map(path)._inner_map == {"a": 2, "b": 2}
+
+    def test_coalesce_flush_in_batch(self):
+        " Tests that flushing during a batch cannot deadlock with the timer. "
+        test_map = Map(tempfile.NamedTemporaryFile().name, coalesce_interval=10)
+
+        def write():
+            with test_map.batch():
+                # Stands in for the coalesce timer, firing during the batch.
+                timer = threading.Thread(target=test_map.flush)
+                timer.daemon = True
+                timer.start()
+                time.sleep(0.05)
+                test_map["a"] = 1
+                test_map.flush()
+            timer.join()
+
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        writer.start()
+        writer.join(5)
+        assert not writer.is_alive()
+        test_map.close()
+        assert Map(test_map._log._backing_file)["a"] == 1
+
+    def test_indexes(self):
+        " Tests that secondary indexes follow the values in the map. "
+        path = tempfile.NamedTemporaryFile().name
+        title = lambda page: page.get("title")
+        test_map = Map(path, indexes={"title": title})
+        test_map["a"] = {"title": "A"}
+        test_map["b"] = {"title": "A"}
+        test_map["c"] = {"title": "C"}
+        test_map["d"] = {}
+        assert test_map.lookup("title", "A") == set(["a", "b"])
+        test_map["b"] = {"title": "B"}
+        del test_map["c"]
+        assert test_map.lookup("title", "A") == set(["a"])
+        assert test_map.lookup("title", "B") == set(["b"])
+        assert test_map.lookup("title", "C") == set()
+        # Values the extractor returns None for are not indexed, and empty
+        # groups are dropped.
+        assert sorted(test_map._indexes["title"].buckets) == ["A", "B"]
+        self.assertRaises(ValueError, test_map.add_index, "title", title)
+        self.assertRaises(KeyError, test_map.lookup, "missing", "A")
+        test_map.close()
+        # Indexes are rebuilt when the map is opened.
+        reloaded = Map(path, indexes={"title": title})
+        assert reloaded.lookup("title", "B") == set(["b"])
+        reloaded.add_index("length", len)
+        assert reloaded.lookup("length", 0) == set(["d"])
+        reloaded.remove_index("length")
+        self.assertRaises(KeyError, reloaded.lookup, "length", 0)
+
+    def test_snapshot(self):
+        " Tests that snapshots are unaffected by later changes. "
+        test_map = Map(tempfile.NamedTemporaryFile().name)
+        for i in range(10):
+            test_map[i] = i
+        snapshot = test_map.snapshot()
+        items = snapshot.iteritems()
+        first = next(items)
+        # Changing the map while a snapshot is iterated does not disturb it.
+        for i in range(10, 20):
+            test_map[i] = i
+        del test_map[0]
+        test_map[1] = "changed"
+        assert sorted([first] + list(items)) == [(i, i) for i in range(10)]
+        assert len(snapshot) == 10 and 0 in snapshot and snapshot[1] == 1
+        assert len(test_map) == 19 and test_map[1] == "changed"
+        # Once no snapshot is in use, the map is changed in place again.
+        del snapshot, items
+        inner_map = test_map._inner_map
+        test_map[2] = "changed"
+        assert test_map._inner_map is inner_map
+
+    def test_snapshot_threads(self):
+        " Tests taking snapshots on one thread while another changes the map. "
+        test_map = Map(tempfile.NamedTemporaryFile().name,
+            durability=DURABILITY_NONE)
+        errors = []
+        done = threading.Event()
+
+        def read():
+            try:
+                while not done.is_set():
+                    snapshot = test_map.snapshot()
+                    items = list(snapshot.iteritems())
+                    assert list(snapshot.iteritems()) == items
+            except Exception as e:
+                errors.append(e)
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        # Switch threads as often as possible, to hit the races.
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for i in range(5000):
+                test_map[i % 50] = i
+                if i % 3 == 0:
+                    del test_map[i % 50]
+        finally:
+            sys.setcheckinterval(check_interval)
+            done.set()
+            reader.join()
+        assert not errors, errors
+
+    def test_compact_values(self):
+        " Tests that maps which keep their values compact behave as usual. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = Map(path, compact_values=True, value_cache_size=2,
+            indexes={"title" : lambda page: page["title"]})
+        plain_map = Map(tempfile.NamedTemporaryFile().name)
+        for i in range(5):
+            page = {"title" : "Page %d" % (i % 2), "ids" : [i, str(i)]}
+            test_map[i] = page
+            plain_map[i] = page
+        assert all(isinstance(stored, str)
+            for stored in test_map._inner_map.itervalues())
+        assert test_map == plain_map
+        assert test_map[3] == {"title" : "Page 1", "ids" : [3, "3"]}
+        # Cached values are returned again while they are recent.
+        assert test_map[1] is test_map[1]
+        test_map[4]
+        test_map[3]
+        assert list(test_map._value_cache) == [4, 3]
+        test_map[3] = {"title" : "Page 0", "ids" : []}
+        assert test_map[3] == {"title" : "Page 0", "ids" : []}
+        assert test_map.lookup("title", "Page 1") == frozenset([1])
+        assert test_map.__delitem__(4)["ids"] == [4, "4"]
+        snapshot = test_map.snapshot()
+        test_map[0] = {"title" : "Page 0", "ids" : None}
+        assert snapshot[0]["ids"] == [0, "0"] and snapshot.get(4) is None
+        assert sorted(page["ids"] for page in snapshot.itervalues()) == \
+            [[], [0, "0"], [1, "1"], [2, "2"]]
+        # Values which JSON can encode but marshal cannot are rejected.
+        with self.assertRaises(ValueError):
+            test_map[5] = collections.OrderedDict([("title", "Page 1")])
+        assert 5 not in test_map
+        test_map.close()
+        reloaded = Map(path, compact_values=True)
+        assert dict(reloaded.iteritems()) == dict(test_map.iteritems())
+        reloaded.close()
+        plain_map.close()
+
+    def test_read_only(self):
+        " Tests that read-only maps pick up changes made by a writer. "
+        path = tempfile.NamedTemporaryFile().name
+        writer = Map(path)
+        writer["a"] = {"title" : "A"}
+        reader = Map(path, read_only=True,
+            indexes={"title" : lambda page: page["title"]})
+        assert dict(reader.iteritems()) == {"a" : {"title" : "A"}}
+        with self.assertRaises(IOError):
+            reader["b"] = {"title" : "B"}
+        assert "b" not in reader
+        snapshot = reader.snapshot()
+        writer["b"] = {"title" : "B"}
+        writer["a"] = {"title" : "B"}
+        reader.refresh()
+        assert reader.lookup("title", "B") == frozenset(["a", "b"])
+        del writer["b"]
+        writer._log.compact()
+        writer["c"] = {"title" : "C"}
+        reader.refresh()
+        assert dict(reader.iteritems()) == dict(writer.iteritems())
+        assert reader.lookup("title", "B") == frozenset(["a"])
+        assert dict(snapshot.iteritems()) == {"a" : {"title" : "A"}}
+        reader.close()
+        writer.close()
+
+    def test_coordinated(self):
+        " Tests that coordinated maps catch up with each other's changes. "
+        path = tempfile.NamedTemporaryFile().name
+        first = Map(path, locking=LOCKING_COORDINATED)
+        second = Map(path, locking=LOCKING_COORDINATED)
+        first["a"] = 1
+        second["b"] = 2
+        assert dict(second.iteritems()) == {"a" : 1, "b" : 2}
+        first["a"] = 3
+        second.refresh()
+        assert second["a"] == 3
+        # Opening a third map compacts the log, replacing the tail.
+        third = Map(path, locking=LOCKING_COORDINATED)
+        del third["b"]
+        second["c"] = 4
+        first.refresh()
+        assert dict(first.iteritems()) == dict(second.iteritems()) == \
+            {"a" : 3, "c" : 4}
+        for test_map in [first, second, third]:
+            test_map.close()
+        assert dict(Map(path).iteritems()) == {"a" : 3, "c" : 4}
+
+    def test_coordinated_processes(self):
+        " Tests that coordinated writer processes do not lose changes. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = Map(path, locking=LOCKING_COORDINATED)
+        test_map["count"] = 0
+        test_map.close()
+        writers = [multiprocessing.Process(target=increment, args=(path, 30))
+            for _ in range(3)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        assert Map(path)["count"] == 90
@@ -0,0 +1,87 @@
+""" Tests for persisted.ShardedMap """
+
+import os
+import tempfile
+import threading
+import unittest
+
+from persisted import DiskMap, ShardedMap, ThresholdPolicy
+from persisted.sharded_map import shard_path
+
+class TestShardedMap(unittest.TestCase):
+
+    def test_set_get_delete(self):
+        " Tests the dict-like interface of the map. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = ShardedMap(path, shards=3)
+        for i in range(100):
+            test_map["key%d" % i] = i
+        del test_map["key0"]
+        assert len(test_map) == 99 and "key0" not in test_map
+        assert test_map["key42"] == 42
+        self.assertRaises(KeyError, test_map.__getitem__, "key0")
+        assert dict(test_map.iteritems()) == \
+            dict(("key%d" % i, i) for i in range(1, 100))
+        assert sorted(test_map) == sorted(test_map.iterkeys())
+        assert sorted(test_map.itervalues()) == range(1, 100)
+        # Every shard got some of the keys.
+        assert all(len(shard) for shard in test_map._shards)
+        test_map.close()
+        reloaded = ShardedMap(path, shards=3)
+        assert reloaded == test_map
+        reloaded["key1"] = "changed"
+        assert reloaded != test_map
+
+    def test_equal_keys(self):
+        " Tests that keys which are equal as dict keys share a shard. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = ShardedMap(path)
+        test_map[1] = "a"
+        test_map[1.0] = "b"
+        test_map[True] = "c"
+        test_map[2.5] = "d"
+        assert len(test_map) == 2
+        assert dict(test_map.iteritems()) == {1 : "c", 2.5 : "d"}
+        del test_map[1.0]
+        assert 1 not in test_map and True not in test_map
+        test_map.close()
+        assert dict(ShardedMap(path).iteritems()) == {2.5 : "d"}
+
+    def test_shard_count_checked(self):
+        " Tests that a map must be reopened with the same number of shards. "
+        path = tempfile.NamedTemporaryFile().name
+        ShardedMap(path, shards=2).close()
+        assert os.path.exists(shard_path(path, 1, 2))
+        self.assertRaises(ValueError, ShardedMap, path, shards=3)
+
+    def test_independent_compaction(self):
+        " Tests that shards are compacted on their own. "
+        path = tempfile.NamedTemporaryFile().name
+        policy = ThresholdPolicy(1000)
+        test_map = ShardedMap(path, shards=2, map_class=DiskMap,
+            compaction_policy=policy)
+        policies = [shard._log._compaction_policy for shard in test_map._shards]
+        assert policy not in policies and policies[0] is not policies[1]
+        key = "hot"
+        for i in range(100):
+            test_map[key] = i
+        generations = sorted(
+            shard._log.generation for shard in test_map._shards)
+        assert generations[0] == 0 and generations[1] > 0
+        assert test_map[key] == 99
+
+    def test_concurrent_writes(self):
+        " Tests that several threads can write to the map at once. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = ShardedMap(path, shards=4)
+        def write(thread):
+            for i in range(200):
+                test_map["%d-%d" % (thread, i)] = i
+        threads = [threading.Thread(target=write, args=(thread,))
+            for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        test_map.close()
+        assert len(ShardedMap(path, shards=4)) == 800
@@ -0,0 +1,68 @@
+""" Tests for persisted.SortedMap """
+
+import random
+import tempfile
+import unittest
+
+from persisted import SortedMap
+from persisted import sorted_map
+
+class TestSortedMap(unittest.TestCase):
+
+    def setUp(self):
+        # Use small blocks so that the tests cover splitting them.
+        self.block_size = sorted_map._block_size
+        sorted_map._block_size = 4
+
+    def tearDown(self):
+        sorted_map._block_size = self.block_size
+
+    def test_order_maintained(self):
+        " Tests that keys stay in order as they are added and removed. "
+        path = tempfile.NamedTemporaryFile().name
+        test_map = SortedMap(path)
+        keys = range(200)
+        random.shuffle(keys)
+        for key in keys:
+            test_map[key] = str(key)
+        for key in keys[:100]:
+            del test_map[key]
+        test_map[keys[0]] = "again"
+        expected = sorted(keys[100:] + keys[:1])
+        assert list(test_map) == list(test_map.iterkeys()) == expected
+        assert [value for _, value in test_map.iteritems()] == \
+            list(test_map.itervalues())
+        test_map.close()
+        # The index is rebuilt when the map is opened.
+        reloaded = SortedMap(path)
+        assert list(reloaded) == expected
+        assert reloaded == test_map
+
+    def test_queries(self):
+        " Tests range, prefix and nearest-key queries. "
+        test_map = SortedMap(tempfile.NamedTemporaryFile().name)
+        self.assertRaises(KeyError, test_map.first)
+        self.assertRaises(KeyError, test_map.last)
+        assert list(test_map.irange()) == []
+        for key in range(0, 100, 10):
+            test_map[key] = key
+        assert list(test_map.irange(15, 45)) == [20, 30, 40]
+        assert list(test_map.irange(20, 40)) == [20, 30, 40]
+        assert list(test_map.irange(hi=15)) == [0, 10]
+        assert list(test_map.irange(85)) == [90]
+        assert list(test_map.irange(100)) == []
+        assert test_map.first() == 0 and test_map.last() == 90
+        assert test_map.floor(35) == 30 and test_map.floor(30) == 30
+        assert test_map.ceiling(35) == 40 and test_map.ceiling(40) == 40
+        self.assertRaises(KeyError, test_map.floor, -1)
+        self.assertRaises(KeyError, test_map.ceiling, 91)
+
+    def test_prefix(self):
+        " Tests that prefix queries find exactly the matching keys. "
+        test_map = SortedMap(tempfile.NamedTemporaryFile().name)
+        urls = ["http://a.com/%d" % i for i in range(10)] + \
+            ["http://b.com/%d" % i for i in range(10)] + ["http://a.co"]
+        for url in urls:
+            test_map[url] = None
+        assert list(test_map.prefix("http://a.com/")) == sorted(urls[:10])
+        assert list(test_map.prefix("http://c")) == []
@@ -14,9 +14,40 @@ class Stack(object):
     url_key = "url"
     """ as_sorted_list[index][url_key]: the URL to the page """
 
-    def __init__(self, backing_file):
-        """ Initializes a new stack using the provided file. """
-        self.pages = persisted.Map(backing_file)
+    def __init__(self, backing_file, **log_options):
+        """ Initializes a new stack using the provided file.
+
+        Args:
+            backing_file (str)
+                The path to the file used to persist the stack.
+            **log_options (object)
+                Keyword arguments passed through to the persisted.Map backing
+                the stack and its log, e.g. durability, coalesce_size or
+                read_only.
+
+        """
+        self.pages = persisted.Map(backing_file, **log_options)
+
+    def close(self):
+        """ Writes out any buffered changes and closes the backing file. """
+        self.pages.close()
+
+    def refresh(self):
+        """ Picks up pages saved by another process since the stack was opened
+        with read_only=True, or last refreshed. See persisted.Map.refresh. """
+        self.pages.refresh()
+
+    def batch(self):
+        """ Returns a context manager which saves the changes made within it as
+        a single unit. See persisted.Map.batch.
+
+        Usage:
+            with stack.batch():
+                stack.add(url, title, timestamp)
+                ...
+
+        """
+        return self.pages.batch()
 
     def add(self, url, title, timestamp):
         """ Adds a new page to the stack.
@@ -63,10 +94,11 @@ class Stack(object):
                 The items in this stack, sorted by timestamp. The most recent
                 item will be first. Each item is represented as a dictionary.
         """
-        # First convert pages to a list of dictionaries.
-        pages_list = list(self.pages.itervalues())
+        # Sort a snapshot of the pages, so that the stack can be changed while
+        # we do.
         get_timestamp = lambda page: page[self.timestamp_key]
-        return sorted(pages_list, key = get_timestamp, reverse=True)
+        return sorted(self.pages.snapshot().itervalues(), key = get_timestamp,
+            reverse=True)
 
     def __eq__(self, other):
         """ Equality check. Returns NotImplemented for subclasses.
@@ -122,3 +122,12 @@ class TestStack(unittest.TestCase):
         assert child.__ne__(test_stack1) == NotImplemented
         # Other types should pass inequality checks.
         assert test_stack1 != "some string"
+
+    def test_batch(self):
+        " Tests that pages added in a batch are persisted. "
+        backing_file = tempfile.NamedTemporaryFile().name
+        stack = Stack(backing_file)
+        with stack.batch():
+            for i in range(10):
+                stack.add("url" + str(i) + ".com", "title", time.time())
+        assert Stack(backing_file) == stack